@@ -0,0 +1,1123 @@
+#!/usr/bin/env python
+"""Timing checks for the slow parts of merge.py and differences.py.
+
+Usage: benchmark.py [name ...]
+Runs all benchmarks if no name is given.
+
+With RESULTS_ENV set, the timings are written to that file as JSON.
+With BASELINE_ENV set to such a file from an earlier run, timings more
+than REGRESSION_RATIO times slower than it are printed, and the script
+exits with status 1.
+"""
+
+import os
+import sys
+import csv
+import time
+import random
+import gc
+import operator
+import warnings
+import tempfile
+import shutil
+import gzip
+import json
+import multiprocessing
+
+from merge import PropertyOwner, BusinessLicense, AddressManager, Address
+from merge import remove_duplicates, load_service_area, DUPLICATE_POLICIES
+from merge import write_snapshot, load_snapshot, SNAPSHOT_SUFFIX
+from merge import MERGE_ENGINES, ErrorManager, REGISTRY
+from merge import merge, output, output_salesforce, output_all
+from merge import SalesforceDelta
+from overrides import AddressOverrides
+from report import RunReport
+from history import UploadHistory
+from differences import diff, PO_IGNORE_FIELDS, BL_IGNORE_FIELDS
+from differences import compare_objects, comparator_for
+from salesforce import BulkUploader
+from salesforce_mock import MockSalesforce
+from generate import generate
+
+VALID_ADDR = load_service_area().valid_addresses
+
+# Parses the records built here, as it does those merge.py reads
+ADDRESS_MANAGER = REGISTRY['address_manager']
+
+SIZES = [10000, 20000, 40000, 80000, 160000]
+
+# Rows in each file of the uploads bench_scale generates. SIZES_ENV 
+# overrides them with a comma separated list, e.g. 1000,100000,10000000
+SCALE_SIZES = [1000, 10000, 100000]
+SIZES_ENV = 'SBIA_BENCHMARK_SIZES'
+
+# Street numbers apart a license can be from the owner it is matched to
+# in bench_merge and bench_scale, which check neighbour matching even 
+# though the service area file turns it off
+NEIGHBOUR_DISTANCE = 4
+
+# Environment variables naming the file to write this run's results to,
+# and the results of an earlier run to compare them with
+RESULTS_ENV = 'SBIA_BENCHMARK_RESULTS'
+BASELINE_ENV = 'SBIA_BENCHMARK_BASELINE'
+
+# Slower than the baseline by more than this is a regression. Timings
+# under MIN_COMPARED_SECONDS in the baseline are too noisy to compare.
+REGRESSION_RATIO = 1.5
+MIN_COMPARED_SECONDS = 0.1
+
+# Dicts of name, rows and seconds of each line reported
+RESULTS = []
+
+
+def parsed(cls, rows):
+    """cls records of rows, parsed by ADDRESS_MANAGER"""
+    return [cls(row, ADDRESS_MANAGER) for row in rows]
+
+
+def timed(func, *args):
+    """Runs func(*args).
+    @return Tuple of (seconds taken, return value of func)"""
+
+    start = time.time()
+    ret = func(*args)       # pylint: disable-msg=W0142
+    return (time.time() - start, ret)
+
+
+def report(name, size, seconds):
+    """Prints one line of benchmark output, and adds it to RESULTS"""
+    RESULTS.append({'name': name, 'rows': size, 'seconds': seconds})
+    per_row = seconds / size * 1000000
+    print('%-40s %10d rows %8.3fs %8.2f us/row' %
+            (name, size, seconds, per_row))
+
+
+def license_rows(size, duplicate_every=10):
+    """Business license rows, every 'duplicate_every' row repeats
+    an earlier license number with a later LICENSE YEAR"""
+
+    rows = []
+    for i in range(size):
+        number = i
+        year = '2011'
+        if i % duplicate_every == 0 and i:
+            number = i / 2
+            year = '2012'
+        rows.append(['1', '%08d' % number, '%d powell st' % (300 + i % 100),
+                'Retail', 'Issued', year, 'Business %d' % i, '', '',
+                '', '', '', '', '', ''])
+    return rows
+
+
+def owner_rows(size):
+    """Property owner rows, some with multi line mailing addresses"""
+
+    rows = []
+    for i in range(size):
+        civic = '%d powell st, vancouver' % (300 + i % 1000)
+        mailing = 'PO BOX %d\nVANCOUVER BC' % i
+        if i % 5 == 0:
+            mailing += '\nUSA'
+        rows.append(['%09d' % i, civic, 'Owner %d' % i, '', mailing,
+                '100000', '90000', '500', '', str(300 + i % 1000), 'powell'])
+    return rows
+
+
+class DictRecord(object):
+    """Copy of a record with a per-instance __dict__, the way
+    PropertyOwner and BusinessLicense used to be stored."""
+
+    def __init__(self, record):
+        for name in record.__slots__:
+            setattr(self, name, getattr(record, name))
+
+
+def record_bytes(record):
+    """Bytes taken by a record itself, not counting the strings it holds,
+    which are the same either way."""
+
+    size = sys.getsizeof(record)
+    if hasattr(record, '__dict__'):
+        size += sys.getsizeof(record.__dict__)
+    return size
+
+
+def bench_memory():
+    """Bytes per record with __slots__ versus with a __dict__"""
+
+    size = 10000
+    for name, cls, rows in [('PropertyOwner', PropertyOwner, owner_rows),
+                            ('BusinessLicense', BusinessLicense, license_rows)]:
+        records = parsed(cls, rows(size))
+        slots = sum(record_bytes(record) for record in records)
+        dicts = sum(record_bytes(DictRecord(record)) for record in records)
+        print('%-30s %10d bytes/record with __dict__, %d with __slots__' %
+                (name, dicts / size, slots / size))
+
+
+def address_corpus(size):
+    """Addresses the way they appear in the input files: mostly
+    Strathcona, in upper or lower case, with or without direction,
+    street type, unit number and city. Each file writes a given 
+    address the same way every time, and multi unit buildings repeat
+    the same civic address."""
+
+    rand = random.Random(size)
+    streets = sorted(VALID_ADDR.keys()) + ['main', 'kingsway']
+
+    civics = []
+    for _ in range(max(size / 20, 1)):
+        street = rand.choice(streets)
+        blocks = VALID_ADDR.get(street, [3, 12])
+        number = rand.choice(blocks) * 100 + rand.randint(0, 99)
+        direction = rand.choice(['', '', 'e ', 'w '])
+        street_type = rand.choice(['st', 'st', 'ave', 'av', 'dr', 'drive'])
+        city = rand.choice(['', ', vancouver'])
+        civic = '%d %s%s %s%s' % (number, direction, street, street_type, city)
+        if rand.randint(0, 1):
+            civic = civic.upper()
+        civics.append(civic)
+
+    corpus = []
+    while len(corpus) < size:
+        civic = rand.choice(civics)
+        corpus.append(civic)
+        if rand.randint(0, 9) == 0:
+            for unit in range(rand.randint(2, 40)):
+                corpus.append('%d %s' % (100 + unit, civic))
+
+    return corpus[:size]
+
+
+# Addresses that have caught out address cleaning before
+ODD_ADDRESSES = ['1250 e w hastings st', '305 e st', '12 drake st', 
+                 '305 clark diversion', '101 305 w e powell', 'powell st',
+                 '305 hastings st e, vancouver', '  305  POWELL ST ',
+                 '305 hastings, vancouver, bc', '0305 ave', '305 e']
+
+
+def check_clean(address_manager, corpus):
+    """Checks clean gives the same answer as clean_by_replace,
+    including raising the same exceptions.
+    @return Number of mismatches, each printed"""
+
+    def result(func, address, is_strong):
+        """Return value or exception class of func"""
+        try:
+            return func(address, is_strong)
+        except Exception, exc:      # pylint: disable-msg=W0703
+            return exc.__class__
+
+    mismatches = 0
+    for address in corpus + ODD_ADDRESSES:
+        for is_strong in [False, True]:
+            expected = result(address_manager.clean_by_replace, 
+                              address, is_strong)
+            got = result(address_manager.clean, address, is_strong)
+            if got != expected:
+                print('clean(%r, %s) is %r, expected %r' %
+                        (address, is_strong, got, expected))
+                mismatches += 1
+    return mismatches
+
+
+def bench_clean():
+    """clean, which strong cleans simple addresses with one match, 
+    versus clean_by_replace, called the way a record is cleaned: in the
+    constructor, the location check and merge"""
+
+    size = 200000
+    corpus = address_corpus(size)
+
+    if check_clean(AddressManager(), corpus):
+        sys.exit(1)
+
+    def run(func):
+        """Cleans the whole corpus the way merge.py does"""
+        for address in corpus:
+            func(address)
+            func(address)
+            func(address, True)
+
+    def run_strong(func):
+        """Strong cleans the whole corpus"""
+        for address in corpus:
+            func(address)
+
+    address_manager = AddressManager()
+    seconds, _ = timed(run, address_manager.clean_by_replace)
+    report('clean_by_replace', size, seconds)
+    seconds, _ = timed(run, AddressManager().clean)
+    report('clean', size, seconds)
+
+    strong = lambda address: address_manager.clean_by_replace(address, True)
+    seconds, _ = timed(run_strong, strong)
+    report('strong clean_by_replace', size, seconds)
+    seconds, _ = timed(run_strong, address_manager.clean_strong_by_pattern)
+    report('clean_strong_by_pattern', size, seconds)
+
+
+def bench_location():
+    """Service area lookup versus scanning the street's block list"""
+
+    size = 1000000
+    address_manager = AddressManager()
+    rand = random.Random(size)
+    streets = sorted(VALID_ADDR.keys()) + ['main', 'kingsway']
+    addresses = []
+    for _ in range(size):
+        street = rand.choice(streets)
+        block = rand.randint(0, 15)
+        addresses.append(Address(None, block * 100, street, block, None))
+
+    def is_in_location(address):
+        """The way is_in_location used to check"""
+        try:
+            valid_blocks = VALID_ADDR[address.street]
+        except KeyError:
+            return False
+        return address.block in valid_blocks
+
+    def scan():
+        """Check against block lists"""
+        inside = 0
+        for address in addresses:
+            if is_in_location(address):
+                inside += 1
+        return inside
+
+    def lookup():
+        """Check against the ServiceArea"""
+        inside = 0
+        for address in addresses:
+            if address_manager.is_in_location(address):
+                inside += 1
+        return inside
+
+    seconds, expected = timed(scan)
+    report('location by list scan', size, seconds)
+    seconds, inside = timed(lookup)
+    report('location by service area', size, seconds)
+    if inside != expected:
+        print('Service area found %d inside, list scan found %d' %
+                (inside, expected))
+        sys.exit(1)
+
+
+def write_csv(rows, num_columns):
+    """Writes rows to a temporary CSV file with a header row.
+    @return Filename, which the caller removes"""
+
+    (file_desc, filename) = tempfile.mkstemp(suffix='.csv')
+    csv_file = os.fdopen(file_desc, 'wb')
+    writer = csv.writer(csv_file)
+    writer.writerow(['Column %d' % i for i in range(num_columns)])
+    writer.writerows(rows)
+    csv_file.close()
+    return filename
+
+
+def bench_dedup():
+    """Duplicate license removal should take constant time per row"""
+
+    for size in SIZES:
+        licenses = parsed(BusinessLicense, license_rows(size))
+        for policy in DUPLICATE_POLICIES:
+            seconds, _ = timed(remove_duplicates, licenses, policy)
+            report('dedup %s' % policy, size, seconds)
+
+
+def diff_summary(differences):
+    """What a diff found, comparable whether the previous records
+    came from a CSV file or a snapshot"""
+
+    added, changed, removed = differences
+    return ([record.original_record for record in added],
+            [(key, changes) for key, _, changes in changed],
+            [(str(record), record.original_record) for record in removed])
+
+
+def bench_snapshot():
+    """Loading the previous upload from its snapshot versus parsing 
+    the CSV file, and diffing against each."""
+
+    size = 100000
+    for name, cls, rows, num_columns, ignore_fields in [
+            ('PropertyOwner', PropertyOwner, owner_rows, 11, 
+                PO_IGNORE_FIELDS),
+            ('BusinessLicense', BusinessLicense, license_rows, 15, 
+                BL_IGNORE_FIELDS)]:
+        previous_rows = rows(size)
+        filename = write_csv(previous_rows, num_columns)
+        try:
+            seconds, records = timed(cls.load, filename)
+            report('%s load CSV' % name, size, seconds)
+            seconds, _ = timed(write_snapshot, cls, records, filename)
+            report('%s write snapshot' % name, size, seconds)
+            seconds, snapshot = timed(load_snapshot, cls, filename)
+            report('%s load snapshot' % name, size, seconds)
+
+            # A few percent of rows changed or gone, the way a weekly 
+            # upload differs from the last
+            current_rows = [row[:] for i, row in enumerate(previous_rows)
+                            if i % 50]
+            for row in current_rows[::30]:
+                row[num_columns - 1] += ' changed'
+                row[4] += ' changed'
+            current = parsed(cls, current_rows)
+
+            seconds, differences = timed(diff, current, records, 
+                                         ignore_fields)
+            report('%s diff against CSV' % name, size, seconds)
+            expected = diff_summary(differences)
+            seconds, differences = timed(diff, current, snapshot, 
+                                         ignore_fields)
+            report('%s diff against snapshot' % name, size, seconds)
+            if diff_summary(differences) != expected:
+                print('%s diff against snapshot differs from CSV' % name)
+                sys.exit(1)
+        finally:
+            os.remove(filename)
+            os.remove(filename + SNAPSHOT_SUFFIX)
+
+
+def bench_pack():
+    """Loading business licenses, against packing them in a child of
+    pipeline.run_upload and unpacking them in the parent, on files made
+    up by generate.py. Checks the licenses unpacked are those packed."""
+
+    size = 100000
+    root = tempfile.mkdtemp()
+    saved_error_manager = REGISTRY['error_manager']
+    REGISTRY['error_manager'] = ErrorManager()
+    try:
+        filename = generate(root, size)['bl.csv']
+        seconds, licenses = timed(BusinessLicense.load, filename)
+        report('BusinessLicense load', size, seconds)
+    finally:
+        REGISTRY['error_manager'] = saved_error_manager
+        shutil.rmtree(root)
+
+    seconds, packed = timed(BusinessLicense.pack, licenses)
+    report('BusinessLicense pack', len(licenses), seconds)
+    seconds, unpacked = timed(BusinessLicense.unpack, packed)
+    report('BusinessLicense unpack', len(licenses), seconds)
+
+    state = operator.attrgetter(*[name    # pylint: disable-msg=W0142
+            for name in BusinessLicense.__slots__ 
+            if name not in ['parsed_address', 'owner']])
+    address = operator.attrgetter(*Address.__slots__)
+    if [(state(lic), address(lic.parsed_address)) for lic in unpacked] != \
+            [(state(lic), address(lic.parsed_address)) for lic in licenses]:
+        print('BusinessLicense unpacked different licenses to those packed')
+        sys.exit(1)
+
+
+def compare_by_field(obj1, obj2, ignore_fields):
+    """The way compare_objects used to compare"""
+
+    differences = []
+    for field in obj1.FIELDS:
+        if field in ignore_fields:
+            continue
+        new = getattr(obj1, field)
+        old = getattr(obj2, field)
+        new_test = new
+        old_test = old
+        try:
+            new_test = new.lower()
+            old_test = old.lower()
+        except AttributeError:
+            pass
+        if old_test != new_test:
+            differences.append((field, new, old))
+    return differences
+
+
+# Values that compare in unusual ways
+ODD_VALUES = ['', 'A', 'a', None, 0, 1, 1L, True, '1', u'a', u'A', 
+              u'\xc9', u'\xe9', '\xc9', "'", '"', '\n', 'N\\']
+
+
+class FieldRecord(object):
+    """Copy of a record's FIELDS, which can be set to anything"""
+
+    def __init__(self, record):
+        self.FIELDS = record.FIELDS    # pylint: disable-msg=C0103
+        for field in record.FIELDS:
+            setattr(self, field, getattr(record, field))
+
+
+def check_compare(records, ignore_fields):
+    """Checks Comparator gives the same answer as compare_by_field,
+    swapping in odd values
+    @return Number of mismatches, each printed"""
+
+    rand = random.Random(len(records))
+    comparator = comparator_for(records[0].__class__, ignore_fields)
+    mismatches = 0
+    for _ in range(2000):
+        new = FieldRecord(rand.choice(records))
+        old = FieldRecord(rand.choice([new, rand.choice(records)]))
+        for record in [new, old]:
+            for field in rand.sample(record.FIELDS, 2):
+                setattr(record, field, rand.choice(ODD_VALUES))
+
+        # Comparing str to unicode warns, the same with either
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UnicodeWarning)
+            expected = compare_by_field(new, old, ignore_fields)
+            got = comparator.differences(new, old)
+            is_same = comparator.is_same(new, old)
+        if got != expected or (is_same and expected):
+            print('Comparator found %r, same %s, expected %r' % 
+                    (got, is_same, expected))
+            mismatches += 1
+    return mismatches
+
+
+def bench_compare():
+    """Comparator versus comparing field by field, on pairs of which 
+    a few percent differ"""
+
+    size = 100000
+    for name, cls, rows, ignore_fields in [
+            ('PropertyOwner', PropertyOwner, owner_rows, PO_IGNORE_FIELDS),
+            ('BusinessLicense', BusinessLicense, license_rows, 
+                BL_IGNORE_FIELDS)]:
+        previous_rows = rows(size)
+        current_rows = [row[:] for row in previous_rows]
+        for row in current_rows[::30]:
+            row[2] += ' changed'
+        for row in current_rows[1::30]:
+            row[2] = row[2].upper()
+        pairs = zip(parsed(cls, current_rows),
+                    parsed(cls, previous_rows))
+
+        if check_compare([new for new, _ in pairs], ignore_fields):
+            sys.exit(1)
+
+        def by_field():
+            """Compares every pair field by field"""
+            return [compare_by_field(new, old, ignore_fields)
+                    for new, old in pairs]
+
+        def by_comparator():
+            """Compares every pair the way diff does"""
+            comparator = comparator_for(cls, ignore_fields)
+            return [[] if comparator.is_same(new, old) 
+                    else comparator.differences(new, old)
+                    for new, old in pairs]
+
+        seconds, expected = timed(by_field)
+        report('%s compare by field' % name, size, seconds)
+        seconds, differences = timed(by_comparator)
+        report('%s compare by Comparator' % name, size, seconds)
+        if differences != expected:
+            print('%s Comparator found different differences' % name)
+            sys.exit(1)
+
+
+def merge_rows(size):
+    """Owner and license rows to merge. Licenses mostly match an owner,
+    some only through the service area's address_owners or a neighbour,
+    some not at all. Owners' civic addresses repeat."""
+
+    owners = owner_rows(size)
+    owners.append(['999999999', '252 raymur ave, vancouver', 'Owner', '', 
+                   'PO BOX 1\nVANCOUVER BC', '1', '1', '1', '', '252', 
+                   'raymur'])
+
+    licenses = license_rows(size)
+    for i, row in enumerate(licenses):
+        if i % 7 == 0:
+            row[2] = '%d kingsway' % i
+        elif i % 11 == 0:
+            row[2] = '1007 cordova st'
+        elif i % 13 == 0:
+            row[2] = '%d powell street' % (300 + i % 100)
+        elif i % 17 == 0:
+            row[2] = '%d raymur ave' % (245 + i % 15)
+    return owners, licenses
+
+
+def merge_summary(owners, errors, overrides):
+    """What a merge did, comparable between engines"""
+
+    return ((overrides.hits, overrides.misses),
+            [(owner.original_record, 
+              [(business_license.original_record, 
+                business_license.owner.folio)
+               for business_license in owner.licenses])
+             for owner in owners],
+            [(obj.original_record, msg) for obj, msg in errors])
+
+
+def match_neighbours(distance):
+    """Sets the service area's neighbour_distance
+    @return What it was"""
+
+    service_area = ADDRESS_MANAGER.service_area
+    saved_distance = service_area.neighbour_distance
+    service_area.neighbour_distance = distance
+    return saved_distance
+
+
+def bench_merge():
+    """The merge engines, each checked against merge, matching
+    neighbours"""
+
+    size = 200000
+    owners, licenses = merge_rows(size)
+    expected = None
+    saved_error_manager = REGISTRY['error_manager']
+    saved_distance = match_neighbours(NEIGHBOUR_DISTANCE)
+    try:
+        for name in ['rows'] + sorted(set(MERGE_ENGINES) - set(['rows'])):
+            error_manager = REGISTRY['error_manager'] = ErrorManager()
+            parsed_owners = parsed(PropertyOwner, owners)
+            parsed_licenses = parsed(BusinessLicense, licenses)
+            overrides = AddressOverrides(None, 
+                    ADDRESS_MANAGER.service_area.address_owners)
+
+            # Collection pauses depend on what earlier engines left
+            # alive, leave them out
+            gc.collect()
+            gc.disable()
+            try:
+                seconds, merged = timed(MERGE_ENGINES[name], parsed_owners, 
+                                        parsed_licenses, overrides)
+            finally:
+                gc.enable()
+            report('merge engine %s' % name, size, seconds)
+
+            summary = merge_summary(merged, error_manager.errors, overrides)
+            if expected is None:
+                expected = summary
+            elif summary != expected:
+                print('merge engine %s merged differently to rows' % name)
+                sys.exit(1)
+    finally:
+        REGISTRY['error_manager'] = saved_error_manager
+        match_neighbours(saved_distance)
+
+
+def output_by_row(owners, out_filename, salesforce_filename):
+    """The output files written the way merge.py used to, without the
+    removed records: one file after the other, a writerow call per 
+    owner and license"""
+
+    for filename, write in [(out_filename, 'output_to'), 
+                            (salesforce_filename, 'output_salesforce_to')]:
+        out = open(filename, 'wb')
+        writer = csv.writer(out)
+        writer.writerow([])
+        for owner in owners:
+            getattr(owner, write)(writer)
+        out.close()
+
+
+def file_body(filename):
+    """Contents of an output file after its header row, 
+    uncompressed if it is gzipped"""
+
+    if filename.endswith('.gz'):
+        out = gzip.open(filename, 'rb')
+    else:
+        out = open(filename, 'rb')
+    try:
+        return out.read().split('\r\n', 1)[1]
+    finally:
+        out.close()
+
+
+def merged_owners(size):
+    """Owners from merge_rows, merged with their licenses, 
+    less repeated license numbers as BusinessLicense.load drops them"""
+
+    owners, licenses = merge_rows(size)
+    saved_error_manager = REGISTRY['error_manager']
+    REGISTRY['error_manager'] = ErrorManager()
+    try:
+        licenses, _ = remove_duplicates(parsed(BusinessLicense, licenses))
+        return merge(parsed(PropertyOwner, owners), licenses, 
+                     AddressOverrides())
+    finally:
+        REGISTRY['error_manager'] = saved_error_manager
+
+
+def bench_output():
+    """Writing the mailing list and Salesforce files a row at a time,
+    a writerows call per owner one file at a time, in one pass, and 
+    gzipped.
+    Checks they all write the same rows."""
+
+    owners = merged_owners(100000)
+    rows = len(owners) + sum(len(owner.licenses) for owner in owners)
+
+    root = tempfile.mkdtemp()
+    try:
+        # No records were removed
+        for compare_type in ['PO', 'BL']:
+            open(os.path.join(root, 'removed_cache_%s.csv' % compare_type),
+                 'wb').close()
+
+        def write_separately(owners, out_filename, salesforce_filename):
+            """output then output_salesforce"""
+            output(owners, out_filename)
+            output_salesforce(owners, salesforce_filename, root)
+
+        def write_together(owners, out_filename, salesforce_filename):
+            """output_all"""
+            output_all(owners, out_filename, salesforce_filename, root)
+
+        expected = None
+        for name, func, suffix in [
+                ('output by row', output_by_row, ''),
+                ('output separately', write_separately, ''),
+                ('output in one pass', write_together, ''),
+                ('output in one pass gzipped', write_together, '.gz')]:
+            filenames = [os.path.join(root, 'out.csv' + suffix),
+                         os.path.join(root, 'salesforce.csv' + suffix)]
+            seconds, _ = timed(func, owners, *filenames)
+            report(name, rows * 2, seconds)
+
+            bodies = [file_body(filename) for filename in filenames]
+            if expected is None:
+                expected = bodies
+            elif bodies != expected:
+                print('%s wrote different rows' % name)
+                sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_history():
+    """Adding uploads to an UploadHistory, reading one back, and looking
+    up when each of a thousand licenses first appeared. Checks the 
+    records read back are those added."""
+
+    owners, licenses, previous_owners, previous_licenses = upload_rows(20000)
+    root = tempfile.mkdtemp()
+    try:
+        history = UploadHistory(os.path.join(root, 'uploads.sqlite'))
+        for upload_date, owner_rows, license_rows in [
+                ('2012-04-01', previous_owners, previous_licenses),
+                ('2012-05-01', owners, licenses)]:
+            for compare_type, cls, rows in [('PO', PropertyOwner, owner_rows),
+                                            ('BL', BusinessLicense, 
+                                             license_rows)]:
+                records = parsed(cls, rows)
+                seconds, _ = timed(history.add, compare_type, upload_date,
+                                   'archive', records)
+                report('history add %s' % compare_type, len(records), 
+                       seconds)
+
+        seconds, read = timed(history.records, 'BL', '2012-05-01')
+        report('history records BL', len(read), seconds)
+        if sorted(record.original_record for record in read) != \
+                sorted(licenses):
+            print('history read back different licenses')
+            sys.exit(1)
+
+        numbers = [row[1] for row in licenses[::len(licenses) / 1000]]
+        seconds, seen = timed(map, lambda number: 
+                              history.first_seen('BL', number), numbers)
+        report('history first_seen', len(numbers), seconds)
+        if seen != [('2012-04-01', '2012-05-01')] * len(numbers):
+            print('history first_seen found the wrong uploads')
+            sys.exit(1)
+        history.close()
+    finally:
+        shutil.rmtree(root)
+
+
+def upload_rows(size):
+    """Owner and license rows of an upload with an owner at each of up
+    to 'size' addresses, and a license at every other one, and of the
+    upload before it. A few owners are new, and a few percent of owners
+    and licenses changed."""
+
+    addresses = ['%d %s st' % (block * 100 + number, street)
+                 for street, block in sorted(load_service_area().blocks)
+                 for number in range(100)][:size]
+
+    owners = []
+    previous_owners = []
+    for i, address in enumerate(addresses):
+        row = ['%09d' % i, address + ', vancouver', 'Owner %d' % i, '', 
+               'PO BOX %d\nVANCOUVER BC' % i, '100000', '90000', '500', '', 
+               address.split()[0], address.split()[1]]
+        owners.append(row)
+        if i % 97:
+            previous = row[:]
+            if i % 40 == 0:
+                previous[2] = 'Former owner %d' % i
+            previous_owners.append(previous)
+
+    licenses = []
+    previous_licenses = []
+    for i, address in enumerate(addresses[::2]):
+        row = ['1', '%08d' % i, address, 'Retail', 'Issued', '2012', 
+               'Business %d' % i, '', '', '', '', '', '', '', '']
+        licenses.append(row)
+        previous = row[:]
+        if i % 30 == 0:
+            previous[3] = 'Office'
+        previous_licenses.append(previous)
+
+    return owners, licenses, previous_owners, previous_licenses
+
+
+def bench_delta():
+    """The whole Salesforce file versus only what changed since the
+    previous upload, with and without the parents of changed licenses.
+    Checks the deltas only hold rows of the whole file, and that with
+    parents every license's parent account is in the file. Reports 
+    the number of rows each writes in brackets. Then uploads the whole
+    file to salesforce_mock.py followed by each delta, checking the
+    deltas update accounts the whole file added rather than adding
+    more."""
+
+    owners, licenses, previous_owners, previous_licenses = upload_rows(10000)
+    po_differences = diff(parsed(PropertyOwner, owners), 
+                          parsed(PropertyOwner, previous_owners), 
+                          PO_IGNORE_FIELDS)
+    bl_differences = diff(parsed(BusinessLicense, licenses), 
+                          parsed(BusinessLicense, previous_licenses), 
+                          BL_IGNORE_FIELDS)
+
+    saved_error_manager = REGISTRY['error_manager']
+    REGISTRY['error_manager'] = ErrorManager()
+    try:
+        merged = merge(parsed(PropertyOwner, owners),
+                       parsed(BusinessLicense, licenses), AddressOverrides())
+    finally:
+        REGISTRY['error_manager'] = saved_error_manager
+
+    root = tempfile.mkdtemp()
+    try:
+        # Nothing was removed
+        for compare_type in ['PO', 'BL']:
+            open(os.path.join(root, 'removed_cache_%s.csv' % compare_type),
+                 'wb').close()
+        filename = os.path.join(root, 'salesforce.csv')
+
+        full = None
+        # Tuples of (name, header, rows) of each file
+        files = []
+        for name, delta in [
+                ('salesforce full', None),
+                ('salesforce delta', SalesforceDelta.from_differences(
+                    po_differences, bl_differences)),
+                ('salesforce delta with parents', 
+                    SalesforceDelta.from_differences(
+                        po_differences, bl_differences, True))]:
+            seconds, _ = timed(output_salesforce, merged, filename, root, 
+                               delta)
+            salesforce_file = open(filename, 'rb')
+            reader = csv.reader(salesforce_file)
+            header = reader.next()
+            rows = [tuple(row) for row in reader]
+            salesforce_file.close()
+            files.append((name, header, rows))
+            report('%s (%d)' % (name, len(rows)), 
+                   len(owners) + len(licenses), seconds)
+
+            if full is None:
+                full = set(rows)
+            elif not full.issuperset(rows):
+                print('%s wrote rows the full file does not have' % name)
+                sys.exit(1)
+
+            account_names = set(row[1] for row in rows)
+            orphans = [row for row in rows 
+                       if row[2] and row[2] not in account_names]
+            if delta is not None and delta.with_parents and orphans:
+                print('%s left out %d parents' % (name, len(orphans)))
+                sys.exit(1)
+
+            # A changed owner brings along only its changed licenses
+            if delta is not None:
+                included = set()
+                excluded = set()
+                for owner in merged:
+                    for b_l in owner.licenses:
+                        if (owner.key in delta.added_owner_keys or
+                                b_l.key in delta.license_keys):
+                            included.add(b_l.account_name())
+                        else:
+                            excluded.add(b_l.account_name())
+                unchanged = [row for row in rows if row[5] and
+                             row[1] in excluded - included]
+                if unchanged:
+                    print('%s wrote %d licenses that did not change'
+                          % (name, len(unchanged)))
+                    sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+    server = MockSalesforce().start()
+    uploader = BulkUploader(server.url, batch_rows=1000, poll_interval=0.001)
+    try:
+        for name, header, rows in files:
+            processed, failed = uploader.upload(header, rows)
+            if failed:
+                print('uploading the %s failed %d of %d rows' % 
+                        (name, failed, processed))
+                sys.exit(1)
+            if name == 'salesforce full':
+                uploaded = len(server.accounts)
+            elif len(server.accounts) != uploaded:
+                print('uploading the %s after the full file went from ' \
+                        '%d accounts to %d' % (name, uploaded, 
+                                               len(server.accounts)))
+                sys.exit(1)
+    finally:
+        # A kept alive connection would leave its handler thread 
+        # reading from a closed server
+        uploader.close()
+        server.shutdown()
+        server.server_close()
+
+
+def account_names(server):
+    """Account Names of the accounts uploaded to a MockSalesforce"""
+    return set(row['Account Name'] for row in server.accounts.values())
+
+
+def bench_upload():
+    """Uploading a Salesforce file to salesforce_mock.py, throttling 
+    every few batches, with one worker and with several, then uploading
+    it again. Checks every row arrived, parents before children, over a
+    kept alive connection per worker, and that uploading again updated 
+    the accounts rather than adding copies."""
+
+    owners = merged_owners(20000)
+    root = tempfile.mkdtemp()
+    try:
+        for compare_type in ['PO', 'BL']:
+            open(os.path.join(root, 'removed_cache_%s.csv' % compare_type),
+                 'wb').close()
+        filename = os.path.join(root, 'salesforce.csv')
+        output_salesforce(owners, filename, root)
+        salesforce_file = open(filename, 'rb')
+        reader = csv.reader(salesforce_file)
+        header = reader.next()
+        rows = list(reader)
+        salesforce_file.close()
+    finally:
+        shutil.rmtree(root)
+    names = set(row[1] for row in rows)
+
+    for workers in [1, 4]:
+        server = MockSalesforce(throttle_every=7).start()
+        uploader = BulkUploader(server.url, workers=workers, 
+                                batch_rows=1000, retry_delay=0.001, 
+                                poll_interval=0.001)
+        try:
+            seconds, (processed, failed) = timed(uploader.upload, 
+                                                 header, rows)
+            uploaded = len(server.accounts)
+            connections = server.connections
+            again = uploader.upload(header, rows)
+        finally:
+            uploader.close()
+            server.shutdown()
+            server.server_close()
+        report('upload with %d workers' % workers, len(rows), seconds)
+
+        if (processed, failed) != (len(rows), 0) or \
+                account_names(server) != names:
+            print('upload with %d workers lost rows: %d processed, ' \
+                    '%d failed, %d accounts' % (workers, processed, failed,
+                    len(server.accounts)))
+            sys.exit(1)
+        if again != (len(rows), 0) or len(server.accounts) != uploaded:
+            print('uploading again with %d workers went from %d ' \
+                    'accounts to %d' % (workers, uploaded, 
+                                        len(server.accounts)))
+            sys.exit(1)
+        if not server.throttled or uploader.retries != server.throttled:
+            print('upload with %d workers retried %d times, ' \
+                    'throttled %d' % (workers, uploader.retries,
+                    server.throttled))
+            sys.exit(1)
+        if connections > workers + 1:
+            print('upload with %d workers opened %d connections' %
+                    (workers, connections))
+            sys.exit(1)
+
+
+def scale_sizes():
+    """SCALE_SIZES, or the sizes in SIZES_ENV"""
+
+    if SIZES_ENV in os.environ:
+        return [int(size) for size in os.environ[SIZES_ENV].split(',')]
+    return SCALE_SIZES
+
+
+def bench_scale():
+    """The whole upload, on files made up by generate.py at each of
+    scale_sizes(): loading, diffing against the previous upload, merging
+    and writing the Salesforce file. Checks the files held what merge.py
+    has to deal with: rows it rejects, duplicates, licenses matched by
+    address override and to neighbours, and differences."""
+
+    saved_distance = match_neighbours(NEIGHBOUR_DISTANCE)
+    try:
+        for size in scale_sizes():
+            scale(size)
+    finally:
+        match_neighbours(saved_distance)
+
+
+def scale(size):
+    """bench_scale at one size"""
+
+    service_area = ADDRESS_MANAGER.service_area
+    root = tempfile.mkdtemp()
+    saved_managers = (REGISTRY['error_manager'], REGISTRY['run_report'])
+    REGISTRY['error_manager'] = ErrorManager()
+    run_report = REGISTRY['run_report'] = RunReport()
+    try:
+        seconds, filenames = timed(generate, root, size)
+        report('generate', size, seconds)
+
+        with run_report.stage('scale'):
+            seconds, owners = timed(PropertyOwner.load, 
+                                    filenames['po.csv'])
+            report('load owners', size, seconds)
+            seconds, licenses = timed(BusinessLicense.load, 
+                                      filenames['bl.csv'])
+            report('load licenses', size, seconds)
+
+            differences = []
+            for name, records, cls, filename, ignore_fields in [
+                    ('owners', owners, PropertyOwner, 
+                        'previous_po.csv', PO_IGNORE_FIELDS),
+                    ('licenses', licenses, BusinessLicense, 
+                        'previous_bl.csv', BL_IGNORE_FIELDS)]:
+                previous = cls.load(filenames[filename])
+                seconds, found = timed(diff, records, previous, 
+                                       ignore_fields)
+                report('diff %s' % name, size, seconds)
+                differences.append(found)
+
+            overrides = AddressOverrides(None, 
+                                         service_area.address_owners)
+            seconds, merged = timed(merge, owners, licenses, overrides)
+            report('merge', size, seconds)
+
+            for compare_type in ['PO', 'BL']:
+                open(os.path.join(root, 
+                     'removed_cache_%s.csv' % compare_type), 
+                     'wb').close()
+            seconds, _ = timed(output_salesforce, merged, 
+                               os.path.join(root, 'salesforce.csv'), root)
+            report('output_salesforce', size, seconds)
+    finally:
+        REGISTRY['error_manager'], REGISTRY['run_report'] = \
+                saved_managers
+        shutil.rmtree(root)
+
+    counts = run_report.stages[0]['counts']
+    missing = [what for what in ['Duplicate license number', 
+                                 'Invalid license type',
+                                 'Not in %s or invalid address' % 
+                                     service_area.name,
+                                 'Matched by address override', 
+                                 'Matched to neighbour'] 
+               if not counts.get(what)]
+    missing += ['%s %s' % (what, name) 
+                for name, found in zip(['owners', 'licenses'], 
+                                       differences)
+                for what, records in zip(['added', 'changed', 'removed'],
+                                         found)
+                if not records]
+    if missing:
+        print('%d rows generated no %s' % (size, ', '.join(missing)))
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    'clean': bench_clean,
+    'compare': bench_compare,
+    'dedup': bench_dedup,
+    'history': bench_history,
+    'delta': bench_delta,
+    'location': bench_location,
+    'memory': bench_memory,
+    'merge': bench_merge,
+    'pack': bench_pack,
+    'output': bench_output,
+    'scale': bench_scale,
+    'snapshot': bench_snapshot,
+    'upload': bench_upload,
+}
+
+
+def write_results(filename):
+    """Writes RESULTS as JSON, with what they were measured on"""
+
+    results_file = open(filename, 'wt')
+    try:
+        json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'cpus': multiprocessing.cpu_count(),
+                   'results': RESULTS}, results_file, indent=1, 
+                  sort_keys=True)
+    finally:
+        results_file.close()
+
+
+def compare_results(filename):
+    """Prints RESULTS more than REGRESSION_RATIO times slower than the
+    same benchmark on the same number of rows in a results file
+    written by write_results
+    @return Number of regressions
+    """
+
+    results_file = open(filename, 'rt')
+    try:
+        baseline = json.load(results_file)
+    finally:
+        results_file.close()
+
+    expected = dict(((result['name'], result['rows']), result['seconds'])
+                    for result in baseline['results'])
+    regressions = 0
+    for result in RESULTS:
+        seconds = expected.get((result['name'], result['rows']))
+        if seconds is None or seconds < MIN_COMPARED_SECONDS:
+            continue
+        if result['seconds'] > seconds * REGRESSION_RATIO:
+            if not regressions:
+                print('Slower than %s:' % filename)
+            print('%-40s %10d rows %8.3fs, was %.3fs on %s' % 
+                    (result['name'], result['rows'], result['seconds'],
+                     seconds, baseline['date']))
+            regressions += 1
+    return regressions
+
+
+def main():
+    """Main"""
+
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark %s. Expected one of %s' %
+                    (name, ', '.join(sorted(BENCHMARKS.keys()))))
+            sys.exit(1)
+        BENCHMARKS[name]()
+
+    if RESULTS_ENV in os.environ:
+        write_results(os.environ[RESULTS_ENV])
+    if BASELINE_ENV in os.environ:
+        if compare_results(os.environ[BASELINE_ENV]):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,28 +10,188 @@ import csv
 import datetime
 import os
 import stat
+import heapq
+import itertools
+import marshal
+import tempfile
 
-from merge import PropertyOwner, BusinessLicense, wrapped
+import profiling
 
-PO_IGNORE_FIELDS = ['original_record', 
-                    'total_assess', 
-                    'included_assess', 
-                    'annual_charge',
-                    'house',
-                    'street_num',
-                    'mailing_street_1',
-                    'mailing_street_2',
-                    'mailing_street_3']
+from merge import PropertyOwner, BusinessLicense, wrapped, load_snapshot
+from merge import snapshot_rows, snapshot_record_class, SnapshotRecord
+from merge import ErrorManager, REGISTRY
 
-BL_IGNORE_FIELDS = ['original_record', 
-                    'status', 
-                    'record', 
-                    'license_year', 
-                    'license_number']
+PO_IGNORE_FIELDS = list(PropertyOwner.IGNORE_FIELDS)
+
+BL_IGNORE_FIELDS = list(BusinessLicense.IGNORE_FIELDS)
+
+# Record class and fields to ignore for each type we can compare
+COMPARE_TYPES = {
+    'PO': (PropertyOwner, PO_IGNORE_FIELDS),
+    'BL': (BusinessLicense, BL_IGNORE_FIELDS)
+}
+
+# Attribute each class's load sorts by. Of two records with the same
+# key, diff compares the one that comes later in that order.
+LOAD_ORDER = {
+    PropertyOwner: 'folio',
+    BusinessLicense: 'license_number'
+}
+
+# Records held in memory at a time while sorting for streaming_diff
+RUN_SIZE = 100000
+
+# Comparators built so far, see comparator_for. Tuple of (record 
+# class, previous record class, frozenset of ignored fields) to Comparator.
+COMPARATORS = {}
+
+STREAMING_FLAG = '--streaming'
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+
+class CountingErrorManager(ErrorManager):
+    """Counts rejected rows rather than keeping them, 
+    for when they won't be reported"""
+
+    def add(self, obj, msg):
+        self.skip(msg)
+
+
+class Spool(object):
+    """Items written to a temporary file as they are appended, and read
+    back in the same order, as many times as needed. Items must be
+    something marshal can write."""
+
+    def __init__(self, convert=None):
+        """
+        @param convert Function applied to each item as it is read back
+        """
+        self._file = tempfile.TemporaryFile()
+        self._count = 0
+        self._convert = convert
+
+    def append(self, item):
+        """Adds item at the end"""
+        marshal.dump(item, self._file, marshal.version)
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """Reads the items back. Don't append until this has finished."""
+
+        self._file.flush()
+        self._file.seek(0)
+        for _ in xrange(self._count):
+            item = marshal.load(self._file)
+            if self._convert:
+                item = self._convert(item)
+            yield item
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """Removes the temporary file"""
+        self._file.close()
+
+
+def values_getter(cls, fields):
+    """Function returning the tuple of the values of fields of a cls 
+    record. SnapshotRecord are tuples, so theirs are read by position,
+    which is quicker than through their attributes, and works on the 
+    rows of a snapshot as well."""
+
+    if issubclass(cls, SnapshotRecord):
+        get = operator.itemgetter
+        args = [cls._fields.index(field) for field in fields]
+    else:
+        get = operator.attrgetter
+        args = fields
+
+    if len(args) > 1:
+        return get(*args)       # pylint: disable-msg=W0142
+    getters = [get(arg) for arg in args]
+    return lambda record: tuple([getter(record) for getter in getters])
+
+
+class Comparator(object):
+    """compare_objects for one record class and set of ignored fields,
+    with what doesn't change between records worked out once. Most 
+    records haven't changed, so is_same checks all the compared fields 
+    at once, as a tuple, and only records that fail it are compared 
+    field by field.
+    """
+
+    def __init__(self, cls, ignore_fields, previous_cls=None):
+        """
+        @param cls Record class, with FIELDS
+        @param ignore_fields Attributes of cls records to not compare
+        @param previous_cls Class of the records compared against, 
+        e.g. a SnapshotRecord class. Defaults to cls.
+        """
+        self.fields = tuple([field for field in cls.FIELDS 
+                             if field not in ignore_fields])
+        self.values = values_getter(cls, self.fields)
+        self.previous_values = values_getter(previous_cls or cls, 
+                                             self.fields)
+
+    def is_same(self, new, old):
+        """Does new have no differences from old. Faster than 
+        differences, but can say False for records differences finds 
+        no differences in.
+        """
+
+        new_values = self.values(new)
+        old_values = self.previous_values(old)
+        if new_values == old_values:
+            return True
+
+        # Differ in case only?
+        return repr(new_values).lower() == repr(old_values).lower()
+
+    def differences(self, new, old):
+        """Same as compare_objects(new, old, ignore_fields)"""
+
+        differences = []
+
+        for field, new_value, old_value in zip(self.fields, self.values(new),
+                                               self.previous_values(old)):
+            new_test = new_value
+            old_test = old_value
+            try:
+                new_test = new_value.lower()
+                old_test = old_value.lower()
+            except AttributeError:
+                pass
+
+            if old_test != new_test:
+                differences.append((field, new_value, old_value))
+
+        return differences
+
+
+def comparator_for(cls, ignore_fields, previous_cls=None):
+    """The Comparator of cls records, against previous_cls records, 
+    ignoring ignore_fields. Each is only built once."""
+
+    previous_cls = previous_cls or cls
+    key = (cls, previous_cls, frozenset(ignore_fields))
+    try:
+        return COMPARATORS[key]
+    except KeyError:
+        comparator = COMPARATORS[key] = Comparator(cls, ignore_fields, 
+                                                   previous_cls)
+        return comparator
 
 
 def diff(current_arr, previous_arr, ignore_fields):
     """Takes two arrays and computes differences.
+    Where two records have the same key, the later one is compared.
+    previous_arr can hold SnapshotRecord rather than the class itself.
+    Records are compared with a Comparator, unchanged ones in one go.
     """
 
     # Middle brackets are 'generator comprehension'
@@ -40,14 +200,19 @@ def diff(current_arr, previous_arr, ignore_fields):
 
     added = []
     changed = []
+    comparator = None
 
-    for key, val in current_map.items():
+    for key, val in current_map.iteritems():
         if key in previous_map:
             prev = previous_map[key]
 
-            differences = compare_objects(val, prev, ignore_fields)
-            if differences:
-                changed.append((key, val, differences))
+            if comparator is None:
+                comparator = comparator_for(val.__class__, ignore_fields,
+                                            prev.__class__)
+            if not comparator.is_same(val, prev):
+                differences = comparator.differences(val, prev)
+                if differences:
+                    changed.append((key, val, differences))
 
             del previous_map[key]
         else:
@@ -63,66 +228,66 @@ def diff(current_arr, previous_arr, ignore_fields):
 
 
 def compare_objects(obj1, obj2, ignore_fields):
-    """Compares two objects.
+    """Compares two objects of the same class, on the attributes
+    listed in that class's FIELDS. Strings are compared ignoring case.
     @param ignore_fields Attributes of those objects to not compare
     @return Array of tuple (field, new, old) where field is the name
     of a field which has changed, new is current value, and 
     old is previous value.
     """
+    return comparator_for(obj1.__class__, ignore_fields, 
+                          obj2.__class__).differences(obj1, obj2)
 
-    differences = []
-
-    d_obj1 = obj1.__dict__
-    d_obj2 = obj2.__dict__
 
-    for field, new in d_obj1.items():
+def html_list(title, records, extra=None):
+    """Pretty HTML of a simple list. Yields lines."""
 
-        if field in ignore_fields:
-            continue
-
-        old = d_obj2[field]
+    yield '<h3>%s</h3>' % title
+    if extra:
+        yield '<p>%s</p>' % extra
+    yield '<ul>'
+    for record in records:
+        yield '<li>%s</li>' % (record,)
+    yield '</ul>'
 
-        new_test = new
-        old_test = old
-        try:
-            new_test = new.lower()
-            old_test = old.lower()
-        except AttributeError:
-            pass
 
-        if old_test != new_test:
-            differences.append((field, new, old))
-            
-    return differences
+def html_changes(changed):
+    """HTML for changed records. Yields lines."""
 
+    yield '<h3>Changes</h3>'
+    yield '<ul>'
+    for key, _, differences in changed:
+        yield '<li><b>%s</b>' % key
+        yield '<table>'
+        #yield '<tr><th>Field</th><th>Old</th><th>New</th></tr>'
+        for field, new, old in differences:
+            yield '<tr><td>%s</td><td>%s</td><td>%s</td></tr>' % \
+                    (field, old, new)
+        yield '</table></li>'
 
-def output_html_list(title, records, extra=None):
-    """Prints pretty HTML of a simple list"""
+    yield '</ul>'
 
-    print('<h3>%s</h3>' % title)
-    if extra:
-        print('<p>%s</p>' % extra)
-    print('<ul>')
-    for record in records:
-        print('<li>%s</li>' % record)
-    print('</ul>')
 
+def html_diff_lines(added, changed, removed):
+    """HTML of all the differences. Yields lines."""
 
-def output_html_changes(changed):
-    """Prints HTML for changed records"""
+    if added:
+        for line in html_list('New records', added):
+            yield line
+    if removed:
+        for line in html_list('Old records', 
+                    removed,
+                    extra='These need to be removed manually from Salesforce'):
+            yield line
+    if changed:
+        for line in html_changes(changed):
+            yield line
 
-    print('<h3>Changes</h3>')
-    print('<ul>')
-    for key, _, differences in changed:
-        print('<li><b>%s</b>' % key)
-        print('<table>')
-        #print('<tr><th>Field</th><th>Old</th><th>New</th></tr>')
-        for field, new, old in differences:
-            print('<tr><td>%s</td><td>%s</td><td>%s</td></tr>' %
-                    (field, old, new))
-        print('</table></li>')
 
-    print('</ul>')
+def html_diff(added, changed, removed):
+    """HTML of all the differences, for result.html"""
+    return ''.join(line + '\n' 
+                   for line in html_diff_lines(added, changed, removed))
 
 
 def output_csv_diff(compare_type, added, changed, removed):
@@ -151,62 +316,242 @@ def output_csv_diff(compare_type, added, changed, removed):
     os.chmod(filename, perms)
 
 
-def output_remove_cache(compare_type, removed):
+def output_remove_cache(compare_type, removed, root=None):
     """Writes out the removed rows, so that merge.py can load them
-    and include them in the salesforce import csv."""
+    and include them in the salesforce import csv.
+    @param root Directory to write to, defaults to this script's"""
 
-    script_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
-    filename = '%s/removed_cache_%s.csv' % (script_dir, compare_type)
+    if root is None:
+        root = os.path.abspath(os.path.dirname(sys.argv[0]))
+    filename = '%s/removed_cache_%s.csv' % (root, compare_type)
     out = csv.writer(open(filename, 'wb'))
 
     for obj in removed:
         out.writerow(obj.original_record)
 
 
+def compare(compare_type, current, previous_filename):
+    """Diffs current records against a previous upload.
+    @param compare_type 'PO' or 'BL'
+    @param current Array of PropertyOwner or BusinessLicense,
+    as their load returns it
+    @param previous_filename CSV file of the previous upload. Its
+    snapshot is read instead if there is one, see merge.load_snapshot.
+    @return Tuple of (added, changed, removed), see diff
+    """
+
+    cls, ignore_fields = COMPARE_TYPES[compare_type]
+
+    previous = load_snapshot(cls, previous_filename)
+    if previous is None:
+        previous = cls.load(previous_filename)
+    added, changed, removed = diff(current, previous, ignore_fields)
+
+    report = REGISTRY['run_report']
+    report.count('Added', len(added))
+    report.count('Changed', len(changed))
+    report.count('Removed', len(removed))
+    return (added, changed, removed)
+
+
+def output_differences(compare_type, added, changed, removed, root=None):
+    """Writes the differences CSV and the removed cache.
+    @param root Directory for the removed cache, defaults to this script's
+    """
+
+    output_csv_diff(compare_type, added, changed, removed)
+    output_remove_cache(compare_type, removed, root)
+
+
+def external_sort(items, run_size=RUN_SIZE):
+    """Sorts items, holding at most run_size of them in memory. 
+    Beyond that, sorted runs are written to temporary files and merged.
+    @param items Iterable of tuples something marshal can write
+    @return Iterator of items in order
+    """
+
+    runs = []
+    run = list(itertools.islice(items, run_size))
+    run.sort()
+    while len(run) == run_size:
+        spool = Spool()
+        for item in run:
+            spool.append(item)
+        runs.append(spool)
+        run = list(itertools.islice(items, run_size))
+        run.sort()
+
+    if not runs:
+        return iter(run)
+
+    if run:
+        runs.append(run)
+    return heapq.merge(*runs)       # pylint: disable-msg=W0142
+
+
+def keyed_rows(cls, records, run_size=RUN_SIZE):
+    """Snapshot rows of records in key order, and only the one diff
+    would compare where records share a key.
+    @param records Iterable of cls
+    @return Iterator of tuple (key, row), see merge.snapshot_rows
+    """
+
+    names = cls.FIELDS + ('key',)
+    key_index = names.index('key')
+    order_index = names.index(LOAD_ORDER[cls])
+
+    # The counter keeps records with the same key and load order 
+    # in file order, like the stable sort in load
+    counter = itertools.count()
+    decorated = ((row[key_index], row[order_index], counter.next(), row)
+                 for row in snapshot_rows(cls, records))
+
+    last_key = None
+    last_row = None
+    for key, _, _, row in external_sort(decorated, run_size):
+        if last_row is not None and key != last_key:
+            yield last_key, last_row
+        last_key = key
+        last_row = row
+    if last_row is not None:
+        yield last_key, last_row
+
+
+def streaming_diff(cls, current, previous, ignore_fields, run_size=RUN_SIZE):
+    """Finds the same differences as diff, but holds no more than 
+    run_size records of either input in memory. Both are sorted by
+    key, spilling to temporary files if needed, then walked together.
+    @param cls PropertyOwner or BusinessLicense
+    @param current Iterable of cls, e.g. from cls.iterate
+    @param previous Iterable of cls
+    @return Iterator of tuple (kind, item) in key order. kind is ADDED,
+    CHANGED or REMOVED. item is a record for ADDED and REMOVED, and 
+    (key, record, differences) for CHANGED, like diff's arrays. Records 
+    are SnapshotRecord.
+    """
+
+    record_class = snapshot_record_class(cls)
+    make_record = record_class._make
+    comparator = comparator_for(record_class, ignore_fields)
+
+    current_rows = keyed_rows(cls, current, run_size)
+    previous_rows = keyed_rows(cls, previous, run_size)
+    current_row = next(current_rows, None)
+    previous_row = next(previous_rows, None)
+
+    while current_row is not None or previous_row is not None:
+        if previous_row is None or \
+                (current_row is not None and current_row[0] < previous_row[0]):
+            yield ADDED, make_record(current_row[1])
+            current_row = next(current_rows, None)
+
+        elif current_row is None or previous_row[0] < current_row[0]:
+            yield REMOVED, make_record(previous_row[1])
+            previous_row = next(previous_rows, None)
+
+        else:
+            key, row = current_row
+            if not comparator.is_same(row, previous_row[1]):
+                record = make_record(row)
+                differences = comparator.differences(
+                                            record, make_record(previous_row[1]))
+                if differences:
+                    yield CHANGED, (key, record, differences)
+
+            current_row = next(current_rows, None)
+            previous_row = next(previous_rows, None)
+
+
+def output_streaming_differences(compare_type, current_filename, 
+                                 previous_filename, html_file, root=None,
+                                 run_size=RUN_SIZE):
+    """Writes the HTML of the differences between two CSV files to 
+    html_file, then the same files as output_differences, using 
+    streaming_diff. For files too big to diff in memory.
+
+    Each kind of difference is listed in its own section, so they are
+    kept in temporary files until the diff is done.
+    @param root Directory for the removed cache, defaults to this script's
+    """
+
+    cls, ignore_fields = COMPARE_TYPES[compare_type]
+    make_record = snapshot_record_class(cls)._make
+
+    def make_change(item):
+        """CHANGED item from what was spooled"""
+        key, row, differences = item
+        return (key, make_record(row), differences)
+
+    spools = {
+        ADDED: Spool(make_record),
+        REMOVED: Spool(make_record),
+        CHANGED: Spool(make_change)
+    }
+
+    try:
+        for kind, item in streaming_diff(cls, 
+                                         cls.iterate(current_filename),
+                                         cls.iterate(previous_filename),
+                                         ignore_fields, run_size):
+            if kind == CHANGED:
+                key, record, differences = item
+                item = (key, tuple(record), differences)
+            else:
+                item = tuple(item)
+            spools[kind].append(item)
+
+        added, changed, removed = \
+                spools[ADDED], spools[CHANGED], spools[REMOVED]
+        html_file.writelines(line + '\n' for line in 
+                             html_diff_lines(added, changed, removed))
+        output_differences(compare_type, added, changed, removed, root)
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+
 def main():
     """Main"""
 
-    if len(sys.argv) != 4:
-        print('%d arguments, expected 4' % len(sys.argv))
-        print('Usage: differences.py [PO|BL] ' +
+    args = sys.argv[1:]
+    is_streaming = args[:1] == [STREAMING_FLAG]
+    if is_streaming:
+        args = args[1:]
+
+    if len(args) != 3:
+        print('%d arguments, expected 3' % len(args))
+        print('Usage: differences.py [%s] [PO|BL] ' % STREAMING_FLAG +
                 'current.csv previous.csv')
+        print('%s diffs files of any size, with temporary files '
+                'rather than memory' % STREAMING_FLAG)
         syslog.syslog('differences.py: Wrong number of arguments to script')
         sys.exit(1)
 
-    compare_type = sys.argv[1]
+    compare_type = args[0]
 
-    if compare_type == 'PO':
-        load_func = PropertyOwner.load
-        ignore_fields = PO_IGNORE_FIELDS
-
-    elif compare_type == 'BL':
-        load_func = BusinessLicense.load
-        ignore_fields = BL_IGNORE_FIELDS
-
-    else:
+    if compare_type not in COMPARE_TYPES:
         msg = ('differences.py: Invalid first argument of %s.' % compare_type +
                 'Expected PO or BL')
         syslog.syslog(msg)
         print(msg)
         sys.exit(1)
 
-    current = wrapped(load_func, [sys.argv[2]], False)
-    previous = wrapped(load_func, [sys.argv[3]], False)
+    if is_streaming:
+        # Rejected rows aren't reported, don't keep them
+        REGISTRY['error_manager'] = CountingErrorManager()
+        wrapped(output_streaming_differences, 
+                [compare_type, args[1], args[2], sys.stdout], False)
+        return
 
-    (added, changed, removed) = diff(current, previous, ignore_fields)
+    cls, _ = COMPARE_TYPES[compare_type]
+    current = wrapped(cls.load, [args[1]], False)
 
-    if added:
-        output_html_list('New records', added)
-    if removed:
-        output_html_list('Old records', 
-                    removed,
-                    extra='These need to be removed manually from Salesforce')
-    if changed:
-        output_html_changes(changed)
+    (added, changed, removed) = wrapped(compare,
+                                        [compare_type, current, args[2]],
+                                        False)
 
-    output_csv_diff(compare_type, added, changed, removed)
-    output_remove_cache(compare_type, removed)
+    sys.stdout.write(html_diff(added, changed, removed))
+    output_differences(compare_type, added, changed, removed)
 
 if __name__ == '__main__':
-    main()
-
+    profiling.profiled(main, [], 'differences')
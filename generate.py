@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Writes made up property owner and business license files, laid out
+and written like the ones the city exports, to measure merge.py and
+differences.py against at any size.
+
+Owners are at addresses on the service area's streets and blocks,
+written the many ways the files write them, with unit numbers,
+multi line mailing addresses and foreign countries. A few are outside
+the service area. Licenses are mostly at owners' addresses, some at the
+business addresses of the service area's address_owners, some next door
+to an owner, some of a license type that is left out, and some repeat
+an earlier license number.
+
+Each file comes with the upload before it: the same rows, less the few
+added since, with a few changed, and a few rows removed since.
+
+Usage: generate.py <rows> <directory> [seed]
+Writes po.csv, bl.csv, previous_po.csv and previous_bl.csv of about
+<rows> rows each into directory. The same rows and seed always write
+the same files.
+"""
+
+import os
+import csv
+import sys
+import random
+import syslog
+
+from merge import load_service_area, wrapped, PO_COLS, BL_COLS
+
+# One in every this many rows, on average
+OUTSIDE_EVERY = 15          # owner outside the service area
+UNIT_EVERY = 4              # owner of a unit in a building
+LONG_MAILING_EVERY = 5      # owner with three lines of mailing address
+FOREIGN_EVERY = 20          # owner mailed abroad
+ADDRESS_OWNER_EVERY = 20    # license at one of address_owners
+NEIGHBOUR_EVERY = 25        # license next door to an owner
+DUPLICATE_EVERY = 10        # license repeats an earlier license number
+LEFT_OUT_TYPE_EVERY = 50    # license of a type merge.py leaves out
+
+# Numbers between owners' buildings on a block. Licenses next door to an
+# owner are between them.
+BUILDING_SPACING = 4
+
+# One in every this many rows, compared with the previous upload
+ADDED_EVERY = 100
+CHANGED_EVERY = 50
+REMOVED_EVERY = 100
+
+# Streets outside the service area
+OUTSIDE_STREETS = ['main', 'kingsway', 'commercial', 'fraser', 'granville']
+
+# Streets that are sometimes written with a direction
+DIRECTION_STREETS = frozenset(['hastings', 'cordova', 'pender', 'georgia',
+                               'keefer'])
+
+STREET_TYPES = ['st', 'st', 'st', 'street', 'ave', 'dr']
+
+COUNTRIES = ['USA', 'HONG KONG']
+
+LICENSE_TYPES = ['Retail', 'Office', 'Restaurant', 'Manufacturer',
+                 'Wholesale', 'Studio']
+LEFT_OUT_TYPE = 'One-Family Dwelling'
+
+
+class Generator(object):
+    """Makes up rows, from a seeded random number generator"""
+
+    def __init__(self, seed=0):
+        self.rand = random.Random(seed)
+        service_area = load_service_area()
+        self.blocks = sorted(service_area.blocks)
+        # Tuples of (business address, owner address)
+        self.address_owners = sorted(service_area.address_owners.items())
+        # Addresses of address_owners no owner is at
+        self.business_addresses = frozenset(
+                business_addr for business_addr, _ in self.address_owners)
+
+    def one_in(self, every):
+        """True one time in every 'every', at random"""
+        return self.rand.random() * every < 1
+
+    def civic(self, street, number):
+        """An address, written one of the ways the files write them"""
+
+        rand = self.rand
+        direction = ''
+        if street in DIRECTION_STREETS and self.one_in(3):
+            direction = rand.choice(['e ', 'E ', 'east '])
+        address = '%d %s%s %s' % (number, direction, street,
+                                  rand.choice(STREET_TYPES))
+        if not self.one_in(4):
+            address = address.upper()
+        return address
+
+    def owner_address(self, folio):
+        """Street and number of the property of an owner. The first
+        owners are at the owner addresses of address_owners. Then
+        every BUILDING_SPACING numbers of each block, other than the
+        business addresses of address_owners, has an owner before any
+        has two. Every OUTSIDE_EVERY owner is outside the service area.
+        """
+
+        if folio < len(self.address_owners):
+            number, street = self.address_owners[folio][1].split(' ', 1)
+            return (street, int(number))
+        if folio % OUTSIDE_EVERY == 0:
+            return (OUTSIDE_STREETS[folio % len(OUTSIDE_STREETS)],
+                    100 + folio % 5000)
+
+        street, block = self.blocks[folio % len(self.blocks)]
+        number = block * 100 + \
+                folio / len(self.blocks) * BUILDING_SPACING % 100
+        if '%d %s' % (number, street) in self.business_addresses:
+            number += 1
+        return (street, number)
+
+    def owner_row(self, folio):
+        """A property owner row"""
+
+        rand = self.rand
+        street, number = self.owner_address(folio)
+        civic = self.civic(street, number)
+        unit = ''
+        if self.one_in(UNIT_EVERY):
+            unit = str(rand.randint(101, 2499))
+            civic = '%s %s' % (unit, civic)
+
+        mailing = 'PO BOX %d\nVANCOUVER BC' % folio
+        if self.one_in(LONG_MAILING_EVERY):
+            mailing = '%d %s ST\nSUITE %d\nVANCOUVER BC' % (folio % 9999 + 1,
+                    rand.choice(OUTSIDE_STREETS).upper(), folio % 999 + 1)
+        if self.one_in(FOREIGN_EVERY):
+            mailing += '\n' + rand.choice(COUNTRIES)
+
+        assessed = rand.randint(100, 50000) * 100
+        return ['%09d' % folio, civic + ', VANCOUVER',
+                'OWNER %d' % folio, rand.choice(['', '', 'HOLDINGS LTD']),
+                mailing, str(assessed), str(assessed * 9 / 10),
+                str(assessed / 200), unit, str(number), street]
+
+    def license_row(self, number, owners):
+        """A business license row, at the address of one of the first
+        'owners' owners"""
+
+        rand = self.rand
+        if self.one_in(ADDRESS_OWNER_EVERY):
+            business_addr, _ = rand.choice(self.address_owners)
+            street_number, street = business_addr.split(' ', 1)
+            street_number = int(street_number)
+        else:
+            street, street_number = self.owner_address(
+                    int(rand.random() * owners))
+            if self.one_in(NEIGHBOUR_EVERY):
+                # Same side of the street
+                street_number += 2
+
+        license_type = rand.choice(LICENSE_TYPES)
+        if self.one_in(LEFT_OUT_TYPE_EVERY):
+            license_type = LEFT_OUT_TYPE
+
+        return ['1', '%08d' % number, self.civic(street, street_number),
+                license_type, rand.choice(['Issued', 'Issued', 'Pending']),
+                rand.choice(['2011', '2012']), 'BUSINESS %d' % number,
+                rand.choice(['', 'TRADE %d' % number]), 'VANCOUVER',
+                'PO BOX %d' % number, 'VANCOUVER BC', '', '',
+                '604-555-%04d' % (number % 10000), '']
+
+    def owner_rows(self, size):
+        """Yields size property owner rows"""
+
+        for folio in xrange(size):
+            yield self.owner_row(folio)
+
+    def license_rows(self, size, owners):
+        """Yields size business license rows, at the addresses of
+        owner_rows(owners)"""
+
+        for number in xrange(size):
+            if number and self.one_in(DUPLICATE_EVERY):
+                number = int(self.rand.random() * number)
+            yield self.license_row(number, owners)
+
+    def with_previous(self, rows, key_columns, removed_prefix,
+                      changed_column):
+        """Yields tuples of (row, row in the previous upload). Either is
+        None if the row was added or removed since.
+        @param key_columns Columns differences.py tells rows apart by
+        @param removed_prefix Put before the key columns of a row to 
+        make up a row that has been removed since
+        @param changed_column Column that changed in changed rows
+        """
+
+        for row in rows:
+            if self.one_in(REMOVED_EVERY):
+                removed = row[:]
+                for column in key_columns:
+                    if removed[column]:
+                        removed[column] = removed_prefix + removed[column]
+                yield (None, removed)
+
+            if self.one_in(ADDED_EVERY):
+                yield (row, None)
+            elif self.one_in(CHANGED_EVERY):
+                previous = row[:]
+                previous[changed_column] = 'FORMERLY ' + row[changed_column]
+                yield (row, previous)
+            else:
+                yield (row, row)
+
+
+def write_upload(rows, header, filename, previous_filename):
+    """Writes the rows of with_previous to a file, and the previous
+    upload's rows to another"""
+
+    current_file = open(filename, 'wb')
+    previous_file = open(previous_filename, 'wb')
+    try:
+        current = csv.writer(current_file)
+        previous = csv.writer(previous_file)
+        current.writerow(header)
+        previous.writerow(header)
+        for row, previous_row in rows:
+            if row is not None:
+                current.writerow(row)
+            if previous_row is not None:
+                previous.writerow(previous_row)
+    finally:
+        current_file.close()
+        previous_file.close()
+
+
+def generate(directory, size, seed=0):
+    """Writes po.csv, bl.csv, previous_po.csv and previous_bl.csv
+    of about size rows each into directory. Rows are written as they
+    are made up, so any size fits in memory.
+    @return Dict of file name to its path
+    """
+
+    generator = Generator(seed)
+    filenames = dict((name, os.path.join(directory, name)) for name in
+            ['po.csv', 'bl.csv', 'previous_po.csv', 'previous_bl.csv'])
+
+    # Owners are told apart by Civic, and a removed one was in a unit
+    # no owner is in now. Licenses are told apart by their names.
+    write_upload(generator.with_previous(generator.owner_rows(size), 
+                                         [1], '9999 ', 2),
+                 PO_COLS, filenames['po.csv'], filenames['previous_po.csv'])
+    write_upload(generator.with_previous(generator.license_rows(size, size),
+                                         [6, 7], 'CLOSED ', 9),
+                 BL_COLS, filenames['bl.csv'], filenames['previous_bl.csv'])
+
+    syslog.syslog('generate.py: Wrote %d rows to %s' % (size, directory))
+    return filenames
+
+
+def main():
+    """Main"""
+
+    if len(sys.argv) not in [3, 4]:
+        print(__doc__.strip())
+        syslog.syslog('generate.py: Wrong arguments to script')
+        sys.exit(1)
+
+    seed = 0
+    if len(sys.argv) == 4:
+        seed = int(sys.argv[3])
+    wrapped(generate, [sys.argv[2], int(sys.argv[1]), seed], False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+"""Archives each upload, keeping a history of their records, see archive
+and UploadHistory, and answers questions about past uploads from it.
+
+Usage:
+    history.py uploads
+    history.py first <folio or license number>
+    history.py address <address>
+    history.py diff <PO|BL> <date> [previous date]
+
+uploads lists the uploads stored. first tells when a property owner
+or business license was first and last uploaded. address lists every
+upload of the owners and licenses at an address, which can be given as
+it appears in the CSV files. diff shows what changed between the upload
+on a date, as YYYY-MM-DD, and the one before it or on previous date.
+"""
+
+import os
+import sys
+import stat
+import json
+import shutil
+import syslog
+import sqlite3
+import marshal
+import hashlib
+import tempfile
+import datetime
+
+from merge import PropertyOwner, BusinessLicense, wrapped, InvalidInput
+from merge import write_snapshot, SNAPSHOT_SUFFIX, REGISTRY
+from differences import diff, COMPARE_TYPES
+
+# SQLite database of the records of every archived upload, next to the
+# archives, see UploadHistory
+HISTORY_FILENAME = 'uploads.sqlite'
+
+# Names the latest upload's archives and snapshots, next to them, 
+# so finding them doesn't take a look at every archive. See write_manifest.
+MANIFEST_FILENAME = 'latest_upload.json'
+
+# Bytes read at a time by file_md5
+MD5_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadHistory(object):
+    """The records of every archived upload, in a SQLite database.
+    Each record's row is kept as marshal writes it, as in snapshots.
+    Owners are indexed by folio, licenses by license number, and both
+    by cleaned address (Address.key) and upload date, so that the 
+    previous upload, an upload on any date, or when a license first
+    appeared are each a lookup rather than a read of every archive."""
+
+    # Compare type to table and the column identifying its records
+    TABLES = {'PO': ('owners', 'folio'), 
+              'BL': ('licenses', 'license_number')}
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS uploads (
+            compare_type TEXT, upload_date TEXT, filename TEXT, 
+            rows INTEGER, PRIMARY KEY (compare_type, upload_date));
+        CREATE TABLE IF NOT EXISTS owners (
+            upload_date TEXT, folio TEXT, address TEXT, record BLOB);
+        CREATE INDEX IF NOT EXISTS owners_date ON owners (upload_date);
+        CREATE INDEX IF NOT EXISTS owners_folio 
+            ON owners (folio, upload_date);
+        CREATE INDEX IF NOT EXISTS owners_address 
+            ON owners (address, upload_date);
+        CREATE TABLE IF NOT EXISTS licenses (
+            upload_date TEXT, license_number TEXT, address TEXT, 
+            record BLOB);
+        CREATE INDEX IF NOT EXISTS licenses_date ON licenses (upload_date);
+        CREATE INDEX IF NOT EXISTS licenses_number 
+            ON licenses (license_number, upload_date);
+        CREATE INDEX IF NOT EXISTS licenses_address 
+            ON licenses (address, upload_date);
+    """
+
+    def __init__(self, filename):
+        """Opens the database, creating it if it doesn't exist
+        @raises sqlite3.Error
+        """
+        self.connection = sqlite3.connect(filename)
+        # The files aren't always UTF-8, text comes back as it went in
+        self.connection.text_factory = str
+        self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        """Closes the database"""
+        self.connection.close()
+
+    def add(self, compare_type, upload_date, filename, records):
+        """Stores the records of an upload, in place of any stored for
+        the same date
+        @param compare_type 'PO' or 'BL'
+        @param upload_date Date of the upload, as YYYY-MM-DD
+        @param filename Its archive
+        @param records Array of PropertyOwner or BusinessLicense
+        """
+
+        table, column = self.TABLES[compare_type]
+        rows = ((upload_date, getattr(record, column), 
+                 record.parsed_address.key, 
+                 sqlite3.Binary(marshal.dumps(record.original_record))) 
+                for record in records)
+
+        # All of it or none of it
+        with self.connection:
+            self.connection.execute('DELETE FROM uploads ' \
+                    'WHERE compare_type = ? AND upload_date = ?', 
+                    (compare_type, upload_date))
+            self.connection.execute('DELETE FROM %s WHERE upload_date = ?' %
+                    table, (upload_date,))
+            self.connection.execute('INSERT INTO uploads VALUES (?, ?, ?, ?)',
+                    (compare_type, upload_date, filename, len(records)))
+            self.connection.executemany(
+                    'INSERT INTO %s VALUES (?, ?, ?, ?)' % table, rows)
+
+    def uploads(self, compare_type):
+        """Uploads stored, oldest first
+        @return Array of tuples of (upload date, archive filename, rows)
+        """
+
+        return self.connection.execute('SELECT upload_date, filename, ' \
+                'rows FROM uploads WHERE compare_type = ? ' \
+                'ORDER BY upload_date', (compare_type,)).fetchall()
+
+    def previous(self, compare_type, before=None):
+        """The latest upload, or the latest before a date
+        @param before Date as YYYY-MM-DD
+        @return Tuple of (upload date, archive filename), or None if 
+        there isn't one
+        """
+
+        if before is None:
+            before = '9999'
+        return self.connection.execute('SELECT upload_date, filename ' \
+                'FROM uploads WHERE compare_type = ? AND upload_date < ? ' \
+                'ORDER BY upload_date DESC LIMIT 1', 
+                (compare_type, before)).fetchone()
+
+    def records(self, compare_type, upload_date, address_manager=None):
+        """The records of the upload on a date, parsed again from their
+        rows, in the order cls.load returns them
+        @param address_manager AddressManager the records parse their 
+        addresses with, REGISTRY['address_manager'] if not given
+        @return Array of PropertyOwner or BusinessLicense
+        """
+
+        if address_manager is None:
+            address_manager = REGISTRY['address_manager']
+
+        table, column = self.TABLES[compare_type]
+        cls = {'PO': PropertyOwner, 'BL': BusinessLicense}[compare_type]
+        cursor = self.connection.execute('SELECT record FROM %s ' \
+                'WHERE upload_date = ? ORDER BY %s' % (table, column), 
+                (upload_date,))
+        return [cls(marshal.loads(record), address_manager) 
+                for record, in cursor]
+
+    def first_seen(self, compare_type, identifier):
+        """When a folio or license number was first and last uploaded
+        @return Tuple of (first upload date, last upload date), 
+        or None if it never was
+        """
+
+        table, column = self.TABLES[compare_type]
+        first, last = self.connection.execute('SELECT MIN(upload_date), ' \
+                'MAX(upload_date) FROM %s WHERE %s = ?' % (table, column),
+                (identifier,)).fetchone()
+        if first is None:
+            return None
+        return (first, last)
+
+    def at_address(self, compare_type, address_key):
+        """Every upload of the owners or licenses at an address
+        @param address_key Cleaned address, see Address.key
+        @return Array of tuples of (upload date, folio or license number),
+        oldest first
+        """
+
+        table, column = self.TABLES[compare_type]
+        return self.connection.execute('SELECT upload_date, %s FROM %s ' \
+                'WHERE address = ? ORDER BY upload_date, %s' % 
+                (column, table, column), (address_key,)).fetchall()
+
+
+def history_filename(root=None):
+    """The UploadHistory database of the archives in root, 
+    defaults to this script's directory"""
+
+    if root is None:
+        root = os.path.abspath(os.path.dirname(sys.argv[0]))
+    return os.path.join(root, HISTORY_FILENAME)
+
+
+def file_md5(filename):
+    """MD5 of a file's contents, as hex"""
+
+    digest = hashlib.md5()
+    in_file = open(filename, 'rb')
+    try:
+        for block in iter(lambda: in_file.read(MD5_BLOCK_SIZE), ''):
+            digest.update(block)
+    finally:
+        in_file.close()
+    return digest.hexdigest()
+
+
+def manifest_filename(root=None):
+    """The manifest of the archives in root, 
+    defaults to this script's directory"""
+
+    if root is None:
+        root = os.path.abspath(os.path.dirname(sys.argv[0]))
+    return os.path.join(root, MANIFEST_FILENAME)
+
+
+def write_manifest(archives, root=None):
+    """Records the latest upload's archives and their snapshots in the
+    manifest, with their sizes and modification times, which tell
+    whether they have changed since, and their MD5s, to check them by 
+    when reading the manifest once in a while rather than every upload.
+    It is written to a temporary file that is renamed over the old one,
+    so it is only ever read whole.
+    @param archives Dict of compare type ('PO' or 'BL') to archive
+    @param root Archive directory, defaults to this script's
+    @raises IOError, OSError
+    """
+
+    manifest = {}
+    for compare_type, filename in archives.items():
+        snapshot = filename + SNAPSHOT_SUFFIX
+        snapshot_md5 = None
+        if os.path.exists(snapshot):
+            snapshot_md5 = file_md5(snapshot)
+        else:
+            snapshot = None
+        archive_stat = os.stat(filename)
+        manifest[compare_type] = {'archive': filename, 
+                                  'size': archive_stat.st_size,
+                                  'mtime': archive_stat.st_mtime,
+                                  'md5': file_md5(filename),
+                                  'snapshot': snapshot, 
+                                  'snapshot_md5': snapshot_md5}
+
+    filename = manifest_filename(root)
+    file_desc, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(filename), prefix=MANIFEST_FILENAME + '.')
+    try:
+        manifest_file = os.fdopen(file_desc, 'wt')
+        try:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        finally:
+            manifest_file.close()
+        os.chmod(temp_filename, 
+                 stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.rename(temp_filename, filename)
+    except:
+        os.remove(temp_filename)
+        raise
+
+
+def latest_archive(compare_type, root=None):
+    """The latest upload's archive, as the manifest records it.
+    Only the manifest is read, however many uploads have been archived,
+    and the archive is checked against it by its size and modification
+    time without reading it.
+    @param compare_type 'PO' or 'BL'
+    @param root Archive directory, defaults to this script's
+    @return Filename of the archive, or None if there is no manifest, 
+    or the archive has gone or changed since it was written
+    """
+
+    try:
+        manifest_file = open(manifest_filename(root), 'rt')
+        try:
+            entry = json.load(manifest_file)[compare_type]
+        finally:
+            manifest_file.close()
+        archive_stat = os.stat(entry['archive'])
+        if (archive_stat.st_size, archive_stat.st_mtime) != \
+                (entry['size'], entry['mtime']):
+            return None
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+    return entry['archive']
+
+
+def archive(po_filename, bl_filename, root=None, owners=None, licenses=None):
+    """Moves the uploaded Property Owners and 
+    Business Licenses files to an archive file
+    @param root Archive directory, defaults to this script's
+    @param owners Array of PropertyOwner parsed from po_filename, in the
+    order PropertyOwner.load returns them. If given, a snapshot of them 
+    is written next to the archive, see write_snapshot, and they are
+    added to the UploadHistory. The manifest is then written to name
+    the new archives, see write_manifest.
+    @param licenses Same for BusinessLicense and bl_filename
+    """
+
+    # Store archive in same dir as this script
+    if root is None:
+        root = os.path.abspath(os.path.dirname(sys.argv[0]))
+
+    upload_date = str(datetime.date.today())
+    po_archive = root + '/po.csv.%s' % upload_date
+    bl_archive = root + '/bl.csv.%s' % upload_date
+
+    shutil.move(po_filename, po_archive)
+    shutil.move(bl_filename, bl_archive)
+
+    perms = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+    os.chmod(po_archive, perms)
+    os.chmod(bl_archive, perms)
+
+    # The snapshots only save time, an upload doesn't fail without them
+    for cls, records, filename in [(PropertyOwner, owners, po_archive),
+                                   (BusinessLicense, licenses, bl_archive)]:
+        if records is None:
+            continue
+        try:
+            write_snapshot(cls, records, filename)
+        except (IOError, OSError, ValueError), exc:
+            syslog.syslog('merge.py: Could not write snapshot of %s: %s' %
+                    (filename, exc))
+
+    # Nor without the manifest, the archives can still be found. One
+    # naming the upload before this one must not be left behind though.
+    try:
+        write_manifest({'PO': po_archive, 'BL': bl_archive}, root)
+    except (IOError, OSError), exc:
+        syslog.syslog('merge.py: Could not write manifest: %s' % exc)
+        try:
+            os.remove(manifest_filename(root))
+        except OSError:
+            pass
+
+    # Nor without the history
+    if owners is None and licenses is None:
+        return
+    try:
+        history = UploadHistory(history_filename(root))
+        try:
+            for compare_type, records, filename in [
+                    ('PO', owners, po_archive), ('BL', licenses, bl_archive)]:
+                if records is not None:
+                    history.add(compare_type, upload_date, filename, records)
+        finally:
+            history.close()
+    except sqlite3.Error, exc:
+        syslog.syslog('merge.py: Could not add upload to history: %s' % exc)
+
+
+
+def open_history():
+    """The UploadHistory next to the archives
+    @raises InvalidInput if there isn't one"""
+
+    history = UploadHistory(history_filename())
+    if not (history.uploads('PO') or history.uploads('BL')):
+        history.close()
+        raise InvalidInput('No uploads have been archived in %s' %
+                           history_filename())
+    return history
+
+
+def list_uploads():
+    """Prints each upload stored"""
+
+    history = open_history()
+    try:
+        for compare_type in ['PO', 'BL']:
+            for upload_date, filename, rows in history.uploads(compare_type):
+                print('%s %s %8d rows  %s' %
+                        (upload_date, compare_type, rows, filename))
+    finally:
+        history.close()
+
+
+def first(identifier):
+    """Prints when a folio or license number was first and last
+    uploaded"""
+
+    history = open_history()
+    try:
+        for compare_type, name in [('PO', 'Folio'),
+                                   ('BL', 'License number')]:
+            seen = history.first_seen(compare_type, identifier)
+            if seen is not None:
+                print('%s %s first uploaded %s, last uploaded %s' %
+                        ((name, identifier) + seen))
+                return
+    finally:
+        history.close()
+    print('%s has never been uploaded' % identifier)
+
+
+def address(text):
+    """Prints every upload of the owners and licenses at an address"""
+
+    key = REGISTRY['address_manager'].parse(text).key
+    if key is None:
+        raise InvalidInput('%s is not an address' % text)
+
+    history = open_history()
+    try:
+        for compare_type, name in [('PO', 'Folio'),
+                                   ('BL', 'License number')]:
+            for upload_date, identifier in history.at_address(compare_type,
+                                                              key):
+                print('%s %s %s' % (upload_date, name, identifier))
+    finally:
+        history.close()
+
+
+def diff_uploads(compare_type, upload_date, previous_date=None):
+    """Prints the differences between two uploads
+    @param previous_date Defaults to the upload before upload_date
+    @raises InvalidInput if there was no upload on either date
+    """
+
+    if compare_type not in COMPARE_TYPES:
+        raise InvalidInput('Expected PO or BL, got %s' % compare_type)
+
+    history = open_history()
+    try:
+        dates = set(date for date, _, _ in history.uploads(compare_type))
+        for date in [upload_date, previous_date]:
+            if date is not None and date not in dates:
+                raise InvalidInput('No %s upload on %s' % 
+                                   (compare_type, date))
+
+        if previous_date is None:
+            previous = history.previous(compare_type, upload_date)
+            if previous is None:
+                raise InvalidInput('No %s upload before %s' %
+                                   (compare_type, upload_date))
+            previous_date = previous[0]
+
+        _, ignore_fields = COMPARE_TYPES[compare_type]
+        added, changed, removed = diff(
+                history.records(compare_type, upload_date),
+                history.records(compare_type, previous_date), ignore_fields)
+    finally:
+        history.close()
+
+    print('%s %s against %s: %d added, %d changed, %d removed' %
+            (compare_type, upload_date, previous_date,
+             len(added), len(changed), len(removed)))
+    for record in added:
+        print('+ %s' % record)
+    for _, record, changes in changed:
+        print('~ %s: %s' % (record, ', '.join('%s %r was %r' % change
+                                              for change in changes)))
+    for record in removed:
+        print('- %s' % record)
+
+
+COMMANDS = {
+    'uploads': (list_uploads, [0]),
+    'first': (first, [1]),
+    'address': (address, [1]),
+    'diff': (diff_uploads, [2, 3]),
+}
+
+
+def main():
+    """Main"""
+
+    args = sys.argv[1:]
+    try:
+        func, num_args = COMMANDS[args[0]]
+    except (IndexError, KeyError):
+        func, num_args = None, None
+
+    if func is None or len(args) - 1 not in num_args:
+        print(__doc__.strip())
+        syslog.syslog('history.py: Wrong arguments to script')
+        sys.exit(1)
+
+    wrapped(func, args[1:], False)
+
+
+if __name__ == '__main__':
+    main()
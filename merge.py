@@ -7,240 +7,86 @@
 import os
 import csv
 import sys
-import shutil
 import datetime
 import operator
 import syslog
 import stat
+import re
+import json
+import hashlib
+import marshal
+import collections
+import itertools
+import bisect
+import gc
+import gzip
+import cPickle as pickle
+
+import profiling
+from report import RunReport
+
+# Service area definition used when SERVICE_AREA_ENV isn't set: 
+# the streets and blocks that count as Strathcona, and its lookup tables.
+DEFAULT_AREA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'strathcona.json')
+
+# Environment variable naming a different service area file
+SERVICE_AREA_ENV = 'SBIA_SERVICE_AREA'
+
+# Version of the service area file format we understand
+AREA_FILE_VERSION = 1
+
+# Bump when ServiceArea changes, so old pickled indexes are rebuilt
+AREA_INDEX_VERSION = 2
+
+# Which record to keep when a license number appears more than once
+DUPLICATE_FIRST = 'first'       # First row in the file wins
+DUPLICATE_LAST = 'last'         # Last row in the file wins
+DUPLICATE_NEWEST = 'newest'     # Highest LICENSE YEAR wins, ties go to first
+DUPLICATE_POLICIES = [DUPLICATE_FIRST, DUPLICATE_LAST, DUPLICATE_NEWEST]
+
+# Addresses such as '101 305 e hastings st, vancouver' which 
+# clean(is_strong=True) can handle in one match. 
+# Groups are street number and street.
+SIMPLE_ADDRESS = re.compile(r'^(?:\d+ )?(\d+) (?:[ew] )?([a-z]+)'
+                            r'(?: (?:st|av|ave|dr|drive))?(?: [ew])?'
+                            r'(?:, vancouver)?$')
+
+# Street names which clean() treats as something else
+# (a direction or street type), so can't take the simple path
+AMBIGUOUS_STREETS = frozenset(['e', 'w', 'st', 'av', 'ave'])
+AMBIGUOUS_STREET_PREFIXES = ('dr', 'diversion')
+
+# Number of parsed addresses AddressManager remembers
+PARSE_CACHE_SIZE = 50000
+
+# Environment variable naming the merge engine, one of MERGE_ENGINES.
+# 'rows' if not set.
+MERGE_ENGINE_ENV = 'SBIA_MERGE_ENGINE'
+
+# Output files named with GZIP_SUFFIX are compressed at 
+# OUTPUT_GZIP_LEVEL, see open_output
+GZIP_SUFFIX = '.gz'
+OUTPUT_GZIP_LEVEL = 6
+
+# Environment variable naming what pipeline.py puts in the Salesforce 
+# file, one of SALESFORCE_EXPORTS. 'full' if not set.
+SALESFORCE_EXPORT_ENV = 'SBIA_SALESFORCE_EXPORT'
+
+# Written next to each archived upload, e.g. po.csv.2012-05-01.snapshot,
+# so the next upload's differences don't have to parse it again.
+# Bump the version when parsing changes what a record holds.
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_VERSION = 3
 
-# Address that count as Strathcona. Examples: 
-#  Railway St includes the 300, 400 and 500 blocks.
-#  Georgia St includes only the 12000 block.
-VALID_ADDR = {
-
-    # West-East
-    'railway': [3, 4, 5],
-    'alexander': [3, 4, 5, 6, 7],
-    'powell': [3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13],
-    'cordova': [3, 4, 5, 6, 7, 8, 9, 10],
-    'hastings': [3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13],
-    'franklin': [11, 12],
-    'pender': [10, 11, 12],
-    'frances': [12, 13],
-    'keefer': [10],
-    'georgia': [10, 11, 12],
-    'adanac': [12],
-    'union': [10, 11],
-    'venables': [10, 11, 12, 13],
-
-    # North-South
-    'gore': [0, 1, 2, 3, 4],
-    'dunlevy': [0, 1, 2, 3, 4],
-    'jackson': [0, 1, 2, 3, 4],
-    'princess': [1, 2, 3, 4],
-    'heatley': [1, 2, 3, 4],
-    'hawks': [1, 2, 3, 4],
-    'campbell': [3, 4],
-    'raymur': [2, 3, 4, 5, 6, 7, 8],
-    'glen': [2, 3, 4, 5, 6, 7, 8],
-    'vernon': [2, 3, 4, 5, 6, 7, 8],
-    'clark': [2, 3, 4, 5, 6, 7, 8]
-}
+REGISTRY = {}
 
-# Countries that Mailing Address has been seen in 
-COUNTRIES = ['usa', 'hong kong']
-
-# Business License Types to ignore
-INVALID_LICENSE_TYPE = ['one family dwelling']
-
-# Business names to ignore
-INVALID_BUSINESS_NAME = ['provincial rental housing corporation']
-
-# Business address to property owners address
-ADDRESS_OWNERS = {
-
-        '1227 adanac': '1219 adanac',
-        '1228 adanac': '1255 venables',
-        '1311 adanac': '790 clark',
-
-        '302 alexander': '300 alexander',
-        '310 alexander': '320 alexander',
-        '362 alexander': '360 alexander',
-        '397 alexander': '395 alexander',
-        '472 alexander': '450 alexander',
-        '720 alexander': '716 alexander',
-
-        '526 clark': '1305 frances',
-        '530 clark': '1305 frances',
-        '550 clark': '1305 frances',
-        '560 clark': '1305 frances',
-        '570 clark': '1305 frances',
-        '590 clark': '1305 frances',
-        '777 clark': '775 clark',
-        '823 clark': '1255 venables',
-
-        '385 cordova': '255 dunlevy',
-        '742 cordova': '731 cordova',
-        '876 cordova': '889 cordova',
-        '1007 cordova': '252 raymur',
-        '1009 cordova': '252 raymur',
-        '1019 cordova': '252 raymur',
-        '1021 cordova': '252 raymur',
-        '1055 cordova': '252 raymur',
-
-        '37 dunlevy': '45 dunlevy',
-        '49 dunlevy': '45 dunlevy',
-        '55 dunlevy': '395 alexander',
-        '402 dunlevy': '406 hastings',
-        '406 dunlevy': '406 hastings',
-        '408 dunlevy': '406 hastings',
-        '418 dunlevy': '406 hastings',
-
-        '1221 frances': '1223 frances',
-        '1231 frances': '1223 frances',
-        '1258 frances': '1254 frances',
-
-        '1104 franklin': '1102 franklin',
-        '1146 franklin': '1180 franklin',
-        '1198 franklin': '1180 franklin',
-
-        '1138 georgia': '1134 georgia',
-
-        '326 hastings': '330 hastings',
-        '328 hastings': '330 hastings',
-        '336 hastings': '334 hastings',
-        '339 hastings': '337 hastings',
-        '380 hastings': '427 dunlevy',
-        '384 hastings': '427 dunlevy',
-        '388 hastings': '427 dunlevy',
-        #'392 hastings': '427 dunlevy',
-        #'398 hastings': '427 dunlevy',
-        '398 hastings': '392 hastings',
-        '408 hastings': '406 hastings',
-        '410 hastings': '406 hastings',
-        '412 hastings': '406 hastings',
-        '420 hastings': '422 hastings',
-        '431 hastings': '437 hastings',
-        '432 hastings': '430 hastings',
-        '439 hastings': '437 hastings',
-        '441 hastings': '440 hastings',
-        '461 hastings': '459 hastings',
-        '463 hastings': '459 hastings',
-        '502 hastings': '408 jackson',
-        '504 hastings': '408 jackson',
-        '505 hastings': '501 hastings',
-        '509 hastings': '501 hastings',
-        '531 hastings': '527 hastings',
-        '604 hastings': '600 hastings',
-        '606 hastings': '600 hastings',
-        '643 hastings': '641 hastings',
-        '649 hastings': '647 hastings',
-        '651 hastings': '647 hastings',
-        '708 hastings': '702 hastings',
-        '745 hastings': '717 hastings',
-        '786 hastings': '782 hastings',
-        '823 hastings': '821 hastings',
-        '825 hastings': '821 hastings',
-        '852 hastings': '848 hastings',
-        '862 hastings': '848 hastings',
-        '869 hastings': '877 hastings',
-        '873 hastings': '877 hastings',
-        '879 hastings': '877 hastings',
-        '881 hastings': '877 hastings',
-        '884 hastings': '882 hastings',
-        '961 hastings': '955 hastings',
-        '965 hastings': '955 hastings',
-        '1121 hastings': '1127 hastings',
-        '1125 hastings': '1127 hastings',
-        '1129 hastings': '1127 hastings',
-        '1133 hastings': '1131 hastings',
-        '1278 hastings': '1268 hastings',
-        '1283 hastings': '1279 hastings',
-        '1291 hastings': '1279 hastings',
-        '1299 hastings': '1279 hastings',
-        '1190 hastings': '403 vernon',
-        '1192 hastings': '403 vernon',
-
-        '250 hawks': '837 cordova',
-
-        '405 heatley': '401 heatley',
-        '407 heatley': '401 heatley',
-        '409 heatley': '401 heatley',
-        '417 heatley': '401 heatley',
-        '419 heatley': '401 heatley',
-
-        '28 jackson': '20 jackson',
-        '370 jackson': '501 hastings',
-
-        '1218 pender': '1222 pender',
-        '1220 pender': '1222 pender',
-        '1202 pender': '1222 pender',
-        '1206 pender': '1222 pender',
-        '1212 pender': '1222 pender',
-        '1310 pender': '1305 frances',
-        '1320 pender': '1305 frances',
-
-        '318 powell': '316 powell',
-        '346 powell': '342 powell',
-        '348 powell': '342 powell',
-        '350 powell': '342 powell',
-        '394 powell': '347 powell',
-        '356 powell': '358 powell',
-        '362 powell': '358 powell',
-        '368 powell': '370 powell',
-        '376 powell': '374 powell',
-        '415 powell': '411 powell',
-        '429 powell': '427 powell',
-        '435 powell': '427 powell',
-        '439 powell': '437 powell',
-        '469 powell': '467 powell',
-        '475 powell': '473 powell',
-        #'453 powell': '451 powell',
-        '543 powell': '537 powell',
-        '578 powell': '215 princess',
-        '580 powell': '215 princess',
-        '582 powell': '215 princess',
-        '683 powell': '687 powell',
-        '686 powell': '209 heatley',
-        '758 powell': '756 powell',
-        '784 powell': '1302 powell',
-        '811 powell': '807 powell',
-        '827 powell': '825 powell',
-        '836 powell': '838 powell',
-        '1132 powell': '1130 powell',
-        '1142 powell': '1130 powell',
-        '1160 powell': '1159 franklin',
-
-        '120 princess': '1302 powell',
-        '420 princess': '600 hastings',
-
-        '329 railway': '325 railway',
-        '380 railway': '45 dunlevy',
-        '397 railway': '395 railway',
-        '435 railway': '439 railway',
-        '495 railway': '485 railway',
-        '505 railway': '503 railway',
-
-        '258 raymur': '252 raymur',
-        '260 raymur': '252 raymur',
-        '266 raymur': '252 raymur',
-
-        '1103 union': '1101 union',
-        '1113 union': '1111 union',
-        '1121 union': '1111 union',
-
-        '1100 venables': '1101 venables',
-        '1275 venables': '1255 venables',
-        '1233 venables': '1255 venables',
-        '1299 venables': '1255 venables',
-
-        '510 vernon': '1222 pender',
-        '520 vernon': '1222 pender',
-        '530 vernon': '1222 pender',
-        '704 vernon': '700 vernon'
-        }
+# Record class to the class of its records read back from a snapshot
+SNAPSHOT_RECORD_CLASSES = {}
 
-REGISTRY = {}
+# Service areas loaded by this process. 
+# Filename to tuple of (file modification time, ServiceArea).
+SERVICE_AREAS = {}
 
 
 class ErrorManager(object):
@@ -248,10 +94,27 @@ class ErrorManager(object):
 
     def __init__(self):
         self.errors = []
+        self.skipped = {}
 
     def add(self, obj, msg):
         """Record that 'obj' was rejected for reason 'msg'"""
         self.errors.append((obj, msg))
+        REGISTRY['run_report'].count(msg)
+
+    def skip(self, msg, count=1):
+        """Count rows dropped for reason 'msg' without reporting them"""
+        self.skipped[msg] = self.skipped.get(msg, 0) + count
+        REGISTRY['run_report'].count(msg, count)
+
+    def extend(self, errors, skipped):
+        """Adds rows rejected and dropped in another process, which
+        counted them in its own run report
+        @param errors Array of tuples of (obj, msg)
+        @param skipped Dict of msg to rows dropped
+        """
+        self.errors.extend(errors)
+        for msg, count in skipped.items():
+            self.skipped[msg] = self.skipped.get(msg, 0) + count
 
     def report(self, filename):
         """Write a report of all errors to filename"""
@@ -272,11 +135,199 @@ class InvalidInput(Exception):
     pass
 
 
+class Address(object):
+    """A street address, parsed once by AddressManager.parse.
+    If the address could not be parsed, unit, street_num and street
+    are '' and block is None."""
+
+    __slots__ = ('unit', 'street_num', 'street', 'block', 'key')
+
+    def __init__(self, unit, street_num, street, block, key):
+        self.unit = unit
+        self.street_num = street_num
+        self.street = street
+        self.block = block
+
+        # Strongly cleaned address, to join licenses to owners.
+        # None if it can't be cleaned.
+        self.key = key
+
+    def __repr__(self):
+        return 'Address(%r, %r, %r, %r, %r)' % (self.unit, self.street_num,
+                self.street, self.block, self.key)
+
+
+class ServiceArea(object):
+    """The streets and blocks of a neighbourhood, e.g. Strathcona, and
+    the lookup tables that go with it. Blocks are held as a set of 
+    (street, block) so checking an address is a single lookup.
+
+    Usually loaded from a file by load_service_area.
+    """
+
+    def __init__(self, name, valid_addresses, address_owners=None,
+                 countries=None, invalid_license_types=None,
+                 invalid_business_names=None, neighbour_distance=None,
+                 street_edit_distance=0):
+        """
+        @param name Name of the area, for messages
+        @param valid_addresses Dict of street to list of blocks. 
+        For example {'railway': [3, 4, 5]} means Railway St includes 
+        the 300, 400 and 500 blocks.
+        @param address_owners Dict of business address to property owners
+        address, for licenses which don't match an owner exactly
+        @param countries Countries seen at the end of mailing addresses
+        @param invalid_license_types Business license types to ignore
+        @param invalid_business_names Business names to ignore
+        @param neighbour_distance How far apart street numbers can be for
+        a license matching neither of the above to go to the nearest owner
+        on the same side of the block, see NeighbourIndex. None or 0 to
+        not match neighbours, leaving such licenses for review.
+        @param street_edit_distance How many letters street names can 
+        differ by when matching neighbours
+        """
+        self.name = name
+        self.valid_addresses = valid_addresses
+        self.blocks = frozenset((street, block)
+                                for street, blocks in valid_addresses.items()
+                                for block in blocks)
+        self.address_owners = address_owners or {}
+        self.countries = frozenset(countries or [])
+        self.invalid_license_types = frozenset(invalid_license_types or [])
+        self.invalid_business_names = frozenset(invalid_business_names or [])
+        self.neighbour_distance = neighbour_distance
+        self.street_edit_distance = street_edit_distance
+
+    @staticmethod
+    def from_file(filename):
+        """Reads a service area file, see strathcona.json for an example.
+        @raises InvalidInput
+        """
+
+        area_file = open(filename, 'rt')
+        try:
+            try:
+                definition = json.load(area_file)
+            except ValueError, exc:
+                raise InvalidInput('Service area file %s is not valid ' \
+                        'JSON: %s' % (filename, exc))
+        finally:
+            area_file.close()
+
+        version = definition.get('version')
+        if version != AREA_FILE_VERSION:
+            raise InvalidInput('Service area file %s is version %s, ' \
+                    'expected %d' % (filename, version, AREA_FILE_VERSION))
+
+        # JSON gives us unicode, the CSV files are byte strings
+        text = lambda value: value.encode('utf-8')
+
+        try:
+            valid_addresses = dict((text(street), blocks) for street, blocks
+                                   in definition['valid_addresses'].items())
+            address_owners = dict((text(business), text(owner))
+                                  for business, owner
+                                  in definition['address_owners'].items())
+            return ServiceArea(
+                text(definition['name']),
+                valid_addresses,
+                address_owners,
+                [text(value) for value in definition['countries']],
+                [text(value) for value in definition['invalid_license_types']],
+                [text(value) 
+                    for value in definition['invalid_business_names']],
+                definition.get('neighbour_distance'),
+                definition.get('street_edit_distance', 0))
+        except KeyError, exc:
+            raise InvalidInput('Service area file %s is missing %s' % 
+                    (filename, exc))
+
+    def __repr__(self):
+        return 'ServiceArea(%r, %d blocks)' % (self.name, len(self.blocks))
+
+    def fingerprint(self):
+        """Digest of everything in this area, so records parsed with
+        it can tell if they'd be parsed differently now"""
+
+        tables = (self.name, sorted(self.blocks),
+                  sorted(self.address_owners.items()), sorted(self.countries),
+                  sorted(self.invalid_license_types), 
+                  sorted(self.invalid_business_names))
+        return hashlib.md5(repr(tables)).hexdigest()
+
+
+def load_service_area(filename=None):
+    """Loads a service area, from a pickled index next to the file if
+    that was built from the file as it is now, otherwise from the file 
+    itself, refreshing the index. Areas already loaded by this process are 
+    shared, as long as the file hasn't changed.
+
+    @param filename Service area file. Defaults to the file named by
+    the SERVICE_AREA_ENV environment variable, or DEFAULT_AREA_FILE.
+    @return ServiceArea
+    @raises InvalidInput
+    """
+
+    if filename is None:
+        filename = os.environ.get(SERVICE_AREA_ENV, DEFAULT_AREA_FILE)
+    filename = os.path.abspath(filename)
+
+    mtime = os.stat(filename).st_mtime
+    try:
+        loaded_mtime, service_area = SERVICE_AREAS[filename]
+        if loaded_mtime == mtime:
+            return service_area
+    except KeyError:
+        pass
+
+    # The index holds the built ServiceArea's attributes rather than the
+    # object, so it loads whether merge is __main__ or imported.
+    index_filename = filename + '.index'
+    service_area = None
+
+    try:
+        index_file = open(index_filename, 'rb')
+        try:
+            index_version, index_mtime, state = pickle.load(index_file)
+        finally:
+            index_file.close()
+        if index_version == AREA_INDEX_VERSION and index_mtime == mtime:
+            service_area = ServiceArea.__new__(ServiceArea)
+            service_area.__dict__.update(state)
+    except Exception:       # pylint: disable-msg=W0703
+        # Missing, unreadable or corrupt, which unpickling can report 
+        # as almost any exception. The file is the truth, rebuild it.
+        service_area = None
+
+    if service_area is None:
+        service_area = ServiceArea.from_file(filename)
+        try:
+            index_file = open(index_filename, 'wb')
+            try:
+                pickle.dump((AREA_INDEX_VERSION, mtime, service_area.__dict__),
+                            index_file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                index_file.close()
+        except IOError, exc:
+            syslog.syslog('merge.py: Could not write service area ' \
+                    'index %s: %s' % (index_filename, exc))
+
+    SERVICE_AREAS[filename] = (mtime, service_area)
+    return service_area
+
+
 class AddressManager(object):
     """Checks addresses"""
 
-    def __init__(self):
-        self.valid_addresses = VALID_ADDR
+    def __init__(self, service_area=None):
+        """
+        @param service_area ServiceArea that is_in_location checks, 
+        load_service_area() if not given
+        """
+        if service_area is None:
+            service_area = load_service_area()
+        self.service_area = service_area
+        self._parse_cache = {}
 
     def get_block(self, street_num):
         """Takes a street address such as 1209 or 305 and returns
@@ -288,8 +339,37 @@ class AddressManager(object):
         - lowercase
         - 'E' or 'W' removed
         - ', vancouver' removed
+        If is_strong, also street type (st, ave, dr) and unit number removed.
+        """
+
+        if is_strong:
+            cleaned = self.clean_strong_by_pattern(address)
+            if cleaned is not None:
+                return cleaned
+        return self.clean_by_replace(address, is_strong)
+
+    def clean_strong_by_pattern(self, address):
+        """Strong clean of simple addresses with a single regular 
+        expression match. Only worth it for strong clean, plain clean
+        is quicker by replace.
+        @return Same as clean_by_replace(address, is_strong=True), 
+        or None if the address is not simple enough to be sure of that.
         """
 
+        match = SIMPLE_ADDRESS.match(address.strip().lower())
+        if not match:
+            return None
+
+        street_num, street = match.groups()
+        if street in AMBIGUOUS_STREETS or \
+                street.startswith(AMBIGUOUS_STREET_PREFIXES):
+            return None
+
+        return street_num + ' ' + street
+
+    def clean_by_replace(self, address, is_strong=False):
+        """clean, one replace at a time. Handles any address."""
+
         address = address.strip().lower()
         address = address\
                     .replace(', vancouver', '')\
@@ -354,23 +434,41 @@ class AddressManager(object):
 
         return (unit, street_num, street)
 
-    def is_in_location(self, address):
-        """Is the given address in one of the blocks and 
-        streets defined in VALID_ADDR"""
+    def parse(self, address):
+        """Parses a street address once, for everything that needs 
+        its parts. Repeated addresses return the same Address, 
+        up to PARSE_CACHE_SIZE of them.
+        @return Address
+        """
+
+        parsed = self._parse_cache.get(address)
+        if parsed is not None:
+            return parsed
 
         try:
-            _, street_num, street = self.extract_unit_num_street(address)
+            unit, street_num, street = self.extract_unit_num_street(address)
+            block = self.get_block(street_num)
         except InvalidAddress:
-            return False
-
-        block = self.get_block(street_num)
+            unit = street_num = street = ''
+            block = None
 
         try:
-            valid_blocks = self.valid_addresses[street]
-        except KeyError:
-            return False
+            key = self.clean(address, is_strong=True)
+        except IndexError:
+            # Strong clean needs at least two words
+            key = None
+
+        parsed = Address(unit, street_num, street, block, key)
+        if len(self._parse_cache) >= PARSE_CACHE_SIZE:
+            self._parse_cache.clear()
+        self._parse_cache[address] = parsed
+
+        return parsed
 
-        return block in valid_blocks
+    def is_in_location(self, address):
+        """Is the given Address in one of the blocks and 
+        streets of our service area"""
+        return (address.street, address.block) in self.service_area.blocks
 
     def previous_neighbour(self, address):
         """Return the address two before this one.
@@ -384,43 +482,139 @@ class AddressManager(object):
         return str(street_num) + ' ' + ' '.join(address.split()[1:])
 
 
+def read_csv(filename, num_columns, description):
+    """Opens a CSV file and checks its header row.
+    @param num_columns Number of columns the file must have
+    @param description Name of the file for error messages,
+    e.g. 'Property Owners'
+    @return Iterator of rows after the header. The file is closed
+    once the iterator is exhausted.
+    @raises InvalidInput
+    """
+
+    csv_file = open(filename, 'rU')
+    reader = csv.reader(csv_file)
+    try:
+        headers = reader.next()   # Text column headers
+    except StopIteration:
+        syslog.syslog('merge.py: Empty file %s' % filename)
+        csv_file.close()
+        return iter([])
+
+    if len(headers) != num_columns:
+        csv_file.close()
+        raise InvalidInput('%s file should have ' % description +
+            'exactly %d columns. Found %d.' % (num_columns, len(headers)))
+
+    def rows():
+        """Yields rows, closing the file at the end"""
+        try:
+            for line in reader:
+                yield line
+        finally:
+            csv_file.close()
+
+    return rows()
+
+
+def read_records(cls, filename, num_columns, description, address_manager):
+    """Reads a CSV file into records, without checking them.
+    @param cls PropertyOwner or BusinessLicense
+    @param address_manager AddressManager the records parse their 
+    addresses with
+    @return Iterator of cls
+    @raises InvalidInput
+    """
+    return (cls(line, address_manager) 
+            for line in read_csv(filename, num_columns, description))
+
+
+# Columns of the property owners and business licenses files
+PO_COLS = ["Folio", "Civic", "Name 1",
+            "Name 2", "Mailing", "Total Assess",
+            "Included Assess", "Ann Chg", "Unit",
+            "House", "Street"]
+
+BL_COLS = ["RECORD", "LICENSE NUMBER", "ADDRESS",
+            "LICENSE TYPE", "STATUS", "LICENSE YEAR",
+            "BUSINESS NAME", "BUSINESS TRADE NAME", "DATA FROM",
+            "MAIL ADDRESS1", "MAIL ADDRESS2", "MAIL ADDRESS3",
+            "MAIL ADDRESS4", "WORK PHONE1", "WORK PHONE2"]
+
+
 class PropertyOwner(object):
     """Owner of a property, identified by address"""
 
+    # Data attributes, in the order differences.py compares them
+    FIELDS = ('folio', 'civic', 'name1', 'name2', 'mailing', 
+              'total_assess', 'included_assess', 'annual_charge', 
+              'unit', 'house', 'street', 'street_num', 
+              'mailing_street_1', 'mailing_street_2', 'mailing_street_3',
+              'mailing_country')
+
+    # Attributes differences.py doesn't compare
+    IGNORE_FIELDS = ('original_record', 'total_assess', 'included_assess', 
+                     'annual_charge', 'house', 'street_num', 
+                     'mailing_street_1', 'mailing_street_2', 
+                     'mailing_street_3')
+
+    # No per-instance __dict__, we hold a lot of these.
+    # unit, street_num and street come from parsed_address.
+    __slots__ = ('folio', 'civic', 'name1', 'name2', 'mailing', 
+                 'total_assess', 'included_assess', 'annual_charge', 
+                 'house', 'mailing_street_1', 'mailing_street_2', 
+                 'mailing_street_3', 'mailing_country', 
+                 'parsed_address', 'licenses', 'original_record')
+
     @staticmethod
-    def load(filename):
+    def load(filename, address_manager=None):
         """Reads property owners from a CSV file and returns
-        an array of PropertyOwner"""
+        an array of PropertyOwner, sorted by folio
+        @param address_manager See iterate
+        """
+
+        owners = list(PropertyOwner.iterate(filename, address_manager))
+        owners.sort(key=operator.attrgetter('folio'))
+
+        return owners
 
-        owners = []
+    @staticmethod
+    def iterate(filename, address_manager=None):
+        """Reads property owners from a CSV file one at a time.
+        Rows outside the service area go straight to the error manager.
+        The header is checked immediately, rows are read as the
+        result is iterated.
+
+        @param address_manager AddressManager of the service area, 
+        REGISTRY['address_manager'] if not given
+        @return Iterator of PropertyOwner, in file order
+        @raises InvalidInput
+        """
 
-        address_manager = REGISTRY['address_manager']
+        if address_manager is None:
+            address_manager = REGISTRY['address_manager']
         error_manager = REGISTRY['error_manager']
 
-        reader = csv.reader(open(filename, 'rU'))
-        try:
-            headers = reader.next()   # Text column headers
-        except StopIteration:
-            syslog.syslog('merge.py: Empty file %s' % filename)
-            return owners
-
-        if len(headers) != 11:
-            raise InvalidInput('Property Owners file should have ' +
-                'exactly 11 columns. Found %d.' % len(headers))
-
-        for line in reader:
-            property_owner = PropertyOwner(line)
-            if address_manager.is_in_strathcona(property_owner.civic):
-                owners.append(property_owner)
-            else:
-                error_manager.add(property_owner, 
-                                  'Not in Strathcona or invalid address')
+        outside_msg = ('Not in %s or invalid address' % 
+                       address_manager.service_area.name)
 
-        owners.sort(key=operator.attrgetter('folio'))
+        def valid(owners):
+            """Yields the owners we want to keep"""
+            for property_owner in owners:
+                if address_manager.is_in_location(
+                                    property_owner.parsed_address):
+                    yield property_owner
+                else:
+                    error_manager.add(property_owner, outside_msg)
 
-        return owners
+        return valid(read_records(PropertyOwner, filename, len(PO_COLS), 
+                                  'Property Owners', address_manager))
 
-    def __init__(self, arr):
+    def __init__(self, arr, address_manager):
+        """
+        @param arr Row of the property owners file
+        @param address_manager AddressManager to parse the address with
+        """
 
         self.original_record = arr
 
@@ -432,20 +626,12 @@ class PropertyOwner(object):
         self.total_assess = arr[5].strip()
         self.included_assess = arr[6].strip()
         self.annual_charge = arr[7].strip()
-        self.unit = arr[8].strip()
         self.house = arr[9].strip()
-        self.street = arr[10].strip()
 
         # Business licences at this address
         self.licenses = []
 
-        address_manager = REGISTRY['address_manager']
-
-        try:
-            self.unit, self.street_num, self.street = \
-                    address_manager.extract_unit_num_street(self.civic)
-        except InvalidAddress:
-            self.unit = self.street_num = self.street = ''
+        self.parsed_address = address_manager.parse(self.civic)
 
         # Split mailing address
 
@@ -462,7 +648,8 @@ class PropertyOwner(object):
 
         self.mailing_country = 'CANADA'
 
-        if mailing_parts[-1].lower() in COUNTRIES:
+        countries = address_manager.service_area.countries
+        if mailing_parts[-1].lower() in countries:
             self.mailing_country = mailing_parts[-1]
             del mailing_parts[-1]
 
@@ -478,6 +665,21 @@ class PropertyOwner(object):
     def __unicode__(self):
         return "%s - %s" % (self.folio, self.civic)
 
+    @property
+    def unit(self):
+        """Unit number, None if there isn't one"""
+        return self.parsed_address.unit
+
+    @property
+    def street_num(self):
+        """Street number"""
+        return self.parsed_address.street_num
+
+    @property
+    def street(self):
+        """Street name, without street type"""
+        return self.parsed_address.street
+
     @property
     def key(self):
         """Unique key for this item"""
@@ -499,7 +701,22 @@ class PropertyOwner(object):
         """ Writes this object out to a CSV file
         @param writer a csv.Writer object
         """
-        record = [
+        writer.writerow(self.output_row())
+
+        for b_l in self.licenses:
+            b_l.output_to(writer)
+
+    def output_rows(self):
+        """Rows of the mailing list file for this owner and its licenses
+        @return Array of rows
+        """
+        return [self.output_row()] + [b_l.output_row() 
+                                      for b_l in self.licenses]
+
+    def output_row(self):
+        """Row of the mailing list file for this owner"""
+
+        return [
             self.civic_no_city(),   # Property address
             'PROPERTY OWNER',   # License type
             self.street_num,    # House
@@ -516,18 +733,32 @@ class PropertyOwner(object):
             ''                  # Unit
         ]
 
-        writer.writerow(record)
-
-        for b_l in self.licenses:
-            b_l.output_to(writer)
-
     def output_salesforce_to(self, writer, remove_date=''):
         """Writes this object to a CSV writer object,
         in a format we can import into Salesforce.
         @param writer a csv.Writer object
         """
+        writer.writerow(self.salesforce_row(remove_date))
+
+        if not remove_date:     # We don't include children of removed items
+            for b_l in self.licenses:
+                b_l.output_salesforce_to(writer)
+
+    def salesforce_rows(self, remove_date=''):
+        """Rows of the Salesforce file for this owner and, unless it was
+        removed, its licenses
+        @return Array of rows
+        """
+
+        record = self.salesforce_row(remove_date)
+        if remove_date:     # We don't include children of removed items
+            return [record]
+        return [record] + [b_l.salesforce_row() for b_l in self.licenses]
 
-        record = [
+    def salesforce_row(self, remove_date=''):
+        """Row of the Salesforce file for this owner"""
+
+        return [
             'System Admin',         # Record Owner
             self.account_name(),    # Account Name
             '',                     # Parent Account
@@ -554,71 +785,204 @@ class PropertyOwner(object):
             remove_date             # Removed
         ]
 
-        writer.writerow(record)
-
-        if not remove_date:     # We don't include children of removed items
-            for b_l in self.licenses:
-                b_l.output_salesforce_to(writer)
-
 
 class BusinessLicense(object):
     """Operator of a business, identified by business license number,
     and by address."""
 
-    @classmethod
-    def load(cls, filename):
-        """Reads CSV file of business licenses, returns an 
-        array of BusinessLicense. """
-
-        licenses = []
+    # Data attributes, in the order differences.py compares them
+    FIELDS = ('record', 'license_number', 'address', 'license_type', 
+              'status', 'license_year', 'business_name', 
+              'business_trade_name', 'data_from', 'mail_address_1', 
+              'mail_address_2', 'mail_address_3', 'mail_address_4', 
+              'work_phone_1', 'work_phone_2', 'unit', 'street_num', 'street')
+
+    # Attributes differences.py doesn't compare
+    IGNORE_FIELDS = ('original_record', 'status', 'record', 'license_year', 
+                     'license_number')
+
+    # No per-instance __dict__, we hold a lot of these.
+    # unit, street_num and street come from parsed_address.
+    __slots__ = ('record', 'license_number', 'address', 'license_type', 
+                 'status', 'license_year', 'business_name', 
+                 'business_trade_name', 'data_from', 'mail_address_1', 
+                 'mail_address_2', 'mail_address_3', 'mail_address_4', 
+                 'work_phone_1', 'work_phone_2', 
+                 'parsed_address', 'owner', 'original_record')
+
+    # Attributes pack keeps, followed by those of parsed_address
+    PACKED_FIELDS = ('record', 'license_number', 'address', 'license_type', 
+                     'status', 'license_year', 'business_name', 
+                     'business_trade_name', 'data_from', 'mail_address_1', 
+                     'mail_address_2', 'mail_address_3', 'mail_address_4', 
+                     'work_phone_1', 'work_phone_2', 'original_record')
 
-        address_manager = REGISTRY['address_manager']
-        error_manager = REGISTRY['error_manager']
+    @staticmethod
+    def pack(licenses):
+        """Packs licenses into a string for another process, which 
+        unpack turns back into licenses in less time than parsing or 
+        unpickling them takes. Their owners aren't kept.
+        @param licenses Iterable of BusinessLicense
+        @return String
+        """
 
-        license_numbers = []
+        fields = operator.attrgetter(     # pylint: disable-msg=W0142
+                *BusinessLicense.PACKED_FIELDS)
+        address = operator.attrgetter(    # pylint: disable-msg=W0142
+                *Address.__slots__)
 
-        reader = csv.reader(open(filename, 'rU'))
+        # Nothing made here can be garbage, as in load_snapshot
+        is_gc_enabled = gc.isenabled()
+        gc.disable()
         try:
-            headers = reader.next()   # Text column headers
-        except StopIteration:
-            syslog.syslog('merge.py: Empty file %s' % filename)
-            return licenses
- 
-        if len(headers) != 15:
-            raise InvalidInput('Business License file should have ' +
-                'exactly 15 columns. Found %d.' % len(headers))
-
-        for line in reader:
-            business_license = BusinessLicense(line)
-
-            if business_license.license_number in license_numbers:
-                # Silently skip duplicates
-                #error_manager.add(business_license,
-                #                'Duplicate license number')
-                continue
+            return marshal.dumps([fields(business_license) + 
+                                  address(business_license.parsed_address)
+                                  for business_license in licenses], 
+                                 marshal.version)
+        finally:
+            if is_gc_enabled:
+                gc.enable()
 
-            license_numbers.append(business_license.license_number)
+    @staticmethod
+    def unpack(packed):
+        """Licenses packed by pack, without owners. 
+        benchmark.py pack checks they are the licenses packed.
+        @return Array of BusinessLicense
+        """
 
-            if not business_license.is_valid_license_type():
-                error_manager.add(business_license,
-                                  'Invalid license type')
-                continue
-            if not business_license.is_valid_business_name():
-                error_manager.add(business_license,
-                                    'Business name is on ignore list')
-                continue
+        num_fields = len(BusinessLicense.PACKED_FIELDS)
+        licenses = []
+        append = licenses.append
 
-            if address_manager.is_in_strathcona(business_license.address):
-                licenses.append(business_license)
-            else:
-                error_manager.add(business_license,
-                                  'Not in Strathcona or invalid address')
+        # Nothing made here can be garbage, as in load_snapshot
+        is_gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for values in marshal.loads(packed):
+                lic = object.__new__(BusinessLicense)
+                # Assigning them all at once is twice as fast as a 
+                # setattr per field
+                (lic.record, lic.license_number, lic.address, 
+                 lic.license_type, lic.status, lic.license_year, 
+                 lic.business_name, lic.business_trade_name, lic.data_from,
+                 lic.mail_address_1, lic.mail_address_2, lic.mail_address_3,
+                 lic.mail_address_4, lic.work_phone_1, lic.work_phone_2, 
+                 lic.original_record) = values[:num_fields]
+                lic.parsed_address = Address(*values[num_fields:])
+                lic.owner = None
+                append(lic)
+        finally:
+            if is_gc_enabled:
+                gc.enable()
+        return licenses
+
+    @classmethod
+    def load(cls, filename, duplicate_policy=DUPLICATE_FIRST, 
+             address_manager=None):
+        """Reads CSV file of business licenses, returns an 
+        array of BusinessLicense, sorted by license number.
+        @param duplicate_policy One of DUPLICATE_POLICIES, decides which
+        row to keep when a license number is repeated.
+        @param address_manager See iterate
+        """
 
+        licenses = list(cls.iterate(filename, duplicate_policy, 
+                                    address_manager))
         licenses.sort(key=operator.attrgetter('license_number'))
 
         return licenses
 
-    def __init__(self, arr):
+    @classmethod
+    def iterate(cls, filename, duplicate_policy=DUPLICATE_FIRST, 
+                address_manager=None):
+        """Reads business licenses from a CSV file one at a time.
+        Rejected rows go straight to the error manager. 
+        The header is checked immediately, rows are read as the
+        result is iterated.
+
+        With DUPLICATE_FIRST only the license numbers seen so far are
+        kept in memory. The other policies can't know which row wins
+        until the end of the file, so they hold every license.
+
+        @param duplicate_policy One of DUPLICATE_POLICIES
+        @param address_manager AddressManager of the service area, 
+        REGISTRY['address_manager'] if not given
+        @return Iterator of BusinessLicense, in file order
+        @raises InvalidInput
+        """
+
+        if address_manager is None:
+            address_manager = REGISTRY['address_manager']
+        service_area = address_manager.service_area
+        error_manager = REGISTRY['error_manager']
+
+        def first_only(all_licenses):
+            """Yields first license for each license number"""
+            seen = set()
+            duplicates = 0
+            for business_license in all_licenses:
+                if business_license.license_number in seen:
+                    duplicates += 1
+                    continue
+                seen.add(business_license.license_number)
+                yield business_license
+            count_duplicates(duplicates)
+
+        def by_policy(all_licenses):
+            """Yields the license chosen by duplicate_policy
+            for each license number"""
+            unique, duplicates = remove_duplicates(all_licenses, 
+                                                   duplicate_policy)
+            count_duplicates(duplicates)
+            for business_license in unique:
+                yield business_license
+
+        outside_msg = 'Not in %s or invalid address' % service_area.name
+
+        def count_duplicates(duplicates):
+            """Duplicates are skipped silently, only counted"""
+            if duplicates:
+                error_manager.skip('Duplicate license number', duplicates)
+                syslog.syslog('merge.py: Skipped %d duplicate license ' \
+                        'numbers in %s' % (duplicates, filename))
+
+        def valid(unique):
+            """Yields the licenses we want to keep"""
+            for business_license in unique:
+
+                if not business_license.is_valid_license_type(service_area):
+                    error_manager.add(business_license,
+                                      'Invalid license type')
+                    continue
+                if not business_license.is_valid_business_name(
+                                                            service_area):
+                    error_manager.add(business_license,
+                                        'Business name is on ignore list')
+                    continue
+
+                if address_manager.is_in_location(
+                                    business_license.parsed_address):
+                    yield business_license
+                else:
+                    error_manager.add(business_license, outside_msg)
+
+        if duplicate_policy not in DUPLICATE_POLICIES:
+            raise ValueError('Unknown duplicate policy %s. ' \
+                    'Expected one of %s' % 
+                    (duplicate_policy, ', '.join(DUPLICATE_POLICIES)))
+
+        all_licenses = read_records(BusinessLicense, filename, len(BL_COLS), 
+                                    'Business License', address_manager)
+        if duplicate_policy == DUPLICATE_FIRST:
+            return valid(first_only(all_licenses))
+        else:
+            return valid(by_policy(all_licenses))
+
+    def __init__(self, arr, address_manager):
+        """
+        @param arr Row of the business licenses file
+        @param address_manager AddressManager to parse the address with
+        """
 
         self.original_record = arr
 
@@ -640,13 +1004,7 @@ class BusinessLicense(object):
 
         self.owner = None
 
-        address_manager = REGISTRY['address_manager']
-
-        try:
-            self.unit, self.street_num, self.street = \
-                    address_manager.extract_unit_num_street(self.address)
-        except InvalidAddress:
-            self.unit = self.street_num = self.street = ''
+        self.parsed_address = address_manager.parse(self.address)
 
     def __repr__(self):
         return unicode(self)
@@ -657,19 +1015,46 @@ class BusinessLicense(object):
     def __unicode__(self):
         return "%s - %s" % (self.license_number, self.address)
 
+    @property
+    def unit(self):
+        """Unit number, None if there isn't one"""
+        return self.parsed_address.unit
+
+    @property
+    def street_num(self):
+        """Street number"""
+        return self.parsed_address.street_num
+
+    @property
+    def street(self):
+        """Street name, without street type"""
+        return self.parsed_address.street
+
     @property
     def key(self):
         """Unique key for this item"""
         return self.account_name()
 
-    def is_valid_license_type(self):
-        """Is this license type one we want to include"""
+    def year(self):
+        """License year as a number, -1 if missing or not a number"""
+        try:
+            return int(self.license_year)
+        except ValueError:
+            return -1
+
+    def is_valid_license_type(self, service_area):
+        """Is this license type one we want to include
+        @param service_area ServiceArea listing the invalid types
+        """
         clean = self.license_type.lower().replace('-', ' ')
-        return clean not in INVALID_LICENSE_TYPE
+        return clean not in service_area.invalid_license_types
 
-    def is_valid_business_name(self):
-        """Should we skip this business?"""
-        return self.business_name.lower() not in INVALID_BUSINESS_NAME
+    def is_valid_business_name(self, service_area):
+        """Should we skip this business?
+        @param service_area ServiceArea listing the names to skip
+        """
+        return (self.business_name.lower() not in 
+                service_area.invalid_business_names)
 
     def other_mail_address(self):
         """Mailing address fields 2, 3 and 4 concatenated"""
@@ -696,8 +1081,12 @@ class BusinessLicense(object):
         """ Writes this object out to a CSV file
         @param writer a csv.Writer object
         """
+        writer.writerow(self.output_row())
+
+    def output_row(self):
+        """Row of the mailing list file for this license"""
 
-        record = [
+        return [
             self.address,               # Property address
             self.license_type,          # License type
             self.street_num,            # House
@@ -714,20 +1103,22 @@ class BusinessLicense(object):
             self.unit                   # Unit
         ]
 
-        writer.writerow(record)
-
     def output_salesforce_to(self, writer, remove_date=''):
         """Writes this object to a CSV writer object,
         in a format we can import into Salesforce.
         @param writer a csv.Writer object
         """
+        writer.writerow(self.salesforce_row(remove_date))
+
+    def salesforce_row(self, remove_date=''):
+        """Row of the Salesforce file for this license"""
 
         if self.owner:
             parent_account = self.owner.civic_no_city()
         else:
             parent_account = ''
 
-        record = [
+        return [
             'System Admin',              # Record Owner
             self.account_name(),         # Account Name
             parent_account,              # Parent Account
@@ -755,15 +1146,197 @@ class BusinessLicense(object):
             remove_date             # Removed
         ]
 
-        writer.writerow(record)
 
+def remove_duplicates(licenses, policy=DUPLICATE_FIRST):
+    """Drops business licenses whose license number was already seen.
+    Uses a dict keyed on license number, so each license costs O(1).
+
+    @param licenses Iterable of BusinessLicense, in file order
+    @param policy One of DUPLICATE_POLICIES
+    @return Tuple of (array of BusinessLicense, number of duplicates dropped).
+    The array is in order of first appearance of each license number.
+    """
+
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError('Unknown duplicate policy %s. Expected one of %s' %
+                (policy, ', '.join(DUPLICATE_POLICIES)))
+
+    chosen = {}
+    order = []
+    duplicates = 0
+
+    for business_license in licenses:
+        number = business_license.license_number
+
+        try:
+            current = chosen[number]
+        except KeyError:
+            chosen[number] = business_license
+            order.append(number)
+            continue
+
+        duplicates += 1
+
+        if policy == DUPLICATE_LAST:
+            chosen[number] = business_license
+        elif policy == DUPLICATE_NEWEST and \
+                business_license.year() > current.year():
+            chosen[number] = business_license
+
+    return ([chosen[number] for number in order], duplicates)
+
+
+def edit_distance(first, second):
+    """Number of letters to insert, delete or change to turn
+    string first into string second"""
+
+    previous = range(len(second) + 1)
+    for i, first_char in enumerate(first):
+        current = [i + 1]
+        for j, second_char in enumerate(second):
+            current.append(min(previous[j + 1] + 1, 
+                               current[j] + 1,
+                               previous[j] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+class NeighbourIndex(object):
+    """Property owners by street, block and side of the street, to find
+    the owner of the nearest address to a business license when it 
+    doesn't match any owner's address exactly. Finding a neighbour is 
+    a binary search of one side of one block, not a scan of all owners.
+    """
+
+    def __init__(self, owners, distance, street_distance=0):
+        """
+        @param owners Iterable of PropertyOwner
+        @param distance Furthest a neighbour's street number can be 
+        from the license's, e.g. 2 means 318 can match 316 or 320
+        @param street_distance How many letters street names can differ by
+        """
+        self.distance = distance
+        self.street_distance = street_distance
+
+        # (street, block, side) to sorted list of tuple (number, folio, owner).
+        # Side is street number % 2, odd numbers are across the road from 
+        # even ones.
+        self._sides = {}
+        for owner in owners:
+            address = owner.parsed_address
+            if address.block is None:
+                continue
+            side = (address.street, address.block, address.street_num % 2)
+            self._sides.setdefault(side, []).append(
+                    (address.street_num, owner.folio, owner))
+
+        self._numbers = {}
+        for side, entries in self._sides.items():
+            entries.sort(key=operator.itemgetter(0, 1))
+            self._numbers[side] = [entry[0] for entry in entries]
+
+        self._streets = frozenset(street for street, _, _ in self._sides)
+
+        # Street name to the streets we have within street_distance of it,
+        # nearest first
+        self._similar_streets = {}
+
+    def similar_streets(self, street):
+        """Streets with owners, within street_distance letters of street,
+        nearest first. Worked out once per street."""
+
+        try:
+            return self._similar_streets[street]
+        except KeyError:
+            pass
+
+        if street in self._streets or not self.street_distance:
+            similar = [street]
+        else:
+            candidates = [(edit_distance(street, other), other) 
+                          for other in self._streets
+                          if abs(len(other) - len(street)) <= 
+                                self.street_distance]
+            similar = [other for letters, other in sorted(candidates)
+                       if letters <= self.street_distance]
+
+        self._similar_streets[street] = similar
+        return similar
+
+    def find(self, address):
+        """The owner at the nearest street number to address, on the same 
+        side of the same block. The lower number wins a tie, and for 
+        owners at the same number, the lowest folio.
+        @param address Address of a business license
+        @return PropertyOwner, or None if there isn't one within distance
+        """
+
+        if address.block is None:
+            return None
 
-def merge(owners, licenses):
+        street_num = address.street_num
+        for street in self.similar_streets(address.street):
+            side = (street, address.block, street_num % 2)
+            numbers = self._numbers.get(side)
+            if not numbers:
+                continue
+
+            entries = self._sides[side]
+            start = bisect.bisect_left(numbers, street_num)
+            best = None
+            for i in [start - 1, start]:
+                if 0 <= i < len(numbers):
+                    gap = abs(numbers[i] - street_num)
+                    if gap <= self.distance and (best is None or 
+                                                 gap < best[0]):
+                        best = (gap, i)
+            if best is not None:
+                # Owners at the same number are sorted by folio
+                i = bisect.bisect_left(numbers, numbers[best[1]])
+                return entries[i][2]
+
+        return None
+
+
+def neighbour_index(owners, service_area):
+    """A NeighbourIndex of owners, for the service area's 
+    neighbour_distance, or None if it doesn't match neighbours
+    @param service_area ServiceArea the owners are in
     """
-    Adds business licenses to property owners.
 
-    @param owners Array of PropertyOwner
-    @param licenses Array of BusinessLicense
+    if not service_area.neighbour_distance:
+        return None
+    return NeighbourIndex(owners, service_area.neighbour_distance,
+                          service_area.street_edit_distance)
+
+
+def count_matches(exact, manual, neighbour):
+    """Counts how licenses found their owners in the run report. 
+    Those that didn't are counted by the error manager."""
+
+    report = REGISTRY['run_report']
+    report.count('Matched by address', exact)
+    report.count('Matched by address override', manual)
+    report.count('Matched to neighbour', neighbour)
+
+
+def merge(owners, licenses, overrides=None, service_area=None):
+    """
+    Adds business licenses to property owners: the owner at the same 
+    address, or the one the address overrides give, or failing that 
+    the nearest neighbour, see NeighbourIndex.
+    Both arguments are read once, so they can be iterators from
+    PropertyOwner.iterate and BusinessLicense.iterate. Only the owners
+    are held in memory, as the index licenses are joined against.
+
+    @param owners Iterable of PropertyOwner
+    @param licenses Iterable of BusinessLicense
+    @param overrides AddressOverrides, load_overrides() if not given.
+    Its hits and misses count the licenses that needed it.
+    @param service_area ServiceArea the records are in, that of
+    REGISTRY['address_manager'] if not given
+    @return Array of PropertyOwner sorted by folio, each with its
+    licenses sorted by license number
     """
 
     def get_normal(addr):
@@ -774,28 +1347,53 @@ def merge(owners, licenses):
             return None
 
     def get_manual(addr):
-        """Looks for match on business address in ADDRESS_OWNERS 
-        hard coded list"""
-        try:
-            property_addr = ADDRESS_OWNERS[addr]
-            return get_normal(property_addr)
-        except KeyError:
+        """Looks for match on business address in the address overrides
+        of business address to property owners address"""
+        property_addr = overrides.get(addr)
+        if property_addr is None:
             return None
+        return get_normal(property_addr)
 
-    address_manager = REGISTRY['address_manager']
-    error_manager = REGISTRY['error_manager']
+    def get_neighbour(address):
+        """Looks for the owner of the nearest address on the same side 
+        of the block. The index is only built if something needs it."""
+        if not neighbours:
+            neighbours.append(neighbour_index(all_owners, service_area))
+        index = neighbours[0]
+        return index and index.find(address)
 
+    error_manager = REGISTRY['error_manager']
+    if service_area is None:
+        service_area = REGISTRY['address_manager'].service_area
+    if overrides is None:
+        # overrides.py builds on this module, so is imported where used
+        from overrides import load_overrides
+        overrides = load_overrides(service_area=service_area)
+
+    all_owners = []
     o_map = {}
+    neighbours = []
+    exact = manual = neighbour = 0
     for owner in owners:
-        addr = address_manager.clean(owner.civic, is_strong=True)
-        o_map[addr] = owner
+        addr = owner.parsed_address.key
+        if addr is not None:
+            o_map[addr] = owner
+        all_owners.append(owner)
 
     for business_license in licenses:
-        addr = address_manager.clean(business_license.address, is_strong=True)
+        addr = business_license.parsed_address.key
 
         owner = get_normal(addr)
-        if not owner:
+        if owner:
+            exact += 1
+        else:
             owner = get_manual(addr)
+            if owner:
+                manual += 1
+            else:
+                owner = get_neighbour(business_license.parsed_address)
+                if owner:
+                    neighbour += 1
 
         if owner:
             owner.licenses.append(business_license)
@@ -803,105 +1401,516 @@ def merge(owners, licenses):
         else:
             error_manager.add(business_license, 'No match in property owners')
 
+    count_matches(exact, manual, neighbour)
+    syslog.syslog('merge.py: Address overrides %s' % overrides)
 
-def output(owners, filename):
-    """Write out final CSV file of owners and licenses"""
+    all_owners.sort(key=operator.attrgetter('folio'))
+    for owner in all_owners:
+        owner.licenses.sort(key=operator.attrgetter('license_number'))
 
-    out = open(filename, 'wb')
-    writer = csv.writer(out)
-    writer.writerow([
-        'Property Address',
-        'License Type',
-        'House',
-        'Street',
-        'License / Folio number',
-        'Civic address',
-        'Business name 1',
-        'Business name 2',
-        'Mail address 1',
-        'Mail address 2',
-        'Total Assess',
-        'Included Assess',
-        'Ann Chg',
-        'Unit'
-    ])
+    return all_owners
 
-    for owner in owners:
-        owner.output_to(writer)
 
+def merge_columns(owners, licenses, overrides=None, service_area=None):
+    """Same as merge, but works on whole columns of address keys at a
+    time rather than one license at a time: the joins are map calls over
+    dict lookups, which run in C. Only attaching licenses to their owners
+    is a Python loop. Both lists are held in memory, and owners must not
+    have any licenses yet.
+
+    merge is the reference for what this does, benchmark.py merge 
+    checks they agree.
+
+    @param owners Iterable of PropertyOwner
+    @param licenses Iterable of BusinessLicense
+    @param overrides AddressOverrides, load_overrides() if not given
+    @param service_area ServiceArea the records are in, that of
+    REGISTRY['address_manager'] if not given
+    @return Array of PropertyOwner sorted by folio, each with its
+    licenses sorted by license number
+    """
+
+    error_manager = REGISTRY['error_manager']
+    if service_area is None:
+        service_area = REGISTRY['address_manager'].service_area
+    if overrides is None:
+        from overrides import load_overrides
+        overrides = load_overrides(service_area=service_area)
+    address_key = operator.attrgetter('parsed_address.key')
+
+    all_owners = list(owners)
+    licenses = list(licenses)
+
+    # Later owners win, like merge
+    o_map = dict(itertools.izip(itertools.imap(address_key, all_owners),
+                                all_owners))
+    o_map.pop(None, None)
+
+    license_keys = map(address_key, licenses)
+    matched = map(o_map.get, license_keys)
+
+    # Only the licenses without an owner at their own address look up
+    # the overrides, so its counts are the same as merge's
+    unmatched = [i for i, owner in enumerate(matched) if not owner]
+    manual = map(o_map.get, overrides.get_all(
+            map(license_keys.__getitem__, unmatched)))
+    for i, owner in itertools.izip(unmatched, manual):
+        matched[i] = owner
+
+    exact = len(licenses) - len(unmatched)
+    manual = len(unmatched)
+    unmatched = [i for i in unmatched if not matched[i]]
+    manual -= len(unmatched)
+
+    neighbour = 0
+    neighbours = unmatched and neighbour_index(all_owners, service_area)
+    if neighbours:
+        for i in unmatched:
+            matched[i] = neighbours.find(licenses[i].parsed_address)
+        neighbour = len(unmatched) - map(matched.__getitem__, 
+                                         unmatched).count(None)
+
+    for business_license, owner in itertools.izip(licenses, matched):
+        if not owner:
+            error_manager.add(business_license, 'No match in property owners')
+
+    count_matches(exact, manual, neighbour)
+    syslog.syslog('merge.py: Address overrides %s' % overrides)
+
+    # Attaching the licenses in license number order leaves each
+    # owner's licenses sorted, rather than sorting every owner's list
+    numbers = map(operator.attrgetter('license_number'), licenses)
+    for i in sorted(xrange(len(licenses)), key=numbers.__getitem__):
+        owner = matched[i]
+        if owner:
+            owner.licenses.append(licenses[i])
+            licenses[i].owner = owner
+
+    all_owners.sort(key=operator.attrgetter('folio'))
+
+    return all_owners
 
-def output_salesforce(owners, filename):
-    """Write out CSV file of owners and licenses,
-    with headers for import into Salesforce."""
 
-    out = open(filename, 'wb')
+MERGE_ENGINES = {
+    'rows': merge,
+    'columns': merge_columns
+}
+
+
+def merge_engine():
+    """The merge function named by the MERGE_ENGINE_ENV environment 
+    variable, merge if not set
+    @raises InvalidInput if it names something else
+    """
+
+    name = os.environ.get(MERGE_ENGINE_ENV, 'rows')
+    try:
+        return MERGE_ENGINES[name]
+    except KeyError:
+        raise InvalidInput('%s is %s, expected one of %s' % 
+                (MERGE_ENGINE_ENV, name, ', '.join(sorted(MERGE_ENGINES))))
+
+
+OUTPUT_HEADER = [
+    'Property Address',
+    'License Type',
+    'House',
+    'Street',
+    'License / Folio number',
+    'Civic address',
+    'Business name 1',
+    'Business name 2',
+    'Mail address 1',
+    'Mail address 2',
+    'Total Assess',
+    'Included Assess',
+    'Ann Chg',
+    'Unit'
+]
+
+SALESFORCE_HEADER = [
+    'Record Owner',
+    'Account Name',
+    'Parent Account',
+    'Phone',
+    'Business License Type',
+    'License Number',
+    'Folio Number',
+    'Total Assessment',
+    'Included Assessment',
+    'Annual Charge',
+    'Business Name',
+    'Business Name 2',
+    'Street Name',
+    'Unit',
+    'Billing Street 1',
+    'Billing City',
+    'Billing State',
+    'Billing Postal Code',
+    'Billing Country',
+    'Shipping Street 1',
+    'Shipping Street 2',
+    'Shipping Street 3',
+    'Shipping Country',
+    'Removed'
+    #'Shipping City',
+    #'Shipping State',
+    #'Shipping Postal Code',
+]
+
+
+def open_output(filename, header):
+    """Opens an output file and writes its header row. Files named 
+    with GZIP_SUFFIX are gzip-compressed.
+    @param header Row written first
+    @return Tuple of (file, csv.writer of it), close the file when done
+    """
+
+    if filename.endswith(GZIP_SUFFIX):
+        out = gzip.open(filename, 'wb', OUTPUT_GZIP_LEVEL)
+    else:
+        out = open(filename, 'wb')
     writer = csv.writer(out)
-    writer.writerow([
-        'Record Owner',
-        'Account Name',
-        'Parent Account',
-        'Phone',
-        'Business License Type',
-        'License Number',
-        'Folio Number',
-        'Total Assessment',
-        'Included Assessment',
-        'Annual Charge',
-        'Business Name',
-        'Business Name 2',
-        'Street Name',
-        'Unit',
-        'Billing Street 1',
-        'Billing City',
-        'Billing State',
-        'Billing Postal Code',
-        'Billing Country',
-        'Shipping Street 1',
-        'Shipping Street 2',
-        'Shipping Street 3',
-        'Shipping Country',
-        'Removed'
-        #'Shipping City',
-        #'Shipping State',
-        #'Shipping Postal Code',
-    ])
+    writer.writerow(header)
+    return (out, writer)
 
-    for owner in owners:
-        owner.output_salesforce_to(writer)
 
-    # Now add removed items
+def count_output(filename, rows):
+    """Counts the rows written to an output file in the run report"""
+    REGISTRY['run_report'].count('%s rows' % os.path.basename(filename), 
+                                 rows)
+
+
+def removed_salesforce_rows(root=None):
+    """Rows of the Salesforce file for the records removed since the last
+    upload, read from the removed caches written by differences.py
+    @param root Directory holding the removed caches, 
+    defaults to this script's
+    @return Iterator of rows
+    @raises InvalidInput or IOError if a removed cache can't be read
+    """
 
     today = datetime.date.today()
     remove_date = '%s/%s/%s 12:00 PM' % (today.day, today.month, today.year)
-    root = os.path.abspath(os.path.dirname(sys.argv[0]))
+    if root is None:
+        root = os.path.abspath(os.path.dirname(sys.argv[0]))
 
     removed_po_filename = '%s/removed_cache_PO.csv' % root
-    removed_po = wrapped(PropertyOwner.load, [removed_po_filename], True)
+    removed_po = PropertyOwner.load(removed_po_filename)
     for obj in removed_po:
-        obj.output_salesforce_to(writer, remove_date=remove_date)
+        for row in obj.salesforce_rows(remove_date=remove_date):
+            yield row
 
     removed_bl_filename = '%s/removed_cache_BL.csv' % root
-    removed_bl = wrapped(BusinessLicense.load, [removed_bl_filename], True)
+    removed_bl = BusinessLicense.load(removed_bl_filename)
     for obj in removed_bl:
-        obj.output_salesforce_to(writer, remove_date=remove_date)
+        yield obj.salesforce_row(remove_date=remove_date)
+
+
+class SalesforceDelta(object):
+    """Which accounts a delta Salesforce file includes: the owners and
+    licenses added or changed since the previous upload, going by 
+    differences.diff. Removed ones are added from the removed caches, 
+    as in the full file.
+
+    An added owner's licenses are included too, as their Parent Account
+    is new. A license that moved to an owner that was already there, 
+    because its own owner was removed, is not.
+    """
+
+    def __init__(self, owner_keys, license_keys, with_parents=False,
+                 added_owner_keys=frozenset()):
+        """
+        @param owner_keys Set of keys of owners to include
+        @param license_keys Same for licenses
+        @param with_parents Also include the owner of each license 
+        included, so the file holds whole branches of the hierarchy
+        @param added_owner_keys Set of keys of the owners added, whose
+        licenses are all included
+        """
+        self.owner_keys = owner_keys
+        self.license_keys = license_keys
+        self.with_parents = with_parents
+        self.added_owner_keys = added_owner_keys
+
+    @staticmethod
+    def from_differences(po_differences, bl_differences, with_parents=False):
+        """
+        @param po_differences Tuple of (added, changed, removed) 
+        property owners, as differences.diff returns them
+        @param bl_differences Same, for business licenses
+        @param with_parents See __init__
+        """
+
+        def changed_keys(added, changed, _):
+            """Keys of the added and changed records"""
+            return (set(record.key for record in added) | 
+                    set(key for key, _, _ in changed))
+
+        return SalesforceDelta(changed_keys(*po_differences),
+                               changed_keys(*bl_differences), with_parents,
+                               set(record.key 
+                                   for record in po_differences[0]))
+
+    def salesforce_rows(self, owner):
+        """Rows of the Salesforce file for those of an owner and its
+        licenses that are in the delta
+        @return Array of rows
+        """
+
+        is_owner_in = owner.key in self.owner_keys
+        if owner.key in self.added_owner_keys:
+            licenses = owner.licenses
+        else:
+            license_keys = self.license_keys
+            licenses = [b_l for b_l in owner.licenses 
+                        if b_l.key in license_keys]
+
+        rows = [b_l.salesforce_row() for b_l in licenses]
+        if is_owner_in or (self.with_parents and rows):
+            rows.insert(0, owner.salesforce_rows()[0])
+        return rows
+
+
+# What the Salesforce file can hold, to whether a SalesforceDelta 
+# includes the parents of licenses, None for the full file
+SALESFORCE_EXPORTS = {
+    'full': None,
+    'delta': False,
+    'delta-with-parents': True
+}
+
+
+def salesforce_delta(po_differences, bl_differences):
+    """The SalesforceDelta the SALESFORCE_EXPORT_ENV environment variable
+    asks for, or None for the full file
+    @param po_differences Tuple of (added, changed, removed) property
+    owners, as differences.diff returns them
+    @param bl_differences Same, for business licenses
+    @raises InvalidInput if it names something other than one of 
+    SALESFORCE_EXPORTS
+    """
+
+    name = os.environ.get(SALESFORCE_EXPORT_ENV, 'full')
+    try:
+        with_parents = SALESFORCE_EXPORTS[name]
+    except KeyError:
+        raise InvalidInput('%s is %s, expected one of %s' % 
+                (SALESFORCE_EXPORT_ENV, name, 
+                 ', '.join(sorted(SALESFORCE_EXPORTS))))
+
+    if with_parents is None:
+        return None
+    return SalesforceDelta.from_differences(po_differences, bl_differences,
+                                            with_parents)
+
+
+def output(owners, filename):
+    """Write out final CSV file of owners and licenses"""
 
+    out, writer = open_output(filename, OUTPUT_HEADER)
+    rows = 0
+    try:
+        for owner in owners:
+            owner_rows = owner.output_rows()
+            writer.writerows(owner_rows)
+            rows += len(owner_rows)
+    finally:
+        out.close()
+    count_output(filename, rows)
+
+
+def output_salesforce(owners, filename, root=None, delta=None):
+    """Write out CSV file of owners and licenses,
+    with headers for import into Salesforce.
+    @param root Directory holding the removed caches written by
+    differences.py, defaults to this script's
+    @param delta SalesforceDelta to only write the accounts that changed,
+    None to write all of them
+    """
+
+    salesforce_rows = PropertyOwner.salesforce_rows
+    if delta is not None:
+        salesforce_rows = delta.salesforce_rows
+
+    out, writer = open_output(filename, SALESFORCE_HEADER)
+    rows = 0
+    try:
+        for owner in owners:
+            owner_rows = salesforce_rows(owner)
+            writer.writerows(owner_rows)
+            rows += len(owner_rows)
+
+        # Now add removed items
+        removed = list(removed_salesforce_rows(root))
+        writer.writerows(removed)
+        rows += len(removed)
+    finally:
+        out.close()
+    count_output(filename, rows)
+
+
+def output_all(owners, out_filename, salesforce_filename, root=None, 
+               delta=None):
+    """Same as output then output_salesforce, 
+    in one pass over the owners and their licenses
+    @param root Directory holding the removed caches written by
+    differences.py, defaults to this script's
+    @param delta SalesforceDelta to only write the accounts that changed
+    to the Salesforce file, None to write all of them
+    """
+
+    salesforce_rows = PropertyOwner.salesforce_rows
+    if delta is not None:
+        salesforce_rows = delta.salesforce_rows
+
+    out, writer = open_output(out_filename, OUTPUT_HEADER)
+    salesforce, salesforce_writer = open_output(salesforce_filename, 
+                                                SALESFORCE_HEADER)
+    out_count = 0
+    salesforce_count = 0
+    try:
+        try:
+            for owner in owners:
+                owner_rows = owner.output_rows()
+                writer.writerows(owner_rows)
+                out_count += len(owner_rows)
+                owner_rows = salesforce_rows(owner)
+                salesforce_writer.writerows(owner_rows)
+                salesforce_count += len(owner_rows)
+        finally:
+            out.close()
+        count_output(out_filename, out_count)
+
+        # Now add removed items
+        removed = list(removed_salesforce_rows(root))
+        salesforce_writer.writerows(removed)
+        salesforce_count += len(removed)
+    finally:
+        salesforce.close()
+    count_output(salesforce_filename, salesforce_count)
+
+
+class SnapshotRecord(object):
+    """A PropertyOwner or BusinessLicense read back from a snapshot.
+    Has its data attributes, key and original_record, which is all 
+    differences.py uses, but none of its methods. 
+    See snapshot_record_class."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return unicode(self)
+
+    def __unicode__(self):
+        return self.label      # pylint: disable-msg=E1101
+
+
+def snapshot_names(cls):
+    """Attributes saved in a snapshot of cls records, in order"""
+    return cls.FIELDS + ('key', 'label', 'original_record')
 
-def archive(po_filename, bl_filename):
-    """Moves the uploaded Property Owners and 
-    Business Licenses files to an archive file"""
 
-    # Store archive in same dir as this script
-    root = os.path.abspath(os.path.dirname(sys.argv[0]))
+def snapshot_record_class(cls):
+    """Builds the class of cls records read back from a snapshot.
+    They are tuples, so a whole snapshot turns into records 
+    without a Python call per record."""
 
-    po_archive = root + '/po.csv.%s' % datetime.date.today()
-    bl_archive = root + '/bl.csv.%s' % datetime.date.today()
+    try:
+        return SNAPSHOT_RECORD_CLASSES[cls]
+    except KeyError:
+        pass
+
+    name = cls.__name__ + 'Snapshot'
+    fields = collections.namedtuple(name, snapshot_names(cls))
+    record_class = type(name, (SnapshotRecord, fields), 
+                        {'__slots__': (), 
+                         'FIELDS': cls.FIELDS,
+                         'IGNORE_FIELDS': cls.IGNORE_FIELDS})
+    SNAPSHOT_RECORD_CLASSES[cls] = record_class
+    return record_class
+
+
+def snapshot_rows(cls, records):
+    """Yields records as the tuples a snapshot holds, see snapshot_names
+    @param cls PropertyOwner or BusinessLicense
+    @param records Iterable of cls
+    """
+
+    fields = operator.attrgetter(*cls.FIELDS)      # pylint: disable-msg=W0142
+    for record in records:
+        yield fields(record) + (record.key, record.__unicode__(), 
+                                record.original_record)
+
+
+def write_snapshot(cls, records, filename):
+    """Writes a snapshot of records parsed from CSV file 'filename' 
+    next to it. load_snapshot reads it back several times faster 
+    than parsing the file again.
+    @param cls PropertyOwner or BusinessLicense
+    @param records Array of cls, in the order cls.load returns them
+    @raises IOError, ValueError if a record holds something 
+    marshal can't write
+    """
+
+    rows = list(snapshot_rows(cls, records))
 
-    shutil.move(po_filename, po_archive)
-    shutil.move(bl_filename, bl_archive)
+    service_area = REGISTRY['address_manager'].service_area
+    header = (SNAPSHOT_VERSION, marshal.version, cls.__name__, 
+              service_area.fingerprint(), snapshot_names(cls))
+
+    snapshot_filename = filename + SNAPSHOT_SUFFIX
+    snapshot_file = open(snapshot_filename, 'wb')
+    try:
+        marshal.dump(header, snapshot_file, marshal.version)
+        marshal.dump(rows, snapshot_file, marshal.version)
+    finally:
+        snapshot_file.close()
 
     perms = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-    os.chmod(po_archive, perms)
-    os.chmod(bl_archive, perms)
+    os.chmod(snapshot_filename, perms)
+
+
+def load_snapshot(cls, filename):
+    """Reads back the snapshot written next to CSV file 'filename'.
+    It is only used if it was written by this version of merge.py, 
+    with the same service area, after the file was last changed.
+    @param cls PropertyOwner or BusinessLicense
+    @return Array of SnapshotRecord in the order they were written,
+    or None if there is no snapshot we can use
+    """
+
+    service_area = REGISTRY['address_manager'].service_area
+    expected_header = (SNAPSHOT_VERSION, marshal.version, cls.__name__,
+                       service_area.fingerprint(), snapshot_names(cls))
+
+    snapshot_filename = filename + SNAPSHOT_SUFFIX
+    try:
+        if os.stat(snapshot_filename).st_mtime < os.stat(filename).st_mtime:
+            return None
+
+        snapshot_file = open(snapshot_filename, 'rb')
+        try:
+            if marshal.load(snapshot_file) != expected_header:
+                return None
+
+            # Nothing loaded here can be garbage, and collecting while
+            # a snapshot's strings are created takes longer than 
+            # creating them
+            is_gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                rows = marshal.load(snapshot_file)
+                record_class = snapshot_record_class(cls)
+                return map(tuple.__new__, [record_class] * len(rows), rows)
+            finally:
+                if is_gc_enabled:
+                    gc.enable()
+        finally:
+            snapshot_file.close()
+    except (OSError, IOError, EOFError, ValueError, TypeError):
+        # Missing, or not written by this version of Python
+        return None
 
 
 def wrapped(func, args, is_quiet):
@@ -950,25 +1959,28 @@ def main():
     # Currying. Saves us from always passing 'is_quiet' when calling 'wrapped'.
     wrap = lambda x, y: wrapped(x, y, is_quiet)
 
+    # Both are kept in lists for the snapshots written by archive
     owners = wrap(PropertyOwner.load, [sys.argv[1]])
 
     licenses = wrap(BusinessLicense.load, [sys.argv[2]])
 
-    wrap(merge, [owners, licenses])
-
-    wrap(output, [owners, sys.argv[3]])
+    merge_func = wrap(merge_engine, [])
+    owners = wrap(merge_func, [owners, licenses])
 
     error_manager = REGISTRY['error_manager']
     wrap(error_manager.report, [sys.argv[4]])
 
-    wrap(output_salesforce, [owners, sys.argv[5]])
+    wrap(output_all, [owners, sys.argv[3], sys.argv[5]])
 
-    wrap(archive, [sys.argv[1], sys.argv[2]])
+    # As are archives, by history.py
+    from history import archive
+    wrap(archive, [sys.argv[1], sys.argv[2], None, owners, licenses])
 
 
 REGISTRY['address_manager'] = AddressManager()
 REGISTRY['error_manager'] = ErrorManager()
+REGISTRY['run_report'] = RunReport()
 
 
 if __name__ == '__main__':
-    main()
+    profiling.profiled(main, [], 'merge')
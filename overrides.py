@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Maintains the address overrides merge.py consults when a business
+license's address doesn't match a property owner's: which owner address
+a business address resolves to. See AddressOverrides.
+
+Usage:
+    overrides.py add <business address> <owner address>
+    overrides.py forget <business address>
+    overrides.py import
+    overrides.py list
+
+Addresses can be given as they appear in the CSV files,
+e.g. '397 Railway St', they are cleaned the same way. import copies the
+service area file's address_owners into the overrides file, after which
+they can be taken out of the service area file.
+"""
+
+import os
+import csv
+import sys
+import syslog
+import cStringIO
+
+from merge import wrapped, InvalidInput, REGISTRY
+from merge import SERVICE_AREA_ENV, DEFAULT_AREA_FILE
+
+# Environment variable naming the address overrides file, see
+# AddressOverrides. Defaults to the service area file with 
+# OVERRIDES_SUFFIX added, e.g. strathcona.json.overrides
+OVERRIDES_ENV = 'SBIA_ADDRESS_OVERRIDES'
+OVERRIDES_SUFFIX = '.overrides'
+
+
+class AddressOverrides(object):
+    """Business addresses resolved by hand to the property owner address
+    whose owner gets their licenses. Resolutions are learned as they are
+    accepted, see overrides.py, rather than edited into the service area 
+    file.
+
+    They are appended to a CSV file of (business address, owner address)
+    rows and held in a dict. A later row for a business address replaces
+    earlier ones, and a row with no owner address forgets it. The service
+    area's address_owners lie underneath, for business addresses the 
+    file has nothing for, until import_owners copies them in.
+
+    hits and misses count the lookups that did and didn't find an 
+    owner address.
+    """
+
+    def __init__(self, filename=None, defaults=None):
+        """
+        @param filename File the resolutions are read from and appended
+        to. None to only hold them in memory.
+        @param defaults Dict of business address to owner address, 
+        usually the service area's address_owners
+        @raises InvalidInput if the file isn't CSV
+        """
+        self.filename = filename
+        self.defaults = defaults or {}
+        # Business address to owner address, None if forgotten
+        self.learned = {}
+        self.hits = 0
+        self.misses = 0
+
+        if filename is not None:
+            self._read()
+        self._resolutions = self.resolutions()
+
+    def _read(self):
+        """Reads the resolutions file, if there is one yet"""
+
+        try:
+            overrides_file = open(self.filename, 'rb')
+        except IOError:
+            return
+
+        try:
+            try:
+                for row in csv.reader(overrides_file):
+                    if len(row) == 2:
+                        self.learned[row[0]] = row[1] or None
+            except csv.Error, exc:
+                raise InvalidInput('Address overrides file %s is not ' \
+                        'valid CSV: %s' % (self.filename, exc))
+        finally:
+            overrides_file.close()
+
+    def get(self, business_addr):
+        """Owner address business_addr was resolved to, or None"""
+
+        owner_addr = self._resolutions.get(business_addr)
+        if owner_addr is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return owner_addr
+
+    def get_all(self, business_addrs):
+        """Same as get for each of a list of business addresses, 
+        but a single map call
+        @return Array of owner address or None
+        """
+
+        owner_addrs = map(self._resolutions.get, business_addrs)
+        misses = owner_addrs.count(None)
+        self.misses += misses
+        self.hits += len(owner_addrs) - misses
+        return owner_addrs
+
+    def add(self, resolutions):
+        """Records resolutions, replacing any earlier ones for the same
+        business addresses. They are appended to the file in one write.
+        @param resolutions Iterable of tuple of (business address, 
+        owner address), owner address None to forget the business address
+        """
+
+        resolutions = list(resolutions)
+        if self.filename is not None and resolutions:
+            rows = cStringIO.StringIO()
+            csv.writer(rows).writerows(
+                    (business_addr, owner_addr or '')
+                    for business_addr, owner_addr in resolutions)
+
+            overrides_file = open(self.filename, 'ab')
+            try:
+                overrides_file.write(rows.getvalue())
+            finally:
+                overrides_file.close()
+
+        self.learned.update(resolutions)
+        self._resolutions = self.resolutions()
+
+    def import_owners(self, address_owners):
+        """Adds the resolutions in address_owners for business addresses
+        the file has nothing for, e.g. the service area's address_owners
+        @return Number of resolutions added
+        """
+
+        added = sorted((business_addr, owner_addr)
+                       for business_addr, owner_addr in address_owners.items()
+                       if business_addr not in self.learned)
+        self.add(added)
+        return len(added)
+
+    def resolutions(self):
+        """Dict of business address to owner address of everything 
+        that resolves, learned or not"""
+
+        resolutions = dict(self.defaults)
+        for business_addr, owner_addr in self.learned.items():
+            if owner_addr is None:
+                resolutions.pop(business_addr, None)
+            else:
+                resolutions[business_addr] = owner_addr
+        return resolutions
+
+    def __str__(self):
+        return '%d hits, %d misses' % (self.hits, self.misses)
+
+
+def load_overrides(filename=None, service_area=None):
+    """Loads the AddressOverrides of the service area, with its 
+    address_owners underneath.
+    @param filename Address overrides file. Defaults to the file named by
+    the OVERRIDES_ENV environment variable, or the service area file with
+    OVERRIDES_SUFFIX added.
+    @param service_area ServiceArea, that of REGISTRY['address_manager']
+    if not given
+    @return AddressOverrides
+    @raises InvalidInput
+    """
+
+    if filename is None:
+        filename = os.environ.get(OVERRIDES_ENV)
+    if filename is None:
+        filename = os.environ.get(SERVICE_AREA_ENV, DEFAULT_AREA_FILE) + \
+                OVERRIDES_SUFFIX
+
+    if service_area is None:
+        service_area = REGISTRY['address_manager'].service_area
+    return AddressOverrides(filename, service_area.address_owners)
+
+
+
+def address_key(address):
+    """Cleans an address given on the command line the way
+    merge.py cleans the addresses it matches
+    @raises InvalidInput if it isn't an address
+    """
+
+    key = REGISTRY['address_manager'].parse(address).key
+    if key is None:
+        raise InvalidInput('%s is not an address' % address)
+    return key
+
+
+def add(business_address, owner_address):
+    """Resolves a business address to an owner address"""
+
+    overrides = load_overrides()
+    overrides.add([(address_key(business_address),
+                    address_key(owner_address))])
+
+
+def forget(business_address):
+    """Stops resolving a business address, including an address_owners
+    entry in the service area file"""
+
+    overrides = load_overrides()
+    overrides.add([(address_key(business_address), None)])
+
+
+def import_owners():
+    """Copies the service area's address_owners into the overrides file
+    @return Number of resolutions added"""
+
+    overrides = load_overrides()
+    return overrides.import_owners(overrides.defaults)
+
+
+def list_overrides():
+    """Prints every business address that resolves, and where to"""
+
+    resolutions = load_overrides().resolutions()
+    for business_addr, owner_addr in sorted(resolutions.items()):
+        print('%s -> %s' % (business_addr, owner_addr))
+
+
+COMMANDS = {
+    'add': (add, 2),
+    'forget': (forget, 1),
+    'import': (import_owners, 0),
+    'list': (list_overrides, 0),
+}
+
+
+def main():
+    """Main"""
+
+    args = sys.argv[1:]
+    try:
+        func, num_args = COMMANDS[args[0]]
+    except (IndexError, KeyError):
+        func, num_args = None, None
+
+    if func is None or len(args) - 1 != num_args:
+        print(__doc__.strip())
+        syslog.syslog('overrides.py: Wrong arguments to script')
+        sys.exit(1)
+
+    ret = wrapped(func, args[1:], False)
+    if func is import_owners:
+        print('Imported %d address overrides' % ret)
+
+
+if __name__ == '__main__':
+    main()
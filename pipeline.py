@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""Runs a whole upload: differences from the previous upload, merge,
+output files and archive, parsing each uploaded file once.
+
+run_upload works everything out in memory and returns an Upload.
+write_upload writes the output files from it.
+
+Stages that don't depend on each other run at the same time, in
+forked child processes. A child sees the records parsed before it
+started without them being copied, so only its result comes back.
+The business licenses a child loads, when there is more than one
+processor, come back packed, see merge.BusinessLicense.pack.
+
+Each stage is timed in the run report, report.RunReport, 
+including those run by children.
+"""
+
+import os
+import sys
+import syslog
+import traceback
+import multiprocessing
+
+import merge
+import differences
+import salesforce
+import history
+import profiling
+from merge import PropertyOwner, BusinessLicense, ErrorManager
+from merge import REGISTRY
+from report import RunReport
+
+
+class PipelineError(Exception):
+    """Raised when a stage run in a child process fails"""
+    pass
+
+
+class Background(object):
+    """Runs func(*args) in a forked child process, as a stage of the
+    run report. Call result() to wait for it."""
+
+    def __init__(self, func, args, name=None):
+        """
+        @param name Name of the stage, defaults to func's
+        """
+        self.name = name or func.__name__
+        self._receiver, sender = multiprocessing.Pipe(False)
+        self._process = multiprocessing.Process(target=run_child,
+                args=(func, args, sender, self.name))
+        self._process.start()
+        sender.close()
+
+    def result(self):
+        """Waits for the child to finish, and adds the stages it ran
+        to this process's run report.
+        @return What func returned
+        @raises PipelineError if func raised an exception
+        """
+
+        try:
+            is_ok, value, stages = self._receiver.recv()
+        except EOFError:
+            is_ok, value, stages = False, 'Exited without a result', []
+        self._process.join()
+
+        for info in stages:
+            info['process'] = 'child'
+        REGISTRY['run_report'].stages.extend(stages)
+
+        if not is_ok:
+            raise PipelineError('%s failed: %s' % (self.name, value))
+        return value
+
+
+def run_child(func, args, sender, name):
+    """Body of a Background child process. Sends back tuple of
+    (True, return value, stages) or (False, traceback, stages), 
+    stages being those of its run report."""
+
+    report = REGISTRY['run_report'] = RunReport()
+    try:
+        with report.stage(name):
+            ret = func(*args)       # pylint: disable-msg=W0142
+        sender.send((True, ret, report.stages))
+    except Exception:           # pylint: disable-msg=W0703
+        sender.send((False, traceback.format_exc(), report.stages))
+    sender.close()
+
+
+class Upload(object):
+    """What an upload works out, before anything is written"""
+
+    def __init__(self, owners, licenses, error_manager, 
+                 po_differences, bl_differences, run_report=None):
+        """
+        @param owners Array of PropertyOwner, with licenses merged in
+        @param licenses Array of BusinessLicense, as BusinessLicense.load
+        returns it
+        @param error_manager ErrorManager holding the rejected rows
+        @param po_differences Tuple of (added, changed, removed)
+        property owners, see differences.diff
+        @param bl_differences Same, for business licenses
+        @param run_report RunReport timing the upload's stages
+        """
+        self.owners = owners
+        self.licenses = licenses
+        self.error_manager = error_manager
+        self.differences = {'PO': po_differences, 'BL': bl_differences}
+        self.run_report = run_report
+
+    def html(self, compare_type):
+        """Differences from the previous upload as HTML
+        @param compare_type 'PO' or 'BL'
+        """
+        return differences.html_diff(*self.differences[compare_type])
+
+
+def load_licenses(bl_filename):
+    """Loads the business licenses, in a Background child
+    @return Tuple of (licenses kept, licenses rejected, why each was
+    rejected, dict of why to rows dropped), the licenses packed by 
+    BusinessLicense.pack
+    """
+
+    error_manager = REGISTRY['error_manager'] = ErrorManager()
+    licenses = BusinessLicense.load(bl_filename)
+    REGISTRY['run_report'].count('Kept', len(licenses))
+    return (BusinessLicense.pack(licenses), 
+            BusinessLicense.pack(obj for obj, _ in error_manager.errors),
+            [msg for _, msg in error_manager.errors], 
+            error_manager.skipped)
+
+
+def run_upload(po_filename, bl_filename, 
+               previous_po_filename, previous_bl_filename):
+    """Parses an upload, compares it with the previous one and merges it.
+    Writes nothing.
+
+    With more than one processor, a child loads the business licenses
+    while the owners are loaded. A child then compares the owners with 
+    the previous upload while the licenses are unpacked, or loaded, and
+    merged. Another compares the licenses while the owners are merged.
+
+    @return Upload
+    """
+
+    error_manager = ErrorManager()
+    REGISTRY['error_manager'] = error_manager
+    report = REGISTRY['run_report'] = RunReport()
+
+    # With one processor, packing and unpacking is only extra work
+    bl_load = None
+    if multiprocessing.cpu_count() > 1:
+        bl_load = Background(load_licenses, [bl_filename], 'BL load')
+
+    with report.stage('PO load'):
+        owners = PropertyOwner.load(po_filename)
+        report.count('Kept', len(owners))
+    po_diff = Background(differences.compare,
+                         ['PO', owners, previous_po_filename], 'PO diff')
+
+    if bl_load is None:
+        with report.stage('BL load'):
+            licenses = BusinessLicense.load(bl_filename)
+            report.count('Kept', len(licenses))
+    else:
+        packed, rejected, reasons, skipped = bl_load.result()
+        with report.stage('BL unpack'):
+            licenses = BusinessLicense.unpack(packed)
+            # After the owners', as if the licenses were loaded here
+            error_manager.extend(zip(BusinessLicense.unpack(rejected), 
+                                     reasons), skipped)
+    bl_diff = Background(differences.compare,
+                         ['BL', licenses, previous_bl_filename], 'BL diff')
+
+    with report.stage('merge'):
+        owners = merge.merge_engine()(owners, licenses)
+
+    return Upload(owners, licenses, error_manager, 
+                  po_diff.result(), bl_diff.result(), report)
+
+
+def write_upload(upload, out_filename, err_filename, salesforce_filename,
+                 root=None):
+    """Writes the output files of an upload. The mailing list and
+    Salesforce files are written in one pass over the owners. The 
+    Salesforce file holds only what changed if merge.SALESFORCE_EXPORT_ENV
+    asks for a delta, see merge.salesforce_delta.
+    @param upload Upload from run_upload
+    @param root Directory for the removed caches, defaults to this script's
+    """
+
+    delta = merge.salesforce_delta(upload.differences['PO'], 
+                                   upload.differences['BL'])
+    report = REGISTRY['run_report']
+
+    with report.stage('write errors'):
+        upload.error_manager.report(err_filename)
+
+    # The Salesforce file includes the removed records,
+    # read back from the removed caches written here
+    with report.stage('write differences'):
+        for compare_type in ['PO', 'BL']:
+            args = upload.differences[compare_type]
+            differences.output_differences(compare_type, *args, root=root)
+
+    with report.stage('write mailing list and Salesforce'):
+        merge.output_all(upload.owners, out_filename, salesforce_filename, 
+                         root, delta)
+
+
+def run(po_filename, bl_filename, previous_po_filename, previous_bl_filename,
+        out_filename, err_filename, salesforce_filename, root=None):
+    """Runs an upload from start to end: run_upload, write_upload,
+    uploading the Salesforce file if salesforce.SALESFORCE_URL_ENV is set,
+    then archive the uploaded files with snapshots of their records.
+    @param root Directory of the archives and removed caches,
+    defaults to this script's
+    @return Upload
+    """
+
+    upload = run_upload(po_filename, bl_filename, 
+                        previous_po_filename, previous_bl_filename)
+    write_upload(upload, out_filename, err_filename, salesforce_filename, 
+                 root)
+
+    report = upload.run_report
+    if salesforce.SALESFORCE_URL_ENV in os.environ:
+        with report.stage('Salesforce upload'):
+            processed, failed = salesforce.upload_file(salesforce_filename)
+            report.count('Processed', processed)
+            report.count('Failed', failed)
+    with report.stage('archive'):
+        history.archive(po_filename, bl_filename, root, 
+                        upload.owners, upload.licenses)
+
+    return upload
+
+
+def main():
+    """Main"""
+
+    if len(sys.argv) != 8:
+        print('%d arguments, expected 8' % len(sys.argv))
+        print('Usage: pipeline.py <property_owners.csv> ' +
+                                 '<business_licenses.csv> ' +
+                                 '<previous_property_owners.csv> ' +
+                                 '<previous_business_licenses.csv> ' +
+                                 '<output.csv> ' +
+                                 '<error.csv> ' +
+                                 '<salesforce.csv>')
+        syslog.syslog('pipeline.py: Wrong number of arguments to script')
+        sys.exit(1)
+
+    upload = merge.wrapped(run, sys.argv[1:], False)
+
+    sys.stdout.write(upload.html('PO'))
+    sys.stdout.write(upload.html('BL'))
+
+
+if __name__ == '__main__':
+    profiling.profiled(main, [], 'pipeline')
@@ -0,0 +1,201 @@
+"""Opt-in profiling of a run of merge.py, differences.py, pipeline.py or
+the upload webmerge.py runs. Set the PROFILE_ENV environment variable
+to one of PROFILE_MODES:
+
+- cprofile: every call is timed by cProfile. Writes a pstats file, and a
+  collapsed stack file worked out from its call graph.
+- sample: the stack is sampled every SAMPLE_INTERVAL seconds of CPU
+  time. Costs far less than cprofile, and the collapsed stacks are the
+  real ones. Writes only the collapsed stack file.
+
+Files are written into the archive directory, named by the run and the
+date like the archives, e.g. pipeline.2012-05-01.pstats and
+pipeline.2012-05-01.collapsed. The collapsed stack files are what
+flamegraph.pl takes. Only the process that was started is profiled,
+not children it forks.
+"""
+
+import os
+import sys
+import signal
+import syslog
+import pstats
+import cProfile
+import datetime
+
+# Environment variable turning profiling on, one of PROFILE_MODES
+PROFILE_ENV = 'SBIA_PROFILE'
+PROFILE_MODES = ['cprofile', 'sample']
+
+# Seconds of CPU time between samples
+SAMPLE_INTERVAL = 0.005
+
+# Calls taking less than this many seconds in all from a stack are left
+# out of the collapsed stacks worked out from cProfile's call graph,
+# which otherwise has more stacks than there is time to walk
+MIN_STACK_SECONDS = 0.0001
+
+
+def profiled(func, args, name, root=None):
+    """Runs func(*args), profiled if PROFILE_ENV asks for it.
+    The profile is written even if func raises an exception or exits.
+    @param name Name of the run, starting the profile file names
+    @param root Directory to write the profile files to, defaults to
+    this script's, where the archives go
+    @return What func returned
+    @raises ValueError if PROFILE_ENV isn't one of PROFILE_MODES
+    """
+
+    mode = os.environ.get(PROFILE_ENV)
+    if not mode:
+        return func(*args)      # pylint: disable-msg=W0142
+    if mode not in PROFILE_MODES:
+        raise ValueError('%s is %s, expected one of %s' %
+                (PROFILE_ENV, mode, ', '.join(PROFILE_MODES)))
+
+    if root is None:
+        root = os.path.abspath(os.path.dirname(sys.argv[0]))
+    filename = os.path.join(root, '%s.%s' % (name, datetime.date.today()))
+
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            write_profile(profile, filename)
+    else:
+        sampler = Sampler()
+        sampler.start()
+        try:
+            return func(*args)      # pylint: disable-msg=W0142
+        finally:
+            sampler.stop()
+            write_collapsed(sampler.stacks, filename + '.collapsed')
+
+
+def frame_label(filename, funcname):
+    """How a function appears in a collapsed stack, e.g. merge.py:merge"""
+
+    if filename == '~':
+        # Built in, funcname is e.g. <method 'sort' of 'list' objects>
+        label = funcname
+    else:
+        label = '%s:%s' % (os.path.basename(filename), funcname)
+
+    # Collapsed stacks are split on ; and the count on the last space
+    return label.replace(';', ':').replace(' ', '_')
+
+
+def write_profile(profile, filename):
+    """Writes a cProfile.Profile as filename.pstats and
+    filename.collapsed"""
+
+    try:
+        profile.dump_stats(filename + '.pstats')
+        stats = pstats.Stats(profile).stats    # pylint: disable-msg=E1101
+        write_collapsed(collapsed_stacks(stats), filename + '.collapsed')
+    except (IOError, OSError), exc:
+        syslog.syslog('profiling.py: Could not write profile %s: %s' %
+                (filename, exc))
+
+
+def collapsed_stacks(stats):
+    """Works out collapsed stacks from cProfile's call graph, which only
+    knows each function's callers, not whole stacks. A function's own
+    time is shared out between the stacks it was called from in
+    proportion to the time spent in it from each caller.
+    @param stats Dict of function to tuple of (primitive calls, calls,
+    own time, cumulative time, dict of caller to the same for calls
+    from it), as pstats.Stats.stats
+    @return Dict of tuple of frame labels to microseconds
+    """
+
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((func, cumulative))
+
+    stacks = {}
+
+    def visit(func, stack, share, path):
+        """Adds share of func's own time at the end of stack, and visits
+        what it called
+        @param path Set of the functions on stack, recursion is folded 
+        into the outermost call
+        """
+
+        own = stats[func][2]
+        stack = stack + (frame_label(func[0], func[2]),)
+        micros = int(own * share * 1000000)
+        if micros:
+            stacks[stack] = stacks.get(stack, 0) + micros
+
+        for callee, from_here in callees.get(func, []):
+            callee_cumulative = stats[callee][3]
+            if (callee in path or not callee_cumulative or
+                    from_here * share < MIN_STACK_SECONDS):
+                continue
+            path.add(callee)
+            visit(callee, stack, share * from_here / callee_cumulative, path)
+            path.remove(callee)
+
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            visit(func, (), 1.0, set([func]))
+
+    return stacks
+
+
+class Sampler(object):
+    """Samples the stack of the main thread on a CPU time timer"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        # Tuple of frame labels, outermost first, to number of samples
+        self.stacks = {}
+        self._previous = None
+
+    def start(self):
+        """Starts sampling"""
+
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        # Carry on with system calls the timer interrupts,
+        # rather than failing them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """Stops sampling"""
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+    def _sample(self, _, frame):
+        """SIGPROF handler, counts the stack it interrupted"""
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(frame_label(code.co_filename, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        stack = tuple(stack)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+def write_collapsed(stacks, filename):
+    """Writes stacks as lines of frames separated by ; and a count,
+    the format flamegraph.pl reads
+    @param stacks Dict of tuple of frame labels to count
+    """
+
+    try:
+        out = open(filename, 'wt')
+        try:
+            for stack, count in sorted(stacks.items()):
+                out.write('%s %d\n' % (';'.join(stack), count))
+        finally:
+            out.close()
+    except (IOError, OSError), exc:
+        syslog.syslog('profiling.py: Could not write profile %s: %s' %
+                (filename, exc))
@@ -0,0 +1,94 @@
+"""Timings and row counts of the stages of a run, see RunReport.
+"""
+
+import json
+import cgi
+import time
+import resource
+
+
+class RunReport(object):
+    """How long each stage of a run took, in wall clock and CPU time, 
+    the peak memory of the process by its end, and counts of the rows 
+    it handled. Rows rejected through the ErrorManager are counted by 
+    their reason.
+
+        with REGISTRY['run_report'].stage('merge'):
+            ...
+
+    Counts made while a stage is open go to the innermost one.
+    """
+
+    def __init__(self):
+        # Dict per stage, in the order they started
+        self.stages = []
+        self._open = []
+
+    def stage(self, name):
+        """Context manager timing a stage"""
+        return Stage(self, name)
+
+    def count(self, what, rows=1):
+        """Adds rows to a count of the innermost open stage"""
+
+        if self._open:
+            counts = self._open[-1].info['counts']
+            counts[what] = counts.get(what, 0) + rows
+
+    def write(self, filename):
+        """Writes the stages as JSON"""
+
+        report_file = open(filename, 'wt')
+        try:
+            json.dump({'stages': self.stages}, report_file, indent=1,
+                      sort_keys=True)
+        finally:
+            report_file.close()
+
+    def html(self):
+        """The stages as an HTML table"""
+
+        lines = ['<table>', '<tr><th>Stage</th><th>Wall s</th>'
+                 '<th>CPU s</th><th>Peak RSS MB</th><th>Rows</th></tr>']
+        for info in self.stages:
+            counts = ', '.join('%s: %d' % (cgi.escape(what), rows) 
+                               for what, rows in sorted(info['counts'].items()))
+            lines.append('<tr><td>%s</td><td>%.2f</td><td>%.2f</td>'
+                         '<td>%.1f</td><td>%s</td></tr>' % 
+                         (cgi.escape(info['stage']), info['wall_seconds'], 
+                          info['cpu_seconds'], info['peak_rss_kb'] / 1024.0, 
+                          counts))
+        lines.append('</table>')
+        return '\n'.join(lines)
+
+
+class Stage(object):
+    """One stage of a RunReport, see RunReport.stage"""
+
+    def __init__(self, report, name):
+        self.report = report
+        self.info = {'stage': name, 'counts': {}}
+        self._start = None
+
+    def __enter__(self):
+        self.report.stages.append(self.info)
+        self.report._open.append(self)     # pylint: disable-msg=W0212
+        self._start = (time.time(), cpu_seconds())
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        wall_start, cpu_start = self._start
+        self.info['wall_seconds'] = time.time() - wall_start
+        self.info['cpu_seconds'] = cpu_seconds() - cpu_start
+        self.info['peak_rss_kb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        if exc_type is not None:
+            self.info['failed'] = True
+        self.report._open.remove(self)     # pylint: disable-msg=W0212
+        return False
+
+
+def cpu_seconds():
+    """User and system CPU time used by this process so far"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""Uploads a Salesforce file written by merge.output_salesforce, through
+an API in the style of the Salesforce Bulk API: a job of Account rows,
+sent as CSV batches by a pool of workers, each batch polled until it
+has been processed.
+
+Parent accounts (property owners) go in one job, which finishes before
+the job of their child accounts (business licenses) starts, so every
+Parent Account exists by the time a child names it. Both jobs upsert,
+owners on their Folio Number and licenses on their License Number, so
+uploading an account again updates it rather than adding a copy.
+
+Usage: salesforce.py <salesforce.csv>
+Uploads to the URL in the SALESFORCE_URL_ENV environment variable.
+salesforce_mock.py is a local stand-in to upload to.
+"""
+
+import os
+import csv
+import sys
+import errno
+import json
+import time
+import random
+import socket
+import syslog
+import httplib
+import urlparse
+import threading
+import cStringIO
+from multiprocessing.pool import ThreadPool
+
+from merge import wrapped
+
+# Environment variable giving the URL of the Bulk API,
+# e.g. http://localhost:8090/services/async/24.0
+SALESFORCE_URL_ENV = 'SBIA_SALESFORCE_URL'
+
+# Environment variable giving the session id to upload with
+SALESFORCE_SESSION_ENV = 'SBIA_SALESFORCE_SESSION'
+
+# Environment variable giving the number of batches sent at a time
+UPLOAD_WORKERS_ENV = 'SBIA_UPLOAD_WORKERS'
+UPLOAD_WORKERS = 4
+
+# Most rows and bytes the Bulk API takes in one batch
+BATCH_ROWS = 10000
+BATCH_BYTES = 10000000
+
+# Responses that mean we are being throttled, and should try again later.
+# Waits RETRY_DELAY seconds after the first, doubling each time up to
+# MAX_RETRY_DELAY, MAX_RETRIES times, unless the response says how long.
+THROTTLED_STATUSES = frozenset([429, 503])
+MAX_RETRIES = 8
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+# Seconds between asking whether a batch has been processed
+POLL_INTERVAL = 2.0
+
+# Methods sent again on a new connection when the response to them was
+# lost on a kept alive one. Anything else may have been carried out, so
+# sending it again could load a batch twice.
+RESEND_METHODS = frozenset(['GET'])
+
+# States a batch ends in
+BATCH_DONE_STATES = frozenset(['Completed', 'Failed', 'Not Processed'])
+
+# Columns of the Salesforce file identifying owner and license accounts,
+# which the jobs upsert on
+OWNER_ID_COLUMN = 'Folio Number'
+LICENSE_ID_COLUMN = 'License Number'
+
+# Column of the Salesforce file holding when a removed account was removed
+REMOVED_COLUMN = 'Removed'
+
+
+class UploadError(Exception):
+    """Raised when the Bulk API refuses a request, or a batch fails"""
+    pass
+
+
+class Connections(object):
+    """An HTTP connection per worker thread to a host, kept alive
+    between requests"""
+
+    def __init__(self, url):
+        """
+        @param url Base URL requests are relative to
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self._netloc = parts.netloc
+        self.path = parts.path.rstrip('/')
+        self._local = threading.local()
+        # Every thread's connection, so close() can reach them all
+        self._opened = set()
+        self._opened_lock = threading.Lock()
+
+    def request(self, method, path, body=None, headers=None):
+        """Sends a request on this thread's connection, opening it if
+        there isn't one. If a kept alive connection was dropped, for
+        example by the server timing it out, tries once more on a new
+        one: when sending the request fails, or when the response is
+        lost to a request of RESEND_METHODS.
+        @param path Path after the base URL
+        @return Tuple of (status, dict of lower cased header name to
+        value, body)
+        @raises httplib.HTTPException or socket.error if the request
+        failed and wasn't tried again
+        """
+
+        for attempt in [1, 2]:
+            connection = getattr(self._local, 'connection', None)
+            # A closed connection opens its socket again on request
+            reused = connection is not None and connection.sock is not None
+            if connection is None:
+                connection = self._connection_class(self._netloc)
+                self._local.connection = connection
+            if not reused:
+                with self._opened_lock:
+                    self._opened.add(connection)
+
+            try:
+                connection.request(method, self.path + path, body,
+                                   headers or {})
+            except (httplib.HTTPException, socket.error):
+                self.drop()
+                # The server can't have carried out a request it didn't
+                # get all of
+                if not reused or attempt == 2:
+                    raise
+                continue
+
+            try:
+                response = connection.getresponse()
+                return (response.status, dict(response.getheaders()),
+                        response.read())
+            except (httplib.HTTPException, socket.error), exc:
+                self.drop()
+                if not reused or attempt == 2 or \
+                        method not in RESEND_METHODS or \
+                        not is_dropped(exc):
+                    raise
+
+    def drop(self):
+        """Closes this thread's connection, a new one is opened for the
+        next request"""
+        connection = self._local.connection
+        connection.close()
+        self._local.connection = None
+        with self._opened_lock:
+            self._opened.discard(connection)
+
+    def close(self):
+        """Closes every thread's connection. A thread's next request
+        opens a new one."""
+        with self._opened_lock:
+            opened = self._opened
+            self._opened = set()
+        for connection in opened:
+            connection.close()
+
+
+def is_dropped(exc):
+    """Whether an exception reading a response means the server had
+    closed the connection"""
+    if isinstance(exc, httplib.BadStatusLine):
+        return True
+    return isinstance(exc, socket.error) and \
+            exc.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+class BulkUploader(object):
+    """Uploads Account rows through the Bulk API"""
+
+    def __init__(self, url, session='', workers=UPLOAD_WORKERS,
+                 batch_rows=BATCH_ROWS, retry_delay=RETRY_DELAY,
+                 poll_interval=POLL_INTERVAL):
+        """
+        @param url Base URL of the Bulk API
+        @param session Session id sent with each request
+        @param workers Number of batches sent at a time
+        @param batch_rows Most rows in a batch
+        @param retry_delay Seconds to wait after being throttled the
+        first time
+        @param poll_interval Seconds between polls of a batch
+        """
+        self._connections = Connections(url)
+        self.session = session
+        self.workers = workers
+        self.batch_rows = batch_rows
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.retries = 0
+        self._retries_lock = threading.Lock()
+
+    def close(self):
+        """Closes the kept alive connections, for example before the
+        server stops"""
+        self._connections.close()
+
+    def call(self, method, path, body=None, content_type='application/json'):
+        """Sends a request, waiting and trying again while throttled.
+        @param body Request body, a dict is sent as JSON
+        @return Response body read as JSON
+        @raises UploadError if the response is an error
+        """
+
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        headers = {'X-SFDC-Session': self.session,
+                   'Content-Type': content_type}
+
+        for attempt in xrange(MAX_RETRIES + 1):
+            status, response_headers, response = self._connections.request(
+                    method, path, body, headers)
+            if status not in THROTTLED_STATUSES or attempt == MAX_RETRIES:
+                break
+
+            delay = min(self.retry_delay * 2 ** attempt, MAX_RETRY_DELAY)
+            try:
+                delay = float(response_headers['retry-after'])
+            except (KeyError, ValueError):
+                # Spread out workers throttled at the same time
+                delay = random.uniform(delay / 2, delay)
+            with self._retries_lock:
+                self.retries += 1
+            time.sleep(delay)
+
+        if status >= 400:
+            raise UploadError('%s %s failed with %d: %s' %
+                    (method, path, status, response))
+        return json.loads(response)
+
+    def batches(self, header, rows):
+        """Splits rows into CSV batches of at most batch_rows rows and
+        BATCH_BYTES bytes, each starting with the header row
+        @return Iterator of batch bodies
+        """
+
+        out = cStringIO.StringIO()
+        writer = csv.writer(out)
+
+        def as_csv(row):
+            """A row as a line of CSV"""
+            out.seek(0)
+            out.truncate()
+            writer.writerow(row)
+            return out.getvalue()
+
+        header_line = as_csv(header)
+        batch = []
+        size = len(header_line)
+        for row in rows:
+            line = as_csv(row)
+            if batch and (len(batch) >= self.batch_rows or 
+                          size + len(line) > BATCH_BYTES):
+                yield header_line + ''.join(batch)
+                batch = []
+                size = len(header_line)
+            batch.append(line)
+            size += len(line)
+
+        if batch:
+            yield header_line + ''.join(batch)
+
+    def send_batch(self, job_id, text):
+        """Adds a batch to a job and waits for it to be processed
+        @return Batch info, with numberRecordsProcessed and
+        numberRecordsFailed
+        @raises UploadError if the batch failed, or the response to
+        sending it was lost
+        """
+
+        path = '/job/%s/batch' % job_id
+        try:
+            batch = self.call('POST', path, text, 'text/csv')
+        except (httplib.HTTPException, socket.error), exc:
+            # Not sent again, as it may have been loaded
+            raise UploadError('Lost the response to a batch of job %s, ' \
+                    'which may have been loaded: %s' % (job_id, exc))
+        while batch['state'] not in BATCH_DONE_STATES:
+            time.sleep(self.poll_interval)
+            batch = self.call('GET', '%s/%s' % (path, batch['id']))
+
+        if batch['state'] != 'Completed':
+            raise UploadError('Batch %s of job %s %s: %s' % (batch['id'],
+                    job_id, batch['state'], batch.get('stateMessage', '')))
+        return batch
+
+    def run_job(self, pool, header, rows, id_column):
+        """Upserts rows as one job, its batches sent by the worker pool.
+        Returns once every batch has been processed.
+        @param pool ThreadPool of workers
+        @param id_column Column identifying the accounts, an external id
+        @return Tuple of (rows processed, rows that failed)
+        """
+
+        if not rows:
+            return (0, 0)
+
+        job = self.call('POST', '/job', {'operation': 'upsert',
+                                         'object': 'Account',
+                                         'externalIdFieldName': id_column,
+                                         'contentType': 'CSV',
+                                         'concurrencyMode': 'Parallel'})
+        job_id = job['id']
+
+        results = pool.map(lambda text: self.send_batch(job_id, text),
+                           self.batches(header, rows), 1)
+        self.call('POST', '/job/%s' % job_id, {'state': 'Closed'})
+
+        return (sum(batch['numberRecordsProcessed'] for batch in results),
+                sum(batch['numberRecordsFailed'] for batch in results))
+
+    def upload(self, header, rows):
+        """Uploads the rows of a Salesforce file: a job of the owners,
+        which are the parent accounts, then a job of the licenses
+        @param header Header row, naming the columns
+        @param rows Array of rows
+        @return Tuple of (rows processed, rows that failed)
+        """
+
+        license_number = header.index(LICENSE_ID_COLUMN)
+        owners = superseded_removed(header, OWNER_ID_COLUMN, 
+                [row for row in rows if not row[license_number]])
+        licenses = superseded_removed(header, LICENSE_ID_COLUMN, 
+                [row for row in rows if row[license_number]])
+
+        # The same workers, and so connections, send both jobs
+        pool = ThreadPool(self.workers)
+        try:
+            processed, failed = self.run_job(pool, header, owners, 
+                                             OWNER_ID_COLUMN)
+            child_processed, child_failed = self.run_job(pool, header, 
+                    licenses, LICENSE_ID_COLUMN)
+        finally:
+            pool.close()
+            pool.join()
+        return (processed + child_processed, failed + child_failed)
+
+
+def superseded_removed(header, id_column, rows):
+    """Leaves out the removed rows whose external id is also in a row
+    that wasn't removed, for example an owner whose Civic changed,
+    which differences.py shows as removed and added. Upserting both
+    would mark the one account removed, or not, depending on which
+    batch was loaded last. The Salesforce file still holds them, for
+    uploading by hand.
+    @param id_column Column the rows are upserted on
+    @return Array of rows
+    """
+
+    removed = header.index(REMOVED_COLUMN)
+    identifier = header.index(id_column)
+    current = set(row[identifier] for row in rows if not row[removed])
+    return [row for row in rows 
+            if not (row[removed] and row[identifier] in current)]
+
+
+def upload_file(filename, url=None):
+    """Uploads a Salesforce file written by merge.output_salesforce
+    @param url Base URL of the Bulk API, defaults to the
+    SALESFORCE_URL_ENV environment variable
+    @return Tuple of (rows processed, rows that failed)
+    @raises UploadError
+    """
+
+    if url is None:
+        url = os.environ[SALESFORCE_URL_ENV]
+
+    salesforce_file = open(filename, 'rb')
+    try:
+        reader = csv.reader(salesforce_file)
+        header = reader.next()
+        rows = list(reader)
+    finally:
+        salesforce_file.close()
+
+    uploader = BulkUploader(url, os.environ.get(SALESFORCE_SESSION_ENV, ''),
+            int(os.environ.get(UPLOAD_WORKERS_ENV, UPLOAD_WORKERS)))
+    processed, failed = uploader.upload(header, rows)
+
+    syslog.syslog('salesforce.py: Uploaded %s, %d rows processed, ' \
+            '%d failed, %d retries after throttling' %
+            (filename, processed, failed, uploader.retries))
+    return (processed, failed)
+
+
+def main():
+    """Main"""
+
+    if len(sys.argv) != 2 or SALESFORCE_URL_ENV not in os.environ:
+        print('Usage: salesforce.py <salesforce.csv>')
+        print('Uploads to the URL in the %s environment variable' %
+                SALESFORCE_URL_ENV)
+        syslog.syslog('salesforce.py: Wrong arguments to script')
+        sys.exit(1)
+
+    processed, failed = wrapped(upload_file, [sys.argv[1]], False)
+    print('%d rows processed, %d failed' % (processed, failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""A local stand-in for the Salesforce Bulk API, as salesforce.py uses
+it, to try uploads against. Accounts are held in memory. An upsert job
+updates the account with the same value in its externalIdFieldName, 
+or adds one. An insert job always adds accounts, and fails a row whose
+Account Name is already taken, so uploading the same account twice 
+shows up. A row naming a Parent Account that hasn't been loaded yet 
+fails, the way Salesforce can't resolve it. Batches are loaded as they
+arrive, but show as Queued until they are first polled.
+
+Usage: salesforce_mock.py [port] [throttle_every]
+Serves http://localhost:<port>/services/async/24.0 until interrupted.
+With throttle_every, every that many batch requests is refused with
+a 503, as Salesforce does when it is throttling.
+"""
+
+import csv
+import sys
+import json
+import threading
+import itertools
+import cStringIO
+import BaseHTTPServer
+import SocketServer
+
+# Path the API is served under, as on Salesforce
+BASE_PATH = '/services/async/24.0'
+
+DEFAULT_PORT = 8090
+
+
+class MockSalesforce(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The server, holding what has been uploaded to it"""
+
+    daemon_threads = True
+
+    def __init__(self, port=0, throttle_every=0):
+        """
+        @param port Port to listen on, 0 for any free one
+        @param throttle_every Refuse every this many batch requests with
+        a 503, 0 to never throttle
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port),
+                                           MockHandler)
+        self.url = 'http://localhost:%d%s' % (self.server_port, BASE_PATH)
+        self.throttle_every = throttle_every
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+        # Account id to row, as a dict of column to value
+        self.accounts = {}
+        # Account Name to account id, to find parents by
+        self.names = {}
+        # Tuple of (external id field, value) to account id
+        self.external_ids = {}
+        # Job id to dict of job info
+        self.jobs = {}
+        # Batch id to dict of batch info
+        self.batches = {}
+        # Batches received, throttled batches, connections opened
+        self.batch_posts = 0
+        self.throttled = 0
+        self.connections = 0
+
+    def start(self):
+        """Serves requests in a background thread, until shutdown()"""
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def load(self, job, text):
+        """Processes a batch of CSV rows into accounts
+        @param job Job info of the job the batch is in
+        @return Batch info
+        """
+
+        rows = list(csv.DictReader(cStringIO.StringIO(text)))
+        batch = {'id': '751%012d' % self.ids.next(), 'jobId': job['id'],
+                 'state': 'Completed', 'numberRecordsProcessed': len(rows),
+                 'numberRecordsFailed': 0}
+        for row in rows:
+            if not self.load_row(job, row):
+                batch['numberRecordsFailed'] += 1
+        return batch
+
+    def load_row(self, job, row):
+        """Inserts or upserts an account
+        @return Whether it was loaded, rather than failed
+        """
+
+        parent = row.get('Parent Account')
+        if parent and parent not in self.names:
+            return False
+
+        name = row['Account Name']
+        if job['operation'] == 'upsert':
+            key = (job['externalIdFieldName'], 
+                   row.get(job['externalIdFieldName']))
+            if not key[1]:
+                return False
+            account_id = self.external_ids.get(key)
+            if account_id is None:
+                account_id = self.external_ids[key] = \
+                        '001%012d' % self.ids.next()
+            else:
+                # Renamed
+                old_name = self.accounts[account_id]['Account Name']
+                if self.names.get(old_name) == account_id:
+                    del self.names[old_name]
+        else:
+            if name in self.names:
+                return False
+            account_id = '001%012d' % self.ids.next()
+
+        self.accounts[account_id] = row
+        self.names[name] = account_id
+        return True
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Requests to MockSalesforce. Connections are kept alive."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):       # pylint: disable-msg=W0221
+        """Quiet"""
+        pass
+
+    def reply(self, status, info):
+        """Sends info as JSON"""
+
+        body = json.dumps(info)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        """The request body"""
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def parts(self):
+        """Path after BASE_PATH, split on /, or None if it's not under it"""
+
+        if not self.path.startswith(BASE_PATH + '/'):
+            return None
+        return self.path[len(BASE_PATH) + 1:].split('/')
+
+    def do_POST(self):     # pylint: disable-msg=C0103
+        """Creates or closes a job, or adds a batch to one"""
+
+        body = self.read_body()
+        parts = self.parts()
+        server = self.server
+
+        with server.lock:
+            if parts == ['job']:
+                job = json.loads(body)
+                if job.get('operation') not in ['insert', 'upsert'] or (
+                        job['operation'] == 'upsert' and 
+                        not job.get('externalIdFieldName')):
+                    self.reply(400, {'exceptionMessage': 'Bad operation'})
+                    return
+                job.update({'id': '750%012d' % server.ids.next(),
+                            'state': 'Open'})
+                server.jobs[job['id']] = job
+                self.reply(201, job)
+
+            elif parts and len(parts) == 2 and parts[0] == 'job':
+                job = server.jobs.get(parts[1])
+                if job is None:
+                    self.reply(404, {'exceptionMessage': 'No such job'})
+                    return
+                job.update(json.loads(body))
+                self.reply(200, job)
+
+            elif parts and len(parts) == 3 and parts[2] == 'batch':
+                job = server.jobs.get(parts[1])
+                if job is None or job['state'] != 'Open':
+                    self.reply(400, {'exceptionMessage': 'Job not open'})
+                    return
+
+                server.batch_posts += 1
+                if (server.throttle_every and
+                        server.batch_posts % server.throttle_every == 0):
+                    server.throttled += 1
+                    self.reply(503, {'exceptionCode': 'ExceededQuota'})
+                    return
+
+                batch = server.load(job, body)
+                server.batches[batch['id']] = batch
+                self.reply(201, dict(batch, state='Queued'))
+
+            else:
+                self.reply(404, {'exceptionMessage': 'Not found'})
+
+    def do_GET(self):     # pylint: disable-msg=C0103
+        """Batch info"""
+
+        parts = self.parts()
+        with self.server.lock:
+            if parts and len(parts) == 4 and parts[2] == 'batch':
+                batch = self.server.batches.get(parts[3])
+                if batch is not None:
+                    self.reply(200, batch)
+                    return
+            self.reply(404, {'exceptionMessage': 'Not found'})
+
+
+def main():
+    """Main"""
+
+    port = DEFAULT_PORT
+    throttle_every = 0
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        throttle_every = int(sys.argv[2])
+
+    server = MockSalesforce(port, throttle_every)
+    print('Serving %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('%d accounts, %d batches, %d throttled, %d connections' %
+            (len(server.accounts), server.batch_posts, server.throttled,
+             server.connections))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@
 """ CGI script.
 - Receives uploaded CSV files
 - writes them to disk
-- calls merge.py
+- runs the upload pipeline (differences and merge)
 - write result.html
 - redirects to it
 """
@@ -11,26 +11,12 @@ import cgi
 import cgitb
 import tempfile
 import os
-import subprocess
 import datetime
 import sys
 import time
 import glob
 import re
 
-PO_LENGTH = 11
-PO_COLS = ["Folio", "Civic", "Name 1",
-            "Name 2", "Mailing", "Total Assess",
-            "Included Assess", "Ann Chg", "Unit",
-            "House", "Street"]
-
-BL_LENGTH = 15
-BL_COLS = ["RECORD", "LICENSE NUMBER", "ADDRESS",
-            "LICENSE TYPE", "STATUS", "LICENSE YEAR",
-            "BUSINESS NAME", "BUSINESS TRADE NAME", "DATA FROM",
-            "MAIL ADDRESS1", "MAIL ADDRESS2", "MAIL ADDRESS3",
-            "MAIL ADDRESS4", "WORK PHONE1", "WORK PHONE2"]
-
 WEB_ROOT = '/var/www/sbia.goodenergy.ca/'
 SCRIPT_ROOT = '/usr/local/SBIA/'
 
@@ -41,8 +27,19 @@ FORCE = WEB_ROOT + 'salesforce.csv'
 RESULT_TMPL = SCRIPT_ROOT + 'result_template.html'
 RESULT = WEB_ROOT + 'result.html'
 
-MERGE = SCRIPT_ROOT + 'merge.py'
-DIFF = SCRIPT_ROOT + 'differences.py'
+# Timings and row counts of each stage of the upload, see report.RunReport.
+# Also shown at the bottom of result.html if SHOW_RUN_REPORT.
+RUN_REPORT = WEB_ROOT + 'run_report.json'
+SHOW_RUN_REPORT = False
+
+sys.path.insert(0, SCRIPT_ROOT)
+import pipeline
+import profiling
+from merge import SNAPSHOT_SUFFIX, PO_COLS, BL_COLS
+from history import latest_archive
+
+PO_LENGTH = len(PO_COLS)
+BL_LENGTH = len(BL_COLS)
 
 cgitb.enable()
 
@@ -72,28 +69,33 @@ def save_files(form):
     return (po_filename, bl_filename)
 
 
-def merge(po_filename, bl_filename):
-    """Shells to the merge script"""
+def merge(po_filename, bl_filename, 
+          previous_po_filename, previous_bl_filename):
+    """Runs the upload pipeline: differences from the previous upload,
+    then merge.
+    Returns tuple of (owners differences HTML, licenses differences HTML,
+    report.RunReport)"""
 
-    args = [MERGE, po_filename, bl_filename, OUT, ERR, FORCE, '--quiet']
-    retcode = subprocess.call(args)
-
-    if retcode != 0:
-        raise MergeException('Return code %d. ' % retcode +
+    try:
+        upload = profiling.profiled(pipeline.run, 
+                [po_filename, bl_filename, 
+                 previous_po_filename, previous_bl_filename,
+                 OUT, ERR, FORCE, SCRIPT_ROOT], 'pipeline', SCRIPT_ROOT)
+        return (upload.html('PO'), upload.html('BL'), upload.run_report)
+    except Exception, exc:
+        raise MergeException('%s. ' % exc +
                 'Merge script failed. ' +
                 'Possibly invalid input files')
 
 
-def differences(obj_type, current_filename, previous_filename):
-    """Shells to the differences script.
-    Returns the differences as HTML"""
-
-    args = [DIFF, obj_type, current_filename, previous_filename]
-    return subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
+def write_result(po_differences_html, bl_differences_html, run_report):
+    """Creates the result.html file to display and link the results,
+    and the run report next to it"""
 
-
-def write_result(po_differences_html, bl_differences_html):
-    """Creates the result.html file to display and link the results"""
+    run_report.write(RUN_REPORT)
+    run_report_html = ''
+    if SHOW_RUN_REPORT:
+        run_report_html = '<hr>\n<h2>Run report</h2>\n' + run_report.html()
 
     tmpl_file = open(RESULT_TMPL, 'rt')
     tmpl = tmpl_file.read()
@@ -106,7 +108,8 @@ def write_result(po_differences_html, bl_differences_html):
                     last_updated=now,
                     last_updated_date=today,
                     po_differences_html=po_differences_html,
-                    bl_differences_html=bl_differences_html)
+                    bl_differences_html=bl_differences_html,
+                    run_report_html=run_report_html)
 
     result_file = open(RESULT, 'wt')
     result_file.write(result)
@@ -193,13 +196,15 @@ def output_error(err):
 
 def most_recent(directory, prefix):
     """Finds the most recent file in directory
-    that starts with prefix. directory must end with
-    a slash.
+    that starts with prefix, other than snapshots. 
+    directory must end with a slash.
     @return Filename of most recent file in 'directory' that
     start with 'prefix'."""
 
     options = []
     for filename in glob.glob(directory + prefix + '*'):
+        if filename.endswith(SNAPSHOT_SUFFIX):
+            continue
         last_mod = time.localtime(os.stat(filename)[8])
         options.append((last_mod, filename))
 
@@ -207,6 +212,20 @@ def most_recent(directory, prefix):
     return options[0][1]
 
 
+def previous_upload(compare_type, prefix):
+    """Finds the archive of the previous upload from the manifest 
+    history.archive writes, or failing that with most_recent
+    @param compare_type 'PO' or 'BL'
+    @param prefix Start of the archive filenames, for most_recent
+    @return Filename of the archive
+    """
+
+    filename = latest_archive(compare_type, SCRIPT_ROOT)
+    if filename is None:
+        filename = most_recent(SCRIPT_ROOT, prefix)
+    return filename
+
+
 def main():
     """Main"""
 
@@ -219,19 +238,17 @@ def main():
 
     po_filename, bl_filename = save_files(form)
 
-    previous_po_filename = most_recent(SCRIPT_ROOT, 'po.csv.20')
-    previous_bl_filename = most_recent(SCRIPT_ROOT, 'bl.csv.20')
-
-    po_diff_html = differences('PO', po_filename, previous_po_filename)
-    bl_diff_html = differences('BL', bl_filename, previous_bl_filename)
+    previous_po_filename = previous_upload('PO', 'po.csv.20')
+    previous_bl_filename = previous_upload('BL', 'bl.csv.20')
 
     try:
-        merge(po_filename, bl_filename)
+        po_diff_html, bl_diff_html, run_report = merge(po_filename, 
+                bl_filename, previous_po_filename, previous_bl_filename)
     except MergeException, exc:
         output_error(unicode(exc))
         sys.exit(1)
 
-    write_result(po_diff_html, bl_diff_html)
+    write_result(po_diff_html, bl_diff_html, run_report)
 
     redirect()
 